@@ -19,6 +19,10 @@ import thumbstack
 reload(thumbstack)
 from thumbstack import *
 
+import multi_thumbstack
+reload(multi_thumbstack)
+from multi_thumbstack import *
+
 import cmb
 reload(cmb)
 from cmb import *
@@ -164,26 +168,27 @@ ts_list = [[] for _ in range(len(CMB_masklist))]
 
 for key in list(catalogKeys):
     catalog = catalogs[key]
-    
-    for i, cmap in enumerate(cmbMap_list):
-    
-        ts = ThumbStack(u, catalog, 
-                        cmap.map(), 
-                        cmap.mask(), 
-                        cmap.hit(), 
-                        catalog.name + '_' + cmap.name,
-                        nameLong=None, 
-                        save=save, 
-                        nProc=nProc,
-                        filterTypes=filterTypes[i],
-                        doMBins=False, 
-                        doBootstrap=True,
-                        # doStackedMap=True,
-                        doVShuffle=False, 
-                        cmbNu=cmap.nu, 
-                        cmbUnitLatex=cmap.unitLatex,
-                        rApMinArcmin=1.)
-        ts_list[i].append(ts)
+
+    # all the map variants share one CAR geometry:
+    # extract the cutouts once per object, for all the maps
+    mts = MultiMapThumbStack(u, catalog,
+                             [cmap.map() for cmap in cmbMap_list],
+                             [cmap.mask() for cmap in cmbMap_list],
+                             [cmap.hit() for cmap in cmbMap_list],
+                             names=[catalog.name + '_' + cmap.name for cmap in cmbMap_list],
+                             save=save,
+                             nProc=nProc,
+                             kwargsList=[{'filterTypes': filterTypes[i],
+                                          'cmbNu': cmap.nu,
+                                          'cmbUnitLatex': cmap.unitLatex} for i, cmap in enumerate(cmbMap_list)],
+                             nameLong=None,
+                             doMBins=False,
+                             doBootstrap=True,
+                             # doStackedMap=True,
+                             doVShuffle=False,
+                             rApMinArcmin=1.)
+    for i in range(len(cmbMap_list)):
+        ts_list[i].append(mts.ts[i])
 
 ###################################################################################
 
@@ -0,0 +1,209 @@
+"""Synthetic benchmarks of the ThumbStack hot paths.
+Everything is generated here (CAR map, mask, hit count, catalog, universe),
+so no external data is needed. Each benchmark is run for several catalog sizes
+and numbers of processes, and reports objects per second and the parallel
+scaling efficiency. The rates can be saved as baselines, and later runs
+are compared to them, flagging any slowdown beyond a threshold.
+
+Usage:
+python benchmark_thumbstack.py --nObj 1000 10000 --nProc 1 4 --save-baseline
+python benchmark_thumbstack.py --nObj 1000 10000 --nProc 1 4 --threshold 0.2
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/'))
+
+import argparse
+import json
+import shutil
+import tempfile
+
+from importlib import reload
+import thumbstack
+reload(thumbstack)
+from thumbstack import *
+
+##################################################################################
+# Synthetic inputs
+
+
+class BenchmarkUniverse(object):
+    """Stand-in for the Universe classes: ThumbStack only stores it,
+    so no CLASS computation is needed.
+    """
+    pass
+
+
+class BenchmarkCatalog(object):
+    """Minimal catalog with the attributes used by ThumbStack,
+    with objects uniformly distributed in the map footprint.
+    """
+
+    def __init__(self, nObj, raRange, decRange, seed=0):
+        rng = np.random.default_rng(seed)
+        self.name = "benchmark_"+str(nObj)
+        self.nameLong = self.name
+        self.nObj = nObj
+        self.rV = 0.7
+        self.RA = np.mod(rng.uniform(raRange[0], raRange[1], nObj), 360.)
+        self.DEC = np.degrees(np.arcsin(rng.uniform(np.sin(np.radians(decRange[0])), np.sin(np.radians(decRange[1])), nObj)))
+        self.Z = rng.uniform(0.2, 0.8, nObj)
+        self.Mvir = 10.**rng.uniform(12., 14.5, nObj)
+        self.vR = rng.normal(0., 300., nObj)
+        self.integratedY = 1.e-10 * (self.Mvir / 1.e13)**(5./3.)
+        self.integratedKSZ = 1.e-7 * self.vR / 300.
+
+
+def syntheticMaps(decDeg=5., raDeg=10., resArcmin=0.5, seed=0):
+    '''CAR map [muK], mask with holes and smooth hit count map on a patch of the sky.
+    '''
+    rng = np.random.default_rng(seed)
+    box = np.array([[-decDeg, raDeg], [decDeg, -raDeg]]) * utils.degree
+    shape, wcs = enmap.geometry(pos=box, res=resArcmin*utils.arcmin, proj='car')
+    # smooth Gaussian field plus white noise
+    cmbMap = enmap.smooth_gauss(enmap.ndmap(rng.normal(size=shape), wcs), 2.*utils.arcmin) * 100.
+    cmbMap += enmap.ndmap(rng.normal(size=shape), wcs) * 10.
+    # point source holes of 3 arcmin radius
+    cmbMask = enmap.ones(shape, wcs)
+    nHoles = int(0.1 * np.prod(shape) * resArcmin**2 / 60.)
+    iy = rng.integers(0, shape[0], nHoles)
+    ix = rng.integers(0, shape[1], nHoles)
+    r = int(np.ceil(3. / resArcmin))
+    for i in range(nHoles):
+        cmbMask[max(iy[i]-r, 0):iy[i]+r, max(ix[i]-r, 0):ix[i]+r] = 0.
+    # hit count varying across the patch
+    dec, ra = enmap.posmap(shape, wcs)
+    cmbHit = enmap.ndmap(1. + 0.5*np.cos(ra / utils.degree) + 0.3*np.sin(2.*dec / utils.degree), wcs)
+    return cmbMap, cmbMask, cmbHit
+
+
+##################################################################################
+# Benchmarks
+
+
+# benchmarks that use several processes, for the scaling efficiency
+parallelBenchmarks = ['saveFiltering', 'stackedMap']
+
+
+def timeIt(f, nRepeat=1):
+    '''Shortest run time [sec] of f over nRepeat runs,
+    to reduce the noise on the fast benchmarks.
+    '''
+    tMin = np.inf
+    for iRepeat in range(nRepeat):
+        tStart = time()
+        f()
+        tMin = min(tMin, time() - tStart)
+    return tMin
+
+
+def runBenchmarks(nObj, nProc, pathOut, cmbMap, cmbMask, cmbHit, nObjAnalyzeObject=50, nSamples=100):
+    '''Run all the benchmarks for one catalog size and one number of processes.
+    Returns a dict {benchmark name: objects per second}.
+    '''
+    decRange = [-4., 4.]
+    raRange = [-9., 9.]
+    Catalog = BenchmarkCatalog(nObj, raRange, decRange)
+    # construct without any analysis: the stages are timed one by one below
+    ts = ThumbStack(BenchmarkUniverse(), Catalog, cmbMap, cmbMask, cmbHit, name="benchmark_"+str(nObj)+"_"+str(nProc),
+                    save=True, nProc=nProc, filterTypes='diskring', pathOut=pathOut, doAnalysis=False)
+    filterType = 'diskring'
+    rates = {}
+
+    rates['saveOverlapFlag'] = nObj / timeIt(lambda: ts.saveOverlapFlag(), nRepeat=3)
+    ts.loadOverlapFlag()
+
+    I = np.where(ts.overlapFlag[:] > 0.)[0][:nObjAnalyzeObject]
+    rates['analyzeObject'] = len(I) / timeIt(lambda: [ts.analyzeObject(iObj) for iObj in I])
+
+    rates['saveFiltering'] = nObj / timeIt(lambda: ts.saveFiltering(nProc=nProc))
+    ts.loadFiltering()
+    ts.measureAllVarFromHitCount(plot=False)
+
+    rates['catalogMask'] = nObj / timeIt(lambda: ts.catalogMask(filterType=filterType), nRepeat=5)
+    for est in ['tsz_uniformweight', 'ksz_varweight']:
+        rates['computeStackedProfile_'+est] = nObj / timeIt(lambda: ts.computeStackedProfile(filterType, est), nRepeat=5)
+    rates['bootstrap'] = nObj * nSamples / timeIt(lambda: ts.SaveCovBootstrapStackedProfile(filterType, 'tsz_uniformweight', nSamples=nSamples))
+    rates['stackedMap'] = nObj / timeIt(lambda: ts.computeStackedProfile(filterType, 'tsz_uniformweight', stackedMap=True))
+    return rates
+
+
+##################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic benchmarks of the ThumbStack hot paths")
+    parser.add_argument('--nObj', type=int, nargs='+', default=[1000, 10000], help="catalog sizes")
+    parser.add_argument('--nProc', type=int, nargs='+', default=[1, 4], help="numbers of processes")
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json'),
+                        help="file with the baseline rates")
+    parser.add_argument('--save-baseline', action='store_true', help="save the rates of this run as the new baselines")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="flag a regression if a rate drops by more than this fraction below its baseline")
+    parser.add_argument('--output', default=None, help="optional json file for the rates of this run")
+    args = parser.parse_args()
+
+    # all the outputs go to a temporary directory
+    pathTmp = tempfile.mkdtemp(prefix="thumbstack_benchmark_")
+    cwd = os.getcwd()
+    os.chdir(pathTmp)
+    cmbMap, cmbMask, cmbHit = syntheticMaps()
+    results = {}
+    try:
+        for nObj in args.nObj:
+            for nProc in args.nProc:
+                print("- benchmark nObj="+str(nObj)+", nProc="+str(nProc))
+                rates = runBenchmarks(nObj, nProc, pathTmp+"/", cmbMap, cmbMask, cmbHit)
+                for name in rates:
+                    results[name+"/"+str(nObj)+"/"+str(nProc)] = rates[name]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(pathTmp, ignore_errors=True)
+
+    # rates and parallel scaling efficiency, relative to the smallest nProc
+    nProc0 = min(args.nProc)
+    print("")
+    print("%-40s %8s %6s %14s %10s" % ("benchmark", "nObj", "nProc", "obj/sec", "efficiency"))
+    for key in sorted(results.keys(), key=lambda k: (k.split('/')[0], int(k.split('/')[1]), int(k.split('/')[2]))):
+        name, nObj, nProc = key.split('/')
+        if name in parallelBenchmarks:
+            rate0 = results[name+"/"+nObj+"/"+str(nProc0)]
+            efficiency = "%.2f" % (results[key] / rate0 * nProc0 / int(nProc))
+        else:
+            efficiency = "-"
+        print("%-40s %8s %6s %14.1f %10s" % (name, nObj, nProc, results[key], efficiency))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.save_baseline:
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print("- baselines saved to "+args.baseline)
+        return 0
+
+    # compare to the baselines
+    if not os.path.exists(args.baseline):
+        print("- no baselines in "+args.baseline+": run with --save-baseline first")
+        return 0
+    with open(args.baseline) as f:
+        baselines = json.load(f)
+    regressions = []
+    for key in results:
+        if key in baselines and results[key] < (1. - args.threshold) * baselines[key]:
+            regressions.append(key)
+            print("REGRESSION "+key+": "+str(round(results[key], 1))+" obj/sec, baseline "+str(round(baselines[key], 1)))
+    if len(regressions) > 0:
+        return 1
+    print("- no regression beyond "+str(args.threshold)+" of the baselines")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
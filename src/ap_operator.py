@@ -0,0 +1,194 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+class ApOperator(object):
+    """Sparse linear operator from the pixels of a CAR map
+    to the AP filter values of all the objects in a catalog:
+    filtMap = W @ map_pixels,
+    with W of shape [nObj * nFilterTypes * nRAp, nPix].
+    W combines the bilinear interpolation of the map onto the cutouts
+    with the AP filter weights.
+    It only depends on the catalog, the map geometry and the AP filters,
+    so it is built once, saved to disk (CSR, memory-mapped when reloaded),
+    and then any map on the same pixelization (GRF mocks, difference maps,
+    ILC variants, Dirac/Gauss mocks...) is filtered with a sparse mat-vec.
+    The mask and hit count are not linear inputs (the mask is thresholded):
+    the filtMask, filtHitNoiseStdDev and filtArea of the reference ThumbStack
+    are stored alongside, and reused for all the maps.
+    """
+
+    def __init__(self, ts=None, pathOut=None, save=False, nProc=None):
+        '''ts: reference ThumbStack object, providing the catalog, the map geometry,
+        the AP filters, the overlap flag, and the filter outputs for the mask and hit count.
+        Only needed to build the operator (save=True), or to locate it (if pathOut is None).
+        '''
+        if pathOut is None:
+            pathOut = ts.pathOut + "/ap_operator"
+        self.pathOut = pathOut
+        if not os.path.exists(self.pathOut):
+            os.makedirs(self.pathOut)
+        if nProc is None:
+            nProc = 1 if ts is None else ts.nProc
+
+        # number of objects per chunk when building the operator:
+        # each object contributes ~ 4 * nFilterTypes*nRAp * nPixCutout entries before compression
+        self.nObjPerChunk = 16
+
+        if save:
+            self.saveOperator(ts, nProc=nProc)
+        self.loadOperator()
+
+    ##################################################################################
+
+    def operatorChunk(self, ts, IObj):
+        '''Rows of the sparse operator for the objects with indices IObj,
+        as a CSR matrix with shape [nChunk * nFilterTypes*nRAp, nPix].
+        Objects that do not overlap with the map get empty rows.
+        '''
+        IObj = np.asarray(IObj)
+        nK = ts.filterBank.filterWFlat.shape[0]
+        nY, nX = ts.cmbMap.shape[-2:]
+
+        # keep only the cutout pixels where at least one filter is non-zero
+        iPix = np.where(np.any(ts.filterBank.filterWFlat != 0., axis=0))[0]
+        filterW = ts.filterBank.filterWFlat[:, iPix]   # [nK, nPixCutout]
+
+        # only the objects that overlap with the map
+        J = np.where(ts.overlapFlag[IObj] > 0.)[0]
+        if len(J) == 0:
+            return sparse.csr_matrix((len(IObj) * nK, nY * nX))
+
+        # fractional pixel coordinates on the big map [{y,x},nChunk,nPixCutout]
+        opos, ipos = ts.stampPositions(IObj[J])
+        ipos = ipos.reshape((2, len(J), -1))[:, :, iPix]
+        pix = ts.cmbMap.sky2pix(ipos)
+        iY0 = np.floor(pix[0]).astype(int)
+        iX0 = np.floor(pix[1]).astype(int)
+        fY = pix[0] - iY0
+        fX = pix[1] - iX0
+
+        # bilinear interpolation: 4 neighboring pixels [nChunk,nPixCutout,4]
+        iY = np.stack([iY0, iY0, iY0+1, iY0+1], axis=-1)
+        iX = np.stack([iX0, iX0+1, iX0, iX0+1], axis=-1)
+        wInterp = np.stack([(1.-fY)*(1.-fX), (1.-fY)*fX, fY*(1.-fX), fY*fX], axis=-1)
+        # pixels outside the map contribute zero, as in enmap.at(mode='constant')
+        inMap = (iY >= 0) * (iY < nY) * (iX >= 0) * (iX < nX)
+        wInterp *= inMap
+        iCol = np.clip(iY, 0, nY-1) * nX + np.clip(iX, 0, nX-1)
+
+        # combine filter and interpolation weights [nChunk,nK,nPixCutout,4]
+        data = filterW[np.newaxis, :, :, np.newaxis] * wInterp[:, np.newaxis, :, :]
+        rows = np.broadcast_to(J[:, np.newaxis, np.newaxis, np.newaxis] * nK
+                               + np.arange(nK)[np.newaxis, :, np.newaxis, np.newaxis], data.shape)
+        cols = np.broadcast_to(iCol[:, np.newaxis, :, :], data.shape)
+        I = np.where(data != 0.)
+        # duplicate (row, col) pairs are summed when converting to CSR
+        W = sparse.coo_matrix((data[I], (rows[I], cols[I])), shape=(len(IObj) * nK, nY * nX)).tocsr()
+        return W
+
+    def saveOperator(self, ts, nProc=1):
+        print("- build the sparse AP operator for "+ts.name)
+        tStart = time()
+        nObj = ts.Catalog.nObj
+        nK = ts.filterBank.filterWFlat.shape[0]
+
+        # column indices are stored as int32
+        if np.prod(ts.cmbMap.shape[-2:]) >= np.iinfo(np.int32).max:
+            raise ValueError("ApOperator does not support maps with more than 2^31 pixels")
+
+        # stream the CSR arrays to disk, chunk by chunk
+        pathData = self.pathOut + "/data.bin"
+        pathIndices = self.pathOut + "/indices.bin"
+        indptr = [np.zeros(1, dtype=np.int64)]
+        nnz = 0
+        chunks = np.array_split(np.arange(nObj), max(1, int(np.ceil(nObj / self.nObjPerChunk))))
+        with open(pathData, 'wb') as fData, open(pathIndices, 'wb') as fIndices:
+            # process nProc chunks at a time, to limit the memory
+            for iBatch in range(0, len(chunks), nProc):
+                batch = chunks[iBatch:iBatch+nProc]
+                with sharedmem.MapReduce(np=nProc) as pool:
+                    result = pool.map(lambda IObj: self.operatorChunk(ts, IObj), batch)
+                for W in result:
+                    W.data.astype(np.float64).tofile(fData)
+                    W.indices.astype(np.int32).tofile(fIndices)
+                    indptr.append(nnz + W.indptr[1:].astype(np.int64))
+                    nnz += W.nnz
+        indptr = np.concatenate(indptr)
+        # use the index dtype that scipy.sparse would pick,
+        # so that the memory-mapped arrays are not copied when reloaded
+        if nnz < np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        np.save(self.pathOut + "/indptr.npy", indptr)
+
+        # filter outputs that are not linear in the map,
+        # reused for all the maps filtered with this operator
+        # [{filtMask, filtHitNoiseStdDev, filtArea}, nObj, nFilterTypes, nRAp]
+        aux = np.zeros((3, nObj, len(ts.filterTypes), ts.nRAp))
+        for iFilterType in range(len(ts.filterTypes)):
+            filterType = ts.filterTypes[iFilterType]
+            aux[0, :, iFilterType, :] = ts.filtMask[filterType]
+            aux[1, :, iFilterType, :] = ts.filtHitNoiseStdDev[filterType]
+            aux[2, :, iFilterType, :] = ts.filtArea[filterType]
+        np.save(self.pathOut + "/filtaux.npy", aux)
+
+        # metadata, to check that the operator matches the maps and AP filters
+        meta = {
+            'name': ts.name,
+            'nObj': int(nObj),
+            'nnz': int(nnz),
+            'shape': [int(nObj * nK), int(np.prod(ts.cmbMap.shape[-2:]))],
+            'mapShape': [int(n) for n in ts.cmbMap.shape[-2:]],
+            'mapWcs': ts.cmbMap.wcs.to_header_string(),
+            'filterTypes': [str(f) for f in ts.filterTypes],
+            'RApArcmin': [float(r) for r in ts.RApArcmin],
+            'cutoutShape': [int(n) for n in ts.filterBank.shape],
+        }
+        with open(self.pathOut + "/meta.json", 'w') as f:
+            json.dump(meta, f, indent=1)
+        tStop = time()
+        print("took", (tStop-tStart)/60., "min")
+
+    def loadOperator(self):
+        with open(self.pathOut + "/meta.json") as f:
+            self.meta = json.load(f)
+        self.nObj = self.meta['nObj']
+        self.filterTypes = np.array(self.meta['filterTypes'])
+        self.RApArcmin = np.array(self.meta['RApArcmin'])
+        # memory-map the CSR arrays
+        nnz = self.meta['nnz']
+        data = np.memmap(self.pathOut + "/data.bin", dtype=np.float64, mode='r', shape=(nnz,))
+        indices = np.memmap(self.pathOut + "/indices.bin", dtype=np.int32, mode='r', shape=(nnz,))
+        indptr = np.load(self.pathOut + "/indptr.npy", mmap_mode='r')
+        self.W = sparse.csr_matrix((data, indices, indptr), shape=tuple(self.meta['shape']), copy=False)
+        self.filtAux = np.load(self.pathOut + "/filtaux.npy", mmap_mode='r')
+
+    ##################################################################################
+
+    def checkCompatible(self, ts):
+        '''Raise an error if the ThumbStack object ts does not have the same
+        catalog size, map geometry and AP filters as the operator.
+        '''
+        if ts.Catalog.nObj != self.nObj:
+            raise ValueError("ApOperator was built for "+str(self.nObj)+" objects, not "+str(ts.Catalog.nObj))
+        if list(ts.cmbMap.shape[-2:]) != self.meta['mapShape'] or ts.cmbMap.wcs.to_header_string() != self.meta['mapWcs']:
+            raise ValueError("ApOperator was built for a different map geometry")
+        if list(ts.filterTypes) != list(self.filterTypes) or not np.allclose(ts.RApArcmin, self.RApArcmin):
+            raise ValueError("ApOperator was built for different AP filters")
+
+    def apply(self, cmbMap):
+        """Evaluate all the AP filters on all the objects, for the map cmbMap.
+        Returns an array with shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nObj, nFilterTypes, nRAp],
+        as ThumbStack.analyzeChunk.
+        """
+        if list(cmbMap.shape[-2:]) != self.meta['mapShape']:
+            raise ValueError("map shape "+str(cmbMap.shape)+" does not match the ApOperator")
+        nFilterTypes = len(self.filterTypes)
+        nRAp = len(self.RApArcmin)
+        result = np.zeros((4, self.nObj, nFilterTypes, nRAp))
+        # [map unit * sr]
+        result[0] = self.W.dot(np.asarray(cmbMap).reshape(-1)).reshape((self.nObj, nFilterTypes, nRAp))
+        result[1:] = self.filtAux
+        return result
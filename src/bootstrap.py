@@ -0,0 +1,164 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+class BootstrapStack(object):
+    """Bootstrap resampling of the stacked profiles, for all the samples at once.
+    The stacked profile estimators are ratios of weighted sums over objects,
+    so a bootstrap resample is fully described by its count vector
+    (number of times each object is drawn).
+    The counts for a block of samples form a matrix C [nBlock, nObj],
+    and the weighted sums for all these samples are obtained
+    with a single matrix product C @ X, where X [nObj, nColumns] holds
+    the per-object terms of the estimator.
+    """
+
+    def __init__(self, nObj, nSamples=100, seed=0, maxBlockEntries=2**25):
+        '''nObj: number of objects to resample
+        nSamples: number of bootstrap resamples
+        seed: the resamples are reproducible for a given seed
+        maxBlockEntries: max number of entries in the count matrix of a block,
+        to limit the memory (8 bytes per entry)
+        '''
+        self.nObj = nObj
+        self.nSamples = nSamples
+        self.seed = seed
+        self.nBlock = int(np.clip(maxBlockEntries // max(nObj, 1), 1, nSamples))
+
+    def countBlocks(self):
+        '''Generates the count matrices C [nBlock, nObj] of consecutive blocks of samples.
+        The counts of nObj objects chosen with replacement are multinomial,
+        and are drawn for a whole block at once.
+        The blocks are drawn in turn from a single random stream, seeded with seed,
+        so the samples do not depend on the block size.
+        '''
+        rng = np.random.default_rng(self.seed)
+        pObj = np.full(self.nObj, 1. / self.nObj)
+        for iStart in range(0, self.nSamples, self.nBlock):
+            nBlock = min(self.nBlock, self.nSamples - iStart)
+            yield rng.multinomial(self.nObj, pObj, size=nBlock)
+
+    def resampledSums(self, X):
+        '''Weighted sums of the columns of X for all the resamples.
+        X: array with shape [nObj, ...]
+        Returns an array with shape [nSamples, ...]
+        '''
+        X = np.asarray(X)
+        shape = X.shape[1:]
+        X = X.reshape((self.nObj, -1))
+        sums = np.concatenate([np.dot(C, X) for C in self.countBlocks()], axis=0)
+        return sums.reshape((self.nSamples,) + shape)
+
+    ##################################################################################
+
+    def estimatorTerms(self, est, t, v, s2Hit, s2Full, m):
+        '''Per-object terms of the estimator est, with shape [nObj, nTerms, nRAp],
+        whose resampled sums determine the stacked profile.
+        Same inputs as in ThumbStack.computeStackedProfile, after masking.
+        '''
+        ones = np.ones_like(s2Hit)
+        if est in ['tsz_uniformweight', 'ksz_uniformweight']:
+            u = ones
+        elif est in ['tsz_hitweight', 'ksz_hitweight']:
+            u = 1. / s2Hit
+        elif est in ['tsz_varweight', 'ksz_varweight', 'ksz_massvarweight']:
+            u = 1. / s2Full
+
+        if est.startswith('tsz'):
+            # sum(w t), sum(w)
+            terms = [t * u, u]
+        else:
+            v = v[:, np.newaxis] * ones
+            if est == 'ksz_massvarweight':
+                mv = m[:, np.newaxis] * v
+            else:
+                mv = v
+            # sum(w t), sum(w mv), sum(v), sum(v^2), sum(m)
+            terms = [t * mv * u, mv**2 * u, v, v**2, m[:, np.newaxis] * ones]
+        return np.stack(terms, axis=1)
+
+    def estimatorStack(self, est, sums, rV=1.):
+        '''Stacked profiles [nSamples, nRAp] from the resampled sums
+        [nSamples, nTerms, nRAp] of the estimator terms.
+        '''
+        if est.startswith('tsz'):
+            return sums[:, 0] / sums[:, 1]
+        # std and mean of the resampled velocities and masses
+        meanV = sums[:, 2] / self.nObj
+        stdV = np.sqrt(np.maximum(sums[:, 3] / self.nObj - meanV**2, 0.))
+        norm = stdV / rV / sums[:, 1]
+        if est == 'ksz_massvarweight':
+            norm *= sums[:, 4] / self.nObj
+        return norm * sums[:, 0]
+
+    def stackSamples(self, est, t, v, s2Hit, s2Full, m, rV=1.):
+        '''Bootstrap samples of the stacked profile for the estimator est,
+        with shape [nSamples, nRAp].
+        '''
+        terms = self.estimatorTerms(est, t, v, s2Hit, s2Full, m)
+        return self.estimatorStack(est, self.resampledSums(terms), rV=rV)
+
+
+##################################################################################
+##################################################################################
+
+
+class VShuffleStack(object):
+    """Velocity-shuffling null test of the kSZ stacked profiles, for all the shuffles at once.
+    Only the velocities change between shuffles, and the kSZ estimators are linear in v
+    in the numerator and quadratic in v in the normalization,
+    while std(v) and mean(m) are unchanged by a permutation.
+    The shuffled velocities for a block of samples form a matrix V [nBlock, nObj],
+    and the stacked profiles follow from the matrix products V @ X and V^2 @ Y.
+    """
+
+    def __init__(self, nObj, nSamples=100, seed=0, maxBlockEntries=2**25):
+        '''nObj: number of objects
+        nSamples: number of velocity shuffles
+        seed: the shuffles are reproducible for a given seed
+        maxBlockEntries: max number of entries in the velocity matrix of a block
+        '''
+        self.nObj = nObj
+        self.nSamples = nSamples
+        self.seed = seed
+        self.nBlock = int(np.clip(maxBlockEntries // max(nObj, 1), 1, nSamples))
+
+    def velocityBlocks(self, v):
+        '''Generates the shuffled velocities V [nBlock, nObj] of consecutive blocks of samples,
+        each row being an independent permutation of v.
+        The blocks are drawn in turn from a single random stream, seeded with seed,
+        so the samples do not depend on the block size.
+        '''
+        rng = np.random.default_rng(self.seed)
+        for iStart in range(0, self.nSamples, self.nBlock):
+            nBlock = min(self.nBlock, self.nSamples - iStart)
+            yield rng.permuted(np.broadcast_to(v, (nBlock, self.nObj)), axis=1)
+
+    def stackSamples(self, est, t, v, s2Hit, s2Full, m, rV=1.):
+        '''Shuffled stacked profiles for the kSZ estimator est, with shape [nSamples, nRAp].
+        Same inputs as in ThumbStack.computeStackedProfile, after masking.
+        '''
+        if not est.startswith('ksz'):
+            raise ValueError("velocity shuffling only applies to the kSZ estimators, not "+est)
+        if est == 'ksz_uniformweight':
+            u = np.ones_like(s2Hit)
+        elif est == 'ksz_hitweight':
+            u = 1. / s2Hit
+        else:
+            u = 1. / s2Full
+        # the estimator weights are w = p v u
+        if est == 'ksz_massvarweight':
+            p = m[:, np.newaxis]
+            norm0 = np.mean(m) * np.std(v) / rV
+        else:
+            p = 1.
+            norm0 = np.std(v) / rV
+        X = p * u * t
+        Y = p**2 * u
+        samples = []
+        for V in self.velocityBlocks(v):
+            # sum(w t) and sum(p v w)
+            samples.append(norm0 * np.dot(V, X) / np.dot(V**2, Y))
+        return np.concatenate(samples, axis=0)
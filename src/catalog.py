@@ -1,5 +1,49 @@
 from headers import *
 
+##################################################################################
+##################################################################################
+
+# columns of the output catalog, in the order of catalog.txt
+catalogColumns = ['RA', 'DEC', 'Z',
+                  'coordX', 'coordY', 'coordZ',
+                  'dX', 'dY', 'dZ',
+                  'dXKaiser', 'dYKaiser', 'dZKaiser',
+                  'vX', 'vY', 'vZ',
+                  'vR', 'vTheta', 'vPhi',
+                  'Mstellar',
+                  'hasM', 'Mvir',
+                  'integratedTau', 'integratedKSZ', 'integratedY']
+
+
+def saveCatalogColumns(pathColumns, data):
+   """Save the catalog data [nObj, 24] as a columnar store:
+   one binary file "<column>.npy" per column in the directory pathColumns,
+   plus "columns.json" with the column names and the number of objects.
+   "columns.json" is written last, so an interrupted save is not used.
+   Each column is written to a temporary file, then renamed,
+   so the catalogs that memory-map the previous columns keep their data.
+   """
+   if not os.path.exists(pathColumns):
+      os.makedirs(pathColumns)
+   if os.path.exists(pathColumns + "/columns.json"):
+      os.remove(pathColumns + "/columns.json")
+   for iColumn in range(len(catalogColumns)):
+      path = pathColumns + "/" + catalogColumns[iColumn] + ".npy"
+      with open(path + ".tmp", 'wb') as f:
+         np.save(f, np.ascontiguousarray(data[:,iColumn], dtype=np.float64))
+      os.replace(path + ".tmp", path)
+   with open(pathColumns + "/columns.json", 'w') as f:
+      json.dump({'nObj': int(len(data)), 'columns': catalogColumns}, f, indent=1)
+
+
+def convertCatalogToColumns(pathOutCatalog, pathColumns):
+   """One-time conversion of a text catalog (catalog.txt) to the columnar store.
+   """
+   print("- convert the text catalog "+pathOutCatalog+" to the columnar store "+pathColumns)
+   data = np.genfromtxt(pathOutCatalog)
+   saveCatalogColumns(pathColumns, np.atleast_2d(data))
+
+
 ##################################################################################
 ##################################################################################
 
@@ -25,6 +69,8 @@ class Catalog(object):
          os.makedirs(self.pathOut)
       # catalog path
       self.pathOutCatalog = self.pathOut + "/catalog.txt"
+      # columnar binary copy of the catalog, memory-mapped when loading
+      self.pathOutColumns = self.pathOut + "/columns"
       # path for vtk file (to visualize with VisIt)
       self.pathOutVtk = self.pathOut + "/catalog.vtk"
       
@@ -48,40 +94,24 @@ class Catalog(object):
    ##################################################################################
    ##################################################################################
 
-   def copy(self, name="test", nameLong=None):
+   def copy(self, name="test", nameLong=None, save=False):
       """Copy a catalog class, with the option of changing the name.
+      Returns a CatalogView with its own copy of the columns, which can be modified
+      (eg np.random.shuffle(newCat.vR)) without changing this catalog.
+      If save is True, the copy is also written to disk and returned as a Catalog.
       """
-      # First copy the output catalog
-      # new catalog path
-      newPathOut = "./output/catalog/"+name
-      if not os.path.exists(newPathOut):
-         os.makedirs(newPathOut)
-      newPathOutCatalog = newPathOut + "/catalog.txt"
-      # copy the output catalog
-      copyfile(self.pathOutCatalog, newPathOutCatalog)
-      
-      # Then copy the catalog properties
-      newCat = Catalog(self.U, self.MassConversion, name=name, nameLong=nameLong, pathInCatalog=self.pathInCatalog, save=False)
-      return newCat
+      return self.extractCatalog(slice(None), name=name, nameLong=nameLong, save=save)
 
 
-   def extractCatalog(self, I, name="test", nameLong=None):
+   def extractCatalog(self, I, name="test", nameLong=None, save=False):
       """create and return a new catalog object,
-      keeping only the objects with indices in I
+      keeping only the objects with indices in I (index array, boolean mask or slice).
+      Returns a CatalogView with its own copy of the columns, without writing anything to disk.
+      If save is True, the new catalog is also written to disk and returned as a Catalog.
       """
-      # new catalog path
-      newPathOut = "./output/catalog/"+name
-      if not os.path.exists(newPathOut):
-         os.makedirs(newPathOut)
-      newPathOutCatalog = newPathOut + "/catalog.txt"
-      # read the current catalog
-      data = np.genfromtxt(self.pathOutCatalog)
-      # keep only objects with indices in I
-      data = data[I,:]
-      # save it to new catalog path
-      np.savetxt(newPathOutCatalog, data)
-      # Then copy the catalog properties
-      newCat = Catalog(self.U, self.MassConversion, name=name, nameLong=nameLong, pathInCatalog=self.pathInCatalog, save=False)
+      newCat = CatalogView(self, I, name=name, nameLong=nameLong)
+      if save:
+         newCat = newCat.save()
       return newCat
 
 
@@ -142,11 +172,10 @@ class Catalog(object):
       self.hasM = np.zeros(self.nObj)
       
       self.Mvir = np.zeros(self.nObj)
-      for iObj in range(self.nObj):
-         mStellar = self.Mstellar[iObj]
-         if (mStellar>1.e3) and not np.isnan(mStellar):
-            self.hasM[iObj] = True
-            self.Mvir[iObj] = self.MassConversion.fmStarTomVir(mStellar)
+      # objects with a valid stellar mass (the comparison is False for NaN)
+      I = np.where(self.Mstellar>1.e3)[0]
+      self.hasM[I] = True
+      self.Mvir[I] = self.MassConversion.fmStarTomVir(self.Mstellar[I])
 
       # for object without a mass, use the mean mass from the others
       if np.sum(self.hasM)>0:
@@ -278,63 +307,58 @@ class Catalog(object):
       data[:, 23] = self.integratedY # [sr]
       #
       np.savetxt(self.pathOutCatalog, data)
+      # binary copy, for fast loading
+      saveCatalogColumns(self.pathOutColumns, data)
+
+
+   def updateColumns(self):
+      """Convert the text catalog to the columnar store,
+      if the store is missing or older than the text catalog.
+      """
+      pathMeta = self.pathOutColumns + "/columns.json"
+      if not os.path.exists(pathMeta) or (os.path.exists(self.pathOutCatalog) and os.path.getmtime(self.pathOutCatalog) > os.path.getmtime(pathMeta)):
+         convertCatalogToColumns(self.pathOutCatalog, self.pathOutColumns)
 
 
    def loadCatalog(self, nObj=None):
-      print("- load full catalog from "+self.pathOutCatalog)
-      data = np.genfromtxt(self.pathOutCatalog)
-      self.nObj = len(data[:nObj,0])
-      #
-      # sky coordinates and redshift
-      self.RA = data[:nObj,0] # [deg]
-      self.DEC = data[:nObj,1]   # [deg]
-      self.Z = data[:nObj,2]
-      #
-      # observed cartesian coordinates
-      self.coordX = data[:nObj,3]   # [Mpc/h]
-      self.coordY = data[:nObj,4]   # [Mpc/h]
-      self.coordZ = data[:nObj,5]   # [Mpc/h]
-      #
-      # displacement from difference,
-      # not including the Kaiser displacement,
-      # from differences of the observed and reconstructed fields
-      self.dX = data[:nObj,6]   # [Mpc/h]
-      self.dY = data[:nObj,7]   # [Mpc/h]
-      self.dZ = data[:nObj,8]   # [Mpc/h]
-      #
-      # Kaiser-only displacement
-      # originally from differences of the observed and reconstructed fields
-      self.dXKaiser = data[:nObj,9]   # [Mpc/h] from cartesian catalog difference
-      self.dYKaiser = data[:nObj,10]   # [Mpc/h]
-      self.dZKaiser = data[:nObj,11]   # [Mpc/h]
-      #
-      # velocity in cartesian coordinates
-      self.vX = data[:nObj,12]   #[km/s]
-      self.vY = data[:nObj,13]   #[km/s]
-      self.vZ = data[:nObj,14]   #[km/s]
-      #
-      # velocity in spherical coordinates,
-      # from catalog of spherical displacements
-      self.vR = data[:nObj,15]  # [km/s]   from spherical catalog, >0 away from us
-      self.vTheta = data[:nObj,16]   # [km/s]
-      self.vPhi = data[:nObj,17]  # [km/s]
-      #
-      # Stellar masses
-      self.Mstellar = data[:nObj,18]   # [M_sun], from Maraston et al
-      #
-      # Halo mass
-      self.hasM = data[:nObj,19]
-      self.Mvir = data[:nObj,20]  # [M_sun]
-      #
-      # Integrated optical depth [sr]: int d^2theta n_e^2d sigma_T = (total nb of electrons) * sigma_T / (a chi)^2
-      self.integratedTau = data[:nObj,21]   # [sr]
-      #
-      # Integrated kSZ signal [muK * sr]: int d^2theta n_e sigma_T (-v/c) Tcmb
-      self.integratedKSZ = data[:nObj, 22] # [muK * sr]
-      #
-      # Integrated Y signal [sr]: int d^2theta n_e sigma_T (kB Te / me c^2)
-      # needs to be multiplied by Tcmb * f(nu) to get muK
-      self.integratedY = data[:nObj, 23] # [sr]
+      """Load the catalog from the columnar store, converted once from catalog.txt if needed.
+      The columns (RA, DEC, Z, Mvir, integratedY, ... see catalogColumns) are not read here:
+      each one is memory-mapped on first access (see __getattr__),
+      so that eg a tSZ stack never reads the velocities or displacements.
+      nObj: keep only the first nObj objects, as views of the memory-mapped columns
+      """
+      self.updateColumns()
+      print("- load full catalog from "+self.pathOutColumns)
+      with open(self.pathOutColumns + "/columns.json") as f:
+         nObjFull = json.load(f)['nObj']
+      self.nObj = len(np.arange(nObjFull)[:nObj])
+      # forget the columns already in memory, eg from readInputCatalog,
+      # so that they are loaded from the store and truncated to nObj
+      for column in catalogColumns:
+         self.__dict__.pop(column, None)
+      self.lazyColumns = True
+      #
+      # indices in the parent catalog, if extracted from another catalog
+      pathParent = os.path.dirname(self.pathOutCatalog) + "/parent.txt"
+      if os.path.exists(pathParent) and nObj is None:
+         with open(pathParent) as f:
+            self.parentName = f.read().strip()
+         self.parentIndices = np.load(os.path.dirname(self.pathOutCatalog) + "/parent_indices.npy")
+
+
+   def __getattr__(self, name):
+      """Only called for attributes not found otherwise:
+      memory-map a catalog column from the columnar store on its first access,
+      and keep it as an attribute for the later accesses.
+      The columns are truncated to the first nObj objects without copying.
+      They are memory-mapped copy-on-write: they can be modified in place (eg cat.Mvir[I] = ...),
+      which only copies the modified pages in memory, and never changes the columnar store.
+      """
+      if name not in catalogColumns or not self.__dict__.get('lazyColumns', False):
+         raise AttributeError(name)
+      column = np.load(self.pathOutColumns + "/" + name + ".npy", mmap_mode='c')[:self.nObj]
+      setattr(self, name, column)
+      return column
 
 
    ##################################################################################
@@ -512,44 +536,46 @@ class Catalog(object):
       Keep the galaxy properties from the first catalog (self).
       If vDiff is True, use the difference of the two velocities, 
       for a null test.
+      nProc: number of threads for the nearest neighbor search
       '''
 
-      # find the intersection
-      hasMatch = np.zeros(self.nObj, dtype=bool)
-
-      def matchObj(iObj):
-         if iObj%10000==0:
-            print("matching object", iObj)
-         ra = self.RA[iObj]
-         dec = self.DEC[iObj]
-         z = self.Z[iObj]
-
-         diff = (newCat.RA - ra)**2 / (1.e-3)**2   # accuracy of Mariana's RA (3.6 arcsec)
-         diff += (newCat.DEC - dec)**2 / (1.e-4)**2   # accuracy of Mariana's DEC (0.36 arcsec)
-         diff += (newCat.Z - z) **2 / (1.e-4)**2   # accuracy of Mariana's redshifts 
-         diff = np.sqrt(diff)
-
-         minDiff = np.min(diff)
-         #print "min diff", minDiff
-         if (minDiff<1.):
-            IMatch = np.where(diff==minDiff)[0]
-            if len(IMatch) > 1:
-               print("Problem: got", len(IMatch), "matches")
-            hasMatch[iObj] = True
-            iMatch = IMatch[0]
-            #print iObj, minDiff
-         else:
-            iMatch = -1
-         return iMatch
-
-
-
-      with sharedmem.MapReduce(np=nProc) as pool:
-         IMatch = np.array(pool.map(matchObj, list(range(self.nObj))))
-         #IMatch = np.array(pool.map(matchObj, range(500)))
-
-
-      I0Match = np.where(IMatch!=-1.)[0]
+      # find the intersection:
+      # nearest neighbors in (unit vector on the sky, z) space,
+      # scaled by the accuracy of the position and redshift,
+      # so that a match is within a distance of 1.
+      # The unit vectors do not wrap around RA=0/360,
+      # and their distances do not depend on DEC.
+      theta = 1.e-3 * np.pi/180.   # accuracy of Mariana's RA and DEC (3.6 arcsec) [rad]
+      chord = 2. * np.sin(theta / 2.)   # chord length for the angular separation theta
+      dZ = 1.e-4   # accuracy of Mariana's redshifts
+
+      def position(cat):
+         ra = cat.RA * np.pi/180.   # [rad]
+         dec = cat.DEC * np.pi/180.   # [rad]
+         return np.array([np.cos(dec) * np.cos(ra) / chord,
+                          np.cos(dec) * np.sin(ra) / chord,
+                          np.sin(dec) / chord,
+                          cat.Z / dZ]).T
+
+      tree = cKDTree(position(newCat))
+      pos = position(self)
+      dist, ind = tree.query(pos, k=1, distance_upper_bound=1., workers=nProc)
+
+      hasMatch = dist < 1.
+      IMatch = np.where(hasMatch, ind, -1)
+      # ambiguous matches: several objects of newCat within the tolerance
+      nCandidates = tree.query_ball_point(pos, r=1., return_length=True, workers=nProc)
+      IAmbiguous = np.where(hasMatch * (nCandidates > 1))[0]
+      if len(IAmbiguous) > 0:
+         print("Problem: got", len(IAmbiguous), "objects with several matches within the tolerance")
+         # keep the closest one, and the first one in newCat if equally close
+         for i in IAmbiguous:
+            J = np.sort(tree.query_ball_point(pos[i], r=1.))
+            d = np.sqrt(np.sum((tree.data[J] - pos[i])**2, axis=1))
+            IMatch[i] = J[np.argmin(d)]
+
+
+      I0Match = np.where(IMatch!=-1)[0]
       print("First catalog has", self.nObj, "objects")
       print("Second catalog has", newCat.nObj, "objects")
       print("Intersection has", len(I0Match), "objects")
@@ -919,8 +945,12 @@ class Catalog(object):
 
 
 
-   def generateMockMaps(self, carMap, sigma=None, test=False):
+   def generateMockMaps(self, carMap, sigma=None, test=False, nProc=1, dtype=np.float64):
       """Generate mock maps with 1 at the pixel location of each  object, 0 everywhere else.
+      Objects falling in the same pixel add up.
+      nProc: number of threads for the Gaussian profiles.
+      dtype: dtype of the Gaussian maps. np.float32 halves their memory
+      and evaluates the profiles in single precision.
       If sigma [arcmin] is specified, produces also Gaussian smoothed versions,
       normalized such that   int d^2theta profile = 1, where theta is in [rad].
       If depixwin==True, the Gaussian profile map is deconvolved with one power
@@ -940,47 +970,28 @@ class Catalog(object):
       velDirac = countDirac.copy()
       # get map of exact pixel sizes
       pixSizeMap = countDirac.pixsizemap()
-      # get map of ra and dec, just to check
-      posmap = countDirac.posmap()
-
-      for iObj in range(self.nObj):
-#      for iObj in range(10):
-         if iObj%100000==0:
-            print("    -", iObj)
-         # object coordinates [deg]
-         ra = self.RA[iObj]
-         dec = self.DEC[iObj]
-         # coordinates in [rad]
-         sourcecoord = np.array([dec, ra]) * np.pi/180.
-         # find pixel indices (float) corresponding to ra, dec
-         iY, iX = enmap.sky2pix(countDirac.shape, countDirac.wcs, sourcecoord, safe=True, corner=False)
-         if test:
-            print('ra, dec =', ra, dec, iY, iX)
-            print(countDirac.shape)
-         # Check that the object is within the map boundaries
-         # before rounding the indices
-         if iX>=0 and iX<=(countDirac.shape[1]-1) and iY>=0 and iY<=(countDirac.shape[0]-1):
-             # nearest pixel
-             # watch out for difference round VS np.round!
-             jY = np.int(round(iY))
-             jX = np.int(round(iX))
-             if test:
-               print(("Object "+str(iObj)+" overlaps"))
-             # fill the pixel
-             countDirac[jY, jX] = 1.
-             velDirac[jY, jX] = - self.vR[iObj] / 3.e5   # v_r/c  [dimless]
-             # check that I filled the right pixel
-             if countDirac.at(sourcecoord, prefilter=False, mask_nan=False, order=0)!=1:
-                print("Filled the wrong pixel for  object", iObj)
-                print("wanted ra, dec=", ra, dec) # [deg]
-                print("chosen closest ra, dec=", posmap[::-1, jY, jX] * 180./np.pi)  # [deg]
-                print("difference in arcmin=", (posmap[::-1, jY, jX] * 180./np.pi - np.array([ra, dec]))*60.)  # residual in [arcmin]
-                print("ra index=", iX, jX, np.int(np.round(iX)), countDirac.shape[1])
-                print("dec index=", iY, jY, np.int(np.round(iY)), countDirac.shape[0])
-
-             # normalize to integrate to 1 over angles in [muK*arcmin^2]
-             countDirac[jY, jX] /= pixSizeMap[jY, jX] * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
-             velDirac[jY, jX] /= pixSizeMap[jY, jX] * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
+
+      # find pixel indices (float) corresponding to ra, dec, for all objects at once
+      sourcecoord = np.array([self.DEC, self.RA]) * np.pi/180.
+      iY, iX = enmap.sky2pix(countDirac.shape, countDirac.wcs, sourcecoord, safe=True, corner=False)
+      # Check that the objects are within the map boundaries
+      # before rounding the indices
+      I = np.where((iX>=0) * (iX<=(countDirac.shape[1]-1)) * (iY>=0) * (iY<=(countDirac.shape[0]-1)))[0]
+      if test:
+         print(str(len(I))+" objects out of "+str(self.nObj)+" overlap with the map")
+      # nearest pixel
+      # np.round rounds to even, like round
+      jY = np.round(iY[I]).astype(int)
+      jX = np.round(iX[I]).astype(int)
+      # fill the pixels, adding up the objects that fall in the same pixel
+      iPix = jY * countDirac.shape[1] + jX
+      nPix = countDirac.shape[0] * countDirac.shape[1]
+      countDirac[:,:] = np.bincount(iPix, minlength=nPix).reshape(countDirac.shape)
+      velDirac[:,:] = np.bincount(iPix, weights=- self.vR[I] / 3.e5, minlength=nPix).reshape(velDirac.shape)   # v_r/c  [dimless]
+
+      # normalize to integrate to 1 over angles in [muK*arcmin^2]
+      countDirac /= pixSizeMap * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
+      velDirac /= pixSizeMap * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
              
       # normalize the mock maps, such that:
       # int dOmega count = 1 [muK*arcmin^2]
@@ -1019,8 +1030,8 @@ class Catalog(object):
 
          import pointsrcs
 
-         countGauss = pointsrcs.sim_srcs(carMap.shape, carMap.wcs, srcsCount, sigma*np.pi/(180.*60.))
-         velGauss = pointsrcs.sim_srcs(carMap.shape, carMap.wcs, srcsVel, sigma*np.pi/(180.*60.))
+         countGauss = pointsrcs.sim_srcs(carMap.shape, carMap.wcs, srcsCount, sigma*np.pi/(180.*60.), dtype=dtype, nthread=nProc)
+         velGauss = pointsrcs.sim_srcs(carMap.shape, carMap.wcs, srcsVel, sigma*np.pi/(180.*60.), dtype=dtype, nthread=nProc)
 #         # normalize to integrate to 1 over angles in [muK*arcmin^2]
 #         countGauss /= pixSizeMap * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
 #         velGauss /= pixSizeMap * (180.*60./np.pi)**2 # divide by pixel area in arcmin^2 
@@ -1168,3 +1179,77 @@ class Catalog(object):
 #
 #      tStop = time()
 #      print("Took "+str((tStart-tStop)/60.)+" min")
+
+
+##################################################################################
+##################################################################################
+
+class CatalogView(Catalog):
+   """Subset of a parent catalog, for the objects with indices I,
+   without reading or writing any catalog file.
+   The columns (RA, DEC, Z, Mvir, vR, integratedY... see catalogColumns)
+   are copied from the parent catalog on creation, and can be modified
+   (eg shuffled velocities) without changing the parent.
+   It can be used wherever a Catalog is, eg in ThumbStack, whose outputs can then be
+   sliced from a ThumbStack on the parent catalog (see ThumbStack.parentIndices).
+   save() writes it to disk as a regular catalog.
+   """
+
+   def __init__(self, parent, I, name="test", nameLong=None):
+      '''parent: Catalog (or CatalogView) to take the objects from
+      I: indices of the objects in the parent catalog (index array, boolean mask or slice)
+      '''
+      self.parent = parent
+      self.U = parent.U
+      self.MassConversion = parent.MassConversion
+      self.pathInCatalog = parent.pathInCatalog
+      self.rV = parent.rV
+      self.name = name
+      if nameLong is None:
+         self.nameLong = self.name
+      else:
+         self.nameLong = nameLong
+
+      # indices in the parent catalog
+      self.parentName = parent.name
+      self.parentIndices = np.arange(parent.nObj)[I]
+      self.nObj = len(self.parentIndices)
+      # contiguous indices: copy from slices of the parent columns
+      if self.nObj > 0 and np.all(np.diff(self.parentIndices) == 1):
+         self.index = slice(self.parentIndices[0], self.parentIndices[-1] + 1)
+      else:
+         self.index = self.parentIndices
+
+      # Output paths, only created when saving
+      self.pathOut = os.path.dirname(parent.pathOut) + "/" + self.name
+      self.pathOutCatalog = self.pathOut + "/catalog.txt"
+      self.pathOutColumns = self.pathOut + "/columns"
+      self.pathOutVtk = self.pathOut + "/catalog.vtk"
+      # Figures path
+      self.pathFig = "./figures/catalog/"+self.name
+
+      # columns of the view, independent from the parent
+      for column in catalogColumns:
+         setattr(self, column, np.array(getattr(parent, column)[self.index]))
+
+
+   def writeCatalog(self):
+      """Write the text catalog and columnar store of a Catalog with the same name,
+      keeping track of the parent catalog.
+      """
+      if not os.path.exists(self.pathOut):
+         os.makedirs(self.pathOut)
+      Catalog.writeCatalog(self)
+      # keep track of the parent catalog, so that a ThumbStack on the new catalog
+      # can slice the outputs of a ThumbStack on the parent catalog
+      np.save(self.pathOut + "/parent_indices.npy", self.parentIndices)
+      with open(self.pathOut + "/parent.txt", 'w') as f:
+         f.write(self.parentName)
+
+
+   def save(self):
+      """Write the catalog to disk (see writeCatalog).
+      Returns the new Catalog.
+      """
+      self.writeCatalog()
+      return Catalog(self.U, self.MassConversion, name=self.name, nameLong=self.nameLong, pathInCatalog=self.pathInCatalog, rV=self.rV, save=False)
@@ -1,10 +1,75 @@
 from headers import *
 
+##################################################################################
+# Uncompressed on-disk cache of the maps, opened as read-only memory maps.
+# Worker processes forked by sharedmem then share one physical copy of the maps
+# (the page cache), instead of duplicating pages on copy-on-write.
+# Put the cache on /dev/shm to keep it in POSIX shared memory.
+# Each cache stores a fingerprint of its input in path+".json",
+# and is rewritten when the input changes.
+
+import stamp_cache
+reload(stamp_cache)
+from stamp_cache import mapChecksum
+
+def saveMapCache(map, path, fingerprint=None):
+    '''Save the pixels of the enmap map to path+".npy",
+    its WCS to path+".wcs" and the fingerprint of its input to path+".json".
+    The files are written to temporary files then renamed, so that the memory maps
+    of a previous cache stay valid. The fingerprint is written last,
+    so that an interrupted save is not used.
+    '''
+    if os.path.exists(path+".json"):
+        os.remove(path+".json")
+    with open(path+".npy.tmp", 'wb') as f:
+        np.save(f, np.asarray(map))
+    os.replace(path+".npy.tmp", path+".npy")
+    with open(path+".wcs.tmp", 'w') as f:
+        f.write(map.wcs.to_header_string())
+    os.replace(path+".wcs.tmp", path+".wcs")
+    with open(path+".json", 'w') as f:
+        json.dump(fingerprint, f, indent=1)
+
+def loadMapCacheFingerprint(path):
+    '''Fingerprint saved with the cache at path, or None if there is no complete cache.
+    '''
+    if not (os.path.exists(path+".npy") and os.path.exists(path+".wcs") and os.path.exists(path+".json")):
+        return None
+    with open(path+".json") as f:
+        return json.load(f)
+
+def loadMapCache(path):
+    '''Read-only enmap, memory-mapped from the cache written by saveMapCache.
+    '''
+    with open(path+".wcs") as f:
+        wcs = wcsutils.WCS(fits.Header.fromstring(f.read()))
+    return enmap.ndmap(np.load(path+".npy", mmap_mode='r'), wcs)
+
+def sharedMap(map, path):
+    '''Memory-mapped copy of the enmap map, cached at path.
+    The cache is (re)written if missing or if it was saved for a different map,
+    according to the checksum of the map (see stamp_cache.mapChecksum).
+    '''
+    if map is None:
+        return None
+    fingerprint = {'checksum': mapChecksum(map), 'shape': list(map.shape), 'dtype': str(map.dtype)}
+    saved = loadMapCacheFingerprint(path)
+    if saved != fingerprint:
+        if saved is not None:
+            print("- the map cached at "+path+" changed: rewrite the cache")
+        saveMapCache(map, path, fingerprint)
+    return loadMapCache(path)
+
 ##################################################################################
 
 class cmbMap(object):
 
-    def __init__(self, pathMap, pathMask=None, pathHit=None,  name="test", nu=150.e9, unitLatex=r'$\mu$K', convert_y=False):
+    def __init__(self, pathMap, pathMask=None, pathHit=None,  name="test", nu=150.e9, unitLatex=r'$\mu$K', convert_y=False, pathCache=None):
+        '''pathCache: if not None, directory where the maps are cached uncompressed
+        after the first read, then returned as read-only memory maps.
+        The cache files are named after name, and rewritten if the input file
+        (path, modification time, size) or the conversion options change.
+        '''
         self.name = name
         self.pathMap = pathMap
         self.pathMask = pathMask
@@ -14,7 +79,50 @@ class cmbMap(object):
         self.unitLatex = unitLatex
         self.convert_y = convert_y
 
+        self.pathCache = pathCache
+        if self.pathCache is not None and not os.path.exists(self.pathCache):
+            os.makedirs(self.pathCache)
+
+    def sourceFingerprint(self, pathSource, options={}):
+        '''Fingerprint of the input file pathSource: absolute path, modification time and size,
+        and the options used to convert it.
+        '''
+        info = os.stat(pathSource)
+        return {'path': os.path.abspath(pathSource), 'mtime': info.st_mtime, 'size': info.st_size, 'options': options}
+
+    def cached(self, key, read, pathSource, options={}):
+        '''Returns read(), through the memory-mapped cache if pathCache is set.
+        The cache is rewritten if pathSource or options changed since it was saved.
+        '''
+        if self.pathCache is None:
+            return read()
+        path = self.pathCache+"/"+self.name+"_"+key
+        fingerprint = self.sourceFingerprint(pathSource, options)
+        saved = loadMapCacheFingerprint(path)
+        if saved != fingerprint:
+            if saved is not None:
+                print("- "+pathSource+" changed: rewrite the cache "+path)
+            result = read()
+            if result is None:
+                return None
+            saveMapCache(result, path, fingerprint)
+        return loadMapCache(path)
+
     def map(self):
+        return self.cached("map", self.readMap, self.pathMap, {'convert_y': bool(self.convert_y), 'nu': float(self.nu)})
+
+    def mask(self):
+        # without a mask file, the mask is derived from the map
+        if self.pathMask is None:
+            return self.cached("mask", self.readMask, self.pathMap, {'fromMap': True})
+        return self.cached("mask", self.readMask, self.pathMask)
+
+    def hit(self):
+        if self.pathHit is None:
+            return None
+        return self.cached("hit", self.readHit, self.pathHit)
+
+    def readMap(self):
         result = enmap.read_map(self.pathMap)
         # if the map contains polarization, keep only temperature
         if len(result.shape) > 2:
@@ -31,7 +139,7 @@ class cmbMap(object):
             result = result / (Tcmb * f(self.nu) * 1.e6)
         return result
 
-    def mask(self):
+    def readMask(self):
         if self.pathMask is None:
 
             CMBmap = enmap.read_map(self.pathMap)
@@ -45,7 +153,7 @@ class cmbMap(object):
             result = result[0]
         return result
 
-    def hit(self):
+    def readHit(self):
         if self.pathHit is None:
             return None
         else:
@@ -51,8 +51,8 @@ cmassKendrick = Catalog(u, massConversion, name="cmass_kendrick", nameLong="CMAS
 # for PACT maps
 #path = "./output/thumbstack/cmass_mariana_pactf150daynight20200228maskgal60r2/overlap_flag.txt"
 #overlapCmassM = np.genfromtxt(path).astype(bool)
-path = "./output/thumbstack/cmass_kendrick_pactf150daynight20200228maskgal60r2/overlap_flag.txt"
-overlapCmassK = np.genfromtxt(path).astype(bool)
+path = "./output/thumbstack/cmass_kendrick_pactf150daynight20200228maskgal60r2/overlap_flag.npy"
+overlapCmassK = np.load(path).astype(bool)
 #path = "./output/thumbstack/lowz_kendrick_pactf150daynight20200228maskgal60r2/overlap_flag.txt"
 #overlapLowzK = np.genfromtxt(path).astype(bool)
 
@@ -253,13 +253,18 @@ for cmbMapKey in cmbMaps.keys()[len(cmbMaps.keys())//2:]:
    cmbUnitLatex = cmbMaps[cmbMapKey].unitLatex
    print("Analyzing map "+cmbName)
 
+   # the mass bins are subsets of the full catalog:
+   # slice the filter outputs of the full catalog instead of recomputing them
+   tsFull = None
    for catalogKey in catalogCombi[cmbMapKey]:
    #for catalogKey in ['lowz20200908mbin2']:
       catalog = catalogs[catalogKey]
       print("Analyzing catalog "+catalog.name)
       name = catalog.name + "_" + cmbName
 
-      ts = ThumbStack(u, catalog, cmbMap, cmbMask, cmbHit, name, nameLong=None, save=save, nProc=nProc, doMBins=False, doBootstrap=True, doVShuffle=False, cmbNu=cmbNu, cmbUnitLatex=cmbUnitLatex)
+      ts = ThumbStack(u, catalog, cmbMap, cmbMask, cmbHit, name, nameLong=None, save=save, nProc=nProc, doMBins=False, doBootstrap=True, doVShuffle=False, cmbNu=cmbNu, cmbUnitLatex=cmbUnitLatex, parent=tsFull)
+      if catalogKey == 'lowz20200908full':
+         tsFull = ts
 
 
 ###################################################################################
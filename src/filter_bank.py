@@ -0,0 +1,141 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+class FilterBank(object):
+    """Bank of aperture photometry filters, for all the filter types and radii
+    of a ThumbStack object.
+    The AP filters only depend on the cutout geometry, not on the object,
+    so the weight stamps are built once here,
+    and then applied to a whole batch of stamps with a single matrix product.
+    """
+
+    def __init__(self, ts):
+        self.filterTypes = ts.filterTypes
+        self.RApArcmin = ts.RApArcmin
+        self.nFilterTypes = len(self.filterTypes)
+        self.nRAp = len(self.RApArcmin)
+        self.hasHit = ts.cmbHit is not None
+
+        # coordinates of the square map in radians
+        # zero is at the center of the map
+        # output map position [{dec,ra},ny,nx]
+        cutoutMap = ts.cutoutGeometry()
+        opos = cutoutMap.posmap()
+        dec = opos[0, :, :]
+        ra = opos[1, :, :]
+        radius = np.sqrt(ra**2 + dec**2)
+        # exact angular area of a pixel [sr] (same for all pixels in CEA, not CAR)
+        pixArea = ra.area() / len(ra.flatten())
+        self.pixArea = pixArea
+        self.shape = cutoutMap.shape
+        nPix = len(radius.flatten())
+
+        # filter weights, including the pixel area [sr]
+        # shape [nFilterTypes, nRAp, nPix]
+        self.filterW = np.zeros((self.nFilterTypes, self.nRAp, nPix))
+        # region where point sources are detected [dimensionless]
+        # shape [nRAp, nPix]
+        self.psRegion = np.zeros((self.nRAp, nPix))
+        # exact angular area of the disk [sr]
+        # shape [nRAp]
+        self.diskArea = np.zeros(self.nRAp)
+
+        for iRAp in range(self.nRAp):
+            # Disk radius in rad
+            r0 = self.RApArcmin[iRAp] / 60. * np.pi/180.
+            # choose an equal area AP filter
+            r1 = r0 * np.sqrt(2.)
+
+            self.psRegion[iRAp, :] = 1.*(radius.flatten() <= r1)
+            self.diskArea[iRAp] = np.sum(radius <= r0) * pixArea
+            for iFilterType in range(self.nFilterTypes):
+                filterType = self.filterTypes[iFilterType]
+                self.filterW[iFilterType, iRAp, :] = pixArea * ts.apertureFilterWeight(
+                    radius, pixArea, r0, r1, filterType=filterType).flatten()
+
+        # flattened versions, for the matrix products
+        # shape [nFilterTypes*nRAp, nPix]
+        self.filterWFlat = self.filterW.reshape((-1, nPix))
+        self.filterW2Flat = self.filterWFlat**2
+
+        # annulus basis: all the filters only depend on the pixel radius,
+        # so they are constant on each set of pixels with the same radius.
+        # annulusIndex maps each cutout pixel to its annulus [nPix]
+        self.annulusRadius, iFirst, self.annulusIndex = np.unique(
+            radius.flatten(), return_index=True, return_inverse=True)
+        self.annulusIndex = self.annulusIndex.reshape(-1)
+        self.nAnnulus = len(self.annulusRadius)
+        # filter weights and point source region on the annuli
+        # shape [nFilterTypes*nRAp, nAnnulus] and [nRAp, nAnnulus]
+        self.annulusW = self.filterWFlat[:, iFirst]
+        self.annulusW2 = self.annulusW**2
+        self.annulusPsRegion = self.psRegion[:, iFirst]
+
+    def apply(self, stamps):
+        """Apply all the filters to a batch of stamps
+        stamps: [nChunk,{map,mask,hit},ny,nx], as returned by ThumbStack.extractStamps,
+        with the mask already thresholded to 0 and 1.
+        Returns an array with shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nChunk, nFilterTypes, nRAp],
+        with the same units as ThumbStack.aperturePhotometryFilter.
+        """
+        nChunk = len(stamps)
+        stamps = stamps.reshape((nChunk, 3, -1))
+        result = np.zeros((4, nChunk, self.nFilterTypes, self.nRAp))
+
+        # apply the filters: int d^2theta filter * map [map unit * sr]
+        result[0] = np.dot(stamps[:, 0, :], self.filterWFlat.T).reshape(
+            (nChunk, self.nFilterTypes, self.nRAp))
+        # detect point sources within the filter [dimensionless]
+        # same for all filter types
+        result[1] = np.dot(1. - stamps[:, 1, :], self.psRegion.T)[:, np.newaxis, :]
+        # noise std dev in the filter [sr / sqrt(hit unit)]
+        if self.hasHit:
+            result[2] = np.sqrt(np.dot(1. / (1.e-16 + stamps[:, 2, :]), self.filterW2Flat.T)).reshape(
+                (nChunk, self.nFilterTypes, self.nRAp))
+        # disk area [sr]
+        result[3] = self.diskArea[np.newaxis, np.newaxis, :]
+        return result
+
+    ##################################################################################
+
+    def annulusSums(self, stamps):
+        """Sums over the pixels of each annulus of the map, of 1-mask and of 1/hit,
+        for a batch of stamps [nChunk,{map,mask,hit},ny,nx].
+        Returns an array with shape [nChunk, {map, 1-mask, 1/hit}, nAnnulus].
+        """
+        nChunk = len(stamps)
+        stamps = stamps.reshape((nChunk, 3, -1))
+        # one bin per (object, annulus)
+        index = (np.arange(nChunk)[:, np.newaxis] * self.nAnnulus + self.annulusIndex[np.newaxis, :]).flatten()
+        sums = np.zeros((nChunk, 3, self.nAnnulus))
+        sums[:, 0] = np.bincount(index, weights=stamps[:, 0].flatten(),
+                                 minlength=nChunk*self.nAnnulus).reshape((nChunk, self.nAnnulus))
+        sums[:, 1] = np.bincount(index, weights=(1. - stamps[:, 1]).flatten(),
+                                 minlength=nChunk*self.nAnnulus).reshape((nChunk, self.nAnnulus))
+        if self.hasHit:
+            sums[:, 2] = np.bincount(index, weights=(1. / (1.e-16 + stamps[:, 2])).flatten(),
+                                     minlength=nChunk*self.nAnnulus).reshape((nChunk, self.nAnnulus))
+        return sums
+
+    def applyAnnulusSums(self, sums):
+        """All the filters, from the annulus sums [nChunk, {map, 1-mask, 1/hit}, nAnnulus]
+        returned by annulusSums.
+        Returns the same array as apply(stamps).
+        """
+        nChunk = len(sums)
+        result = np.zeros((4, nChunk, self.nFilterTypes, self.nRAp))
+        # [map unit * sr]
+        result[0] = np.dot(sums[:, 0], self.annulusW.T).reshape(
+            (nChunk, self.nFilterTypes, self.nRAp))
+        # [dimensionless]
+        result[1] = np.dot(sums[:, 1], self.annulusPsRegion.T)[:, np.newaxis, :]
+        # [sr / sqrt(hit unit)]
+        if self.hasHit:
+            result[2] = np.sqrt(np.dot(sums[:, 2], self.annulusW2.T)).reshape(
+                (nChunk, self.nFilterTypes, self.nRAp))
+        # [sr]
+        result[3] = self.diskArea[np.newaxis, np.newaxis, :]
+        return result
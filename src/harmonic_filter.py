@@ -0,0 +1,212 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+class HarmonicFilter(object):
+    """Evaluate all the AP filters on all the objects by convolving the whole CAR map
+    with each (filterType, r0) kernel in Fourier space, then reading the filtered maps
+    at the object positions, instead of extracting one cutout per object.
+    The cost scales with the map size times the number of filters,
+    independently of the number of objects.
+
+    The AP filters only depend on the radius, and are constant on disks and rings:
+    each kernel is a sum of top-hat disks, whose Fourier transform is analytic
+    (pi R^2 * CMB.fwindowDisk). The disk and ring areas are matched to the pixel counts
+    of the cutout filters (FilterBank), so that eg the disk-ring filter still integrates to zero.
+    The mask and hit count terms are the convolutions of 1-mask with the point source region,
+    and of 1/hit with the squared filter weights.
+
+    The kernels are isotropic on the sky, not in the CAR pixels, whose RA width shrinks as cos(dec).
+    The map is therefore convolved in bands of declination, each with the flat-sky
+    pixel scale at its central declination. The residual anisotropy within a band,
+    the flat-sky approximation and the different interpolation make the outputs
+    differ slightly from the cutout-based filters (see ThumbStack.validateHarmonicFiltering).
+    """
+
+    def __init__(self, ts, bandTol=0.01, maxBandPix=2**23):
+        '''ts: ThumbStack object, providing the maps, the catalog, the AP filters and the overlap flag
+        bandTol: max relative variation of cos(dec) within a declination band
+        maxBandPix: max number of pixels in a band, including the padding, to limit the memory
+        '''
+        self.ts = ts
+        self.filterTypes = ts.filterTypes
+        self.nFilterTypes = len(self.filterTypes)
+        self.nRAp = ts.nRAp
+        self.hasHit = ts.cmbHit is not None
+        self.shape = ts.cmbMap.shape[-2:]
+        self.wcs = ts.cmbMap.wcs
+
+        # piecewise constant filters, from the annulus basis of the cutout filters
+        fb = ts.filterBank
+        self.pixArea = fb.pixArea
+        self.diskArea = fb.diskArea
+        # outer edge of each annulus [rad], such that the disk inside it
+        # has the same area as the cutout pixels up to that annulus
+        count = np.bincount(fb.annulusIndex, minlength=fb.nAnnulus)
+        edge = np.sqrt(np.cumsum(count) * self.pixArea / np.pi)
+
+        def jumps(c):
+            # a step function is a sum of disks:
+            # sum_a (c_a - c_{a+1}) disk(edge_a)
+            return c - np.concatenate([c[:, 1:], np.zeros((len(c), 1))], axis=1)
+        # dimensionless filter weights, squared weights and point source region [pixel count]
+        jumpW = jumps(fb.annulusW / self.pixArea)
+        jumpW2 = jumps(fb.annulusW2 / self.pixArea**2)
+        jumpPs = jumps(fb.annulusPsRegion / self.pixArea)
+        # only keep the edges where at least one filter changes
+        J = np.where(np.any(jumpW != 0., axis=0) | np.any(jumpW2 != 0., axis=0) | np.any(jumpPs != 0., axis=0))[0]
+        self.jumpRadius = edge[J]
+        # shape [nFilterTypes*nRAp, nJump], [nFilterTypes*nRAp, nJump], [nRAp, nJump]
+        self.jumpW = jumpW[:, J]
+        self.jumpW2 = jumpW2[:, J]
+        self.jumpPs = jumpPs[:, J]
+
+        # CAR pixel sizes [rad] and declination of each row
+        self.dy = np.abs(self.wcs.wcs.cdelt[1]) * utils.degree
+        self.dx = np.abs(self.wcs.wcs.cdelt[0]) * utils.degree
+        nY, nX = self.shape
+        self.rowDec = enmap.pix2sky(self.shape, self.wcs, np.array([np.arange(nY), np.zeros(nY)]))[0]
+        # full-sky maps are periodic in RA
+        self.fullRA = np.abs(nX * self.dx - 2.*np.pi) < 0.5 * self.dx
+        # number of rows needed around a band, to convolve its pixels
+        self.padY = int(np.ceil(np.max(self.jumpRadius) / self.dy)) + 2
+
+        self.bands = self.decBands(bandTol, maxBandPix)
+
+    ##################################################################################
+
+    def decBands(self, bandTol, maxBandPix):
+        '''Split the map rows into bands [(i0, i1)] where cos(dec) varies by less than bandTol.
+        '''
+        nY, nX = self.shape
+        c = np.cos(self.rowDec)
+        maxRows = max(1, maxBandPix // (nX + 2*self.padY) - 2*self.padY)
+        bands = []
+        i0 = 0
+        while i0 < nY:
+            cMin = cMax = c[i0]
+            i1 = i0 + 1
+            while i1 < nY and i1 - i0 < maxRows:
+                cMin = min(cMin, c[i1])
+                cMax = max(cMax, c[i1])
+                if cMax > (1. + bandTol) * cMin:
+                    break
+                i1 += 1
+            bands.append((i0, i1))
+            i0 = i1
+        return bands
+
+    def diskFT(self, l, R):
+        '''Fourier transform [sr] of a top-hat disk of radius R [rad],
+        ie pi R^2 * CMB.fwindowDisk(l, R).
+        '''
+        x = l * R
+        result = np.pi * R**2 * np.ones_like(l)
+        I = np.where(x > 0.)
+        result[I] = 2.*np.pi * R * special.j1(x[I]) / l[I]
+        return result
+
+    def padBand(self, x, i0, i1, padX):
+        '''Rows i0-padY to i1+padY of the map x, padded with zeros beyond the map edges,
+        and padded with padX columns on each side, periodic for full-sky maps.
+        '''
+        nY = self.shape[0]
+        j0 = max(i0 - self.padY, 0)
+        j1 = min(i1 + self.padY, nY)
+        x = np.pad(np.asarray(x[j0:j1], dtype=np.float64), ((self.padY - (i0 - j0), self.padY - (j1 - i1)), (0, 0)))
+        return np.pad(x, ((0, 0), (padX, padX)), mode='wrap' if self.fullRA else 'constant')
+
+    def filterBand(self, band):
+        '''All the AP filters for the objects in the declination band (i0, i1).
+        Returns the object indices I, and an array with shape
+        [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, len(I), nFilterTypes, nRAp].
+        '''
+        i0, i1 = band
+        I = np.where(self.overlap * (self.iY >= i0) * (self.iY < i1))[0]
+        result = np.zeros((4, len(I), self.nFilterTypes, self.nRAp))
+        if len(I) == 0:
+            return I, result
+        ts = self.ts
+        nY, nX = self.shape
+
+        # columns needed on each side, at the highest |dec| of the padded band
+        cosMin = np.min(np.cos(self.rowDec[max(i0 - self.padY, 0):min(i1 + self.padY, nY)]))
+        padX = min(int(np.ceil(np.max(self.jumpRadius) / (self.dx * max(cosMin, 1.e-3)))) + 2, nX)
+
+        # flat-sky Fourier grid, with the pixel scale at the center of the band
+        mapB = self.padBand(ts.cmbMap, i0, i1, padX)
+        shapeB = mapB.shape
+        dxB = self.dx * np.cos(self.rowDec[(i0 + i1 - 1) // 2])
+        ly = 2.*np.pi * np.fft.fftfreq(shapeB[0], d=self.dy)
+        lx = 2.*np.pi * np.fft.rfftfreq(shapeB[1], d=dxB)
+        l = np.sqrt(ly[:, np.newaxis]**2 + lx[np.newaxis, :]**2)
+
+        mapF = np.fft.rfft2(mapB)
+        # threshold the mask as for the cutouts, to keep 0 and 1 only
+        maskF = np.fft.rfft2(1. - 1.*(self.padBand(ts.cmbMask, i0, i1, padX) > 0.5))
+        if self.hasHit:
+            # pixels without hits are left out, to avoid spreading 1/0 over the band
+            hitB = self.padBand(ts.cmbHit, i0, i1, padX)
+            invHitF = np.fft.rfft2(np.where(hitB > 0., 1. / np.where(hitB > 0., hitB, 1.), 0.))
+
+        # fractional pixel coordinates of the objects in the padded band
+        coords = np.array([self.pixY[I] - (i0 - self.padY), self.pixX[I] + padX])
+
+        def sample(xF, kernel):
+            filtered = np.fft.irfft2(xF * kernel, s=shapeB)
+            return ndimage.map_coordinates(filtered, coords, order=1, mode='nearest')
+
+        for iRAp in range(self.nRAp):
+            # disk transforms shared by the filters with this radius
+            D = {}
+
+            def kernel(jumps):
+                result = np.zeros_like(l)
+                for j in np.where(jumps != 0.)[0]:
+                    if j not in D:
+                        D[j] = self.diskFT(l, self.jumpRadius[j])
+                    result += jumps[j] * D[j]
+                return result
+
+            # detect point sources within the filter [dimensionless]
+            result[1, :, :, iRAp] = sample(maskF, kernel(self.jumpPs[iRAp]))[:, np.newaxis]
+            for iFilterType in range(self.nFilterTypes):
+                k = iFilterType * self.nRAp + iRAp
+                # [map unit * sr]
+                result[0, :, iFilterType, iRAp] = sample(mapF, kernel(self.jumpW[k]))
+                # [sr / sqrt(hit unit)]
+                if self.hasHit:
+                    var = self.pixArea * sample(invHitF, kernel(self.jumpW2[k]))
+                    result[2, :, iFilterType, iRAp] = np.sqrt(np.maximum(var, 0.))
+        # [sr]
+        result[3] = self.diskArea[np.newaxis, np.newaxis, :]
+        return I, result
+
+    def apply(self, IObj=None, nProc=1):
+        """Evaluate all the AP filters on the objects IObj (default: all of them).
+        Returns an array with shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nObj, nFilterTypes, nRAp],
+        as ThumbStack.analyzeChunk, with zeros for the objects that do not overlap with the map.
+        """
+        ts = self.ts
+        if IObj is None:
+            IObj = np.arange(ts.Catalog.nObj)
+        IObj = np.asarray(IObj)
+        # pixel coordinates of all the objects, in a single call
+        pix = ts.cmbMap.sky2pix(np.array([ts.Catalog.DEC[IObj], ts.Catalog.RA[IObj]]) * utils.degree)
+        self.pixY = pix[0]
+        self.pixX = np.mod(pix[1], self.shape[1]) if self.fullRA else pix[1]
+        self.iY = np.floor(self.pixY + 0.5).astype(int)
+        self.overlap = ts.overlapFlag[IObj] > 0.
+
+        # only the bands that contain objects
+        bands = [b for b in self.bands if np.any(self.overlap * (self.iY >= b[0]) * (self.iY < b[1]))]
+        print("- convolve the map in "+str(len(bands))+" declination bands, with "+str(len(self.jumpW))+" AP kernels")
+        with sharedmem.MapReduce(np=nProc) as pool:
+            bandResults = pool.map(self.filterBand, bands)
+
+        result = np.zeros((4, len(IObj), self.nFilterTypes, self.nRAp))
+        for I, r in bandResults:
+            result[:, I] = r
+        return result
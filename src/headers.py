@@ -7,7 +7,8 @@ import os
 from importlib import reload
 # to copy files
 from shutil import copyfile
-from scipy import special, optimize, integrate, stats
+from scipy import special, optimize, integrate, stats, sparse, ndimage
+from scipy.spatial import cKDTree
 from scipy.interpolate import UnivariateSpline, RectBivariateSpline, interp1d, interp2d, BarycentricInterpolator
 from time import time
 import matplotlib.gridspec as gridspec
@@ -19,11 +20,14 @@ from timeit import timeit
 from time import time
 from copy import copy
 import sys
+# for metadata of the binary outputs
+import json
+import hashlib
 
 
 # For CMB maps
 #from enlib import enmap, utils, powspec
-from pixell import enmap, utils, powspec, enplot, reproject #, pointsrcs
+from pixell import enmap, utils, powspec, enplot, reproject, wcsutils #, pointsrcs
 import healpy as hp
 # copy rotfuncs.py somewhere on your python path,
 # so you can import it
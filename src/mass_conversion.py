@@ -31,11 +31,13 @@ class MassConversionKravtsov14(object):
       self.gamma = 0.544
       '''
 
-      # interpolate M_star = f(M_vir)
-      self.mVir = np.logspace(np.log10(1.e9), np.log10(1.e18), 501, 10.) # [M_sun]
-      self.mStar = np.array(list(map(self.fmStar, self.mVir)))  # [M_sun]
-      self.fmStarTomVir = interp1d(self.mStar, self.mVir, kind='cubic', bounds_error=True, fill_value=0.)
-      self.fmVirTomStar = interp1d(self.mVir, self.mStar, kind='cubic', bounds_error=True, fill_value=0.)
+      # tabulate M_star = f(M_vir), evaluated on the whole array at once
+      self.mVir = np.logspace(np.log10(1.e9), np.log10(1.e18), 2001, 10.) # [M_sun]
+      self.mStar = self.fmStar(self.mVir)  # [M_sun]
+      # M_star is monotonic in M_vir: interpolate linearly in log-log space,
+      # in both directions
+      self.log10mVir = np.log10(self.mVir)
+      self.log10mStar = np.log10(self.mStar)
 
 
    def f(self, x):
@@ -57,6 +59,28 @@ class MassConversionKravtsov14(object):
       result = 10.**result
       return result
 
+   def interpLog(self, x, xTable, yTable, name):
+      """Interpolate log10(y) linearly in log10(x), for an array or a scalar x.
+      Raises a ValueError if x is outside the table, as interp1d with bounds_error=True.
+      NaN values are returned as NaN.
+      """
+      log10x = np.log10(x)
+      if np.any((log10x < xTable[0]) | (log10x > xTable[-1])):
+         raise ValueError("A value in "+name+" is outside the interpolation range ["+str(10.**xTable[0])+", "+str(10.**xTable[-1])+"]")
+      return 10.**np.interp(log10x, xTable, yTable)
+
+   def fmStarTomVir(self, mStar):
+      """Computes halo mass Mvir [M_sun]
+      from stellar mass [M_sun].
+      """
+      return self.interpLog(mStar, self.log10mStar, self.log10mVir, "mStar")
+
+   def fmVirTomStar(self, mVir):
+      """Computes stellar mass [M_sun]
+      from halo mass Mvir [M_sun].
+      """
+      return self.interpLog(mVir, self.log10mVir, self.log10mStar, "mVir")
+
    ##################################################################################
 
    def plot(self):
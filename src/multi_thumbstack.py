@@ -0,0 +1,152 @@
+from headers import *
+
+import thumbstack
+reload(thumbstack)
+from thumbstack import *
+
+##################################################################################
+##################################################################################
+
+
+class MultiMapThumbStack(object):
+    """Stack one catalog on several maps sharing the same pixelization
+    (eg ILC variants with different deprojections), in a single extraction pass.
+    The cutout coordinates are computed once per object,
+    converted once to pixel coordinates, and all the maps
+    (and the distinct masks and hit counts) are interpolated at these pixels.
+    The filter outputs of each map are written in the usual layout,
+    in the output directory of a ThumbStack object for that map,
+    which then runs the rest of the analysis as usual.
+    """
+
+    def __init__(self, U, Catalog, cmbMaps, cmbMasks, cmbHits=None, names=None, save=False, nProc=1, doStackedMap=False, kwargsList=None, **kwargs):
+        '''cmbMaps: list of enmaps on a common geometry
+        cmbMasks, cmbHits: either one enmap for all the maps, or a list with one enmap (or None) per map
+        names: list of names for the ThumbStack objects, one per map
+        kwargsList: optional list of dicts of ThumbStack arguments specific to each map (eg cmbNu, filterTypes)
+        kwargs: ThumbStack arguments common to all the maps
+        '''
+        self.nMaps = len(cmbMaps)
+        if not isinstance(cmbMasks, (list, tuple)):
+            cmbMasks = [cmbMasks] * self.nMaps
+        if not isinstance(cmbHits, (list, tuple)):
+            cmbHits = [cmbHits] * self.nMaps
+        if names is None:
+            names = [Catalog.name+"_map"+str(iMap) for iMap in range(self.nMaps)]
+        if kwargsList is None:
+            kwargsList = [{} for iMap in range(self.nMaps)]
+
+        # all the maps, masks and hit counts need to share the same pixelization
+        for x in cmbMaps + cmbMasks + cmbHits:
+            if x is not None and (x.shape[-2:] != cmbMaps[0].shape[-2:] or x.wcs.to_header_string() != cmbMaps[0].wcs.to_header_string()):
+                raise ValueError("MultiMapThumbStack requires maps with a common geometry")
+
+        # the masks and hit counts are often the same for all the maps:
+        # only interpolate the distinct ones
+        self.cmbMasks, self.iMask = self.uniqueMaps(cmbMasks)
+        self.cmbHits, self.iHit = self.uniqueMaps(cmbHits)
+        self.nProc = nProc
+
+        # one ThumbStack object per map, without filtering yet
+        self.ts = []
+        for iMap in range(self.nMaps):
+            kw = dict(kwargs)
+            kw.update(kwargsList[iMap])
+            self.ts.append(ThumbStack(U, Catalog, cmbMaps[iMap], cmbMasks[iMap], cmbHits[iMap], name=names[iMap],
+                                      save=save, nProc=nProc, doAnalysis=False, **kw))
+        self.checkCompatible()
+
+        if save:
+            self.saveFiltering(nProc=self.nProc)
+        for ts in self.ts:
+            ts.analyze(save=save, doStackedMap=doStackedMap, doFiltering=False)
+
+    def checkCompatible(self):
+        '''The cutouts are extracted once, with the cutout geometry of the first map,
+        and filtered with the FilterBank of each map, without the optional filtering paths:
+        raise an error if the maps need different cutouts (eg different rApMaxArcmin),
+        or a filterMode, apOperator or stamp cache that this single pass would ignore.
+        The filter types and AP radii can differ between maps.
+        '''
+        cutout0 = self.ts[0].cutoutGeometry()
+        for ts in self.ts:
+            cutout = ts.cutoutGeometry()
+            if cutout.shape != cutout0.shape or cutout.wcs.to_header_string() != cutout0.wcs.to_header_string():
+                raise ValueError("MultiMapThumbStack requires the same cutout geometry for all the maps: "
+                                 +ts.name+" differs from "+self.ts[0].name+" (eg rApMaxArcmin)")
+            if ts.filterMode != 'stamp':
+                raise ValueError("MultiMapThumbStack only supports filterMode='stamp', not '"+ts.filterMode+"' for "+ts.name)
+            if ts.apOperator is not None:
+                raise ValueError("MultiMapThumbStack does not support apOperator, set for "+ts.name)
+            if ts.stampCache is not None:
+                raise ValueError("MultiMapThumbStack does not support pathStampCache, set for "+ts.name)
+
+    def uniqueMaps(self, maps):
+        '''Returns the list of distinct maps (None excluded),
+        and for each input map the index of the corresponding distinct map (-1 for None).
+        '''
+        unique = []
+        index = []
+        for x in maps:
+            if x is None:
+                index.append(-1)
+                continue
+            for iUnique in range(len(unique)):
+                if x is unique[iUnique] or np.array_equal(x, unique[iUnique]):
+                    index.append(iUnique)
+                    break
+            else:
+                index.append(len(unique))
+                unique.append(x)
+        return unique, index
+
+    ##################################################################################
+
+    def filterChunk(self, IObj):
+        '''Extract the cutouts of all the maps for the chunk of objects IObj,
+        in a single pass, apply all the filters,
+        and write the results into the filtering store of each map.
+        '''
+        IObj = np.asarray(IObj)
+        ts0 = self.ts[0]
+        # objects that overlap with at least one of the maps
+        overlap = np.array([ts.overlapFlag[IObj] > 0. for ts in self.ts])
+        J = np.where(np.any(overlap, axis=0))[0]
+
+        results = [np.zeros((4, len(IObj), len(ts.filterTypes), ts.nRAp)) for ts in self.ts]
+        if len(J) > 0:
+            # cutout coordinates, converted once to pixels on the common geometry
+            opos, ipos = ts0.stampPositions(IObj[J])
+            pix = ts0.cmbMap.sky2pix(ipos)
+
+            def interp(map):
+                return map.at(pix, unit="pix", prefilter=True, mask_nan=False, order=1)
+            # re-threshold the masks, to keep 0 and 1 only
+            masks = [1.*(interp(mask) > 0.5) for mask in self.cmbMasks]
+            hits = [interp(hit) for hit in self.cmbHits]
+
+            stamps = np.zeros((len(J), 3) + opos.shape[1:])
+            for iMap in range(self.nMaps):
+                ts = self.ts[iMap]
+                stamps[:, 0] = interp(ts.cmbMap)
+                stamps[:, 1] = masks[self.iMask[iMap]]
+                stamps[:, 2] = hits[self.iHit[iMap]] if self.iHit[iMap] >= 0 else 0.
+                # only keep the objects that overlap with this map
+                K = np.where(overlap[iMap, J])[0]
+                results[iMap][:, J[K]] = ts.filterBank.apply(stamps[K])
+
+        for iMap in range(self.nMaps):
+            store = np.load(self.ts[iMap].pathOut+"/filtering.npy", mmap_mode='r+')
+            store[:, :, IObj[0]:IObj[-1]+1, :] = np.swapaxes(results[iMap], 1, 2)
+            store.flush()
+            del store
+
+    def saveFiltering(self, nProc=1):
+        print("Evaluate all filters on all objects, for "+str(self.nMaps)+" maps in a single pass")
+        tStart = time()
+        for ts in self.ts:
+            ts.createFilteringStore()
+        with sharedmem.MapReduce(np=nProc) as pool:
+            pool.map(self.filterChunk, self.ts[0].objectChunks())
+        tStop = time()
+        print("took", (tStop-tStart)/60., "min")
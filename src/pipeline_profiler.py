@@ -0,0 +1,127 @@
+from headers import *
+
+import cProfile
+import resource
+from contextlib import contextmanager
+
+##################################################################################
+##################################################################################
+
+
+class PipelineProfiler(object):
+    """Timing and memory report for the stages of a ThumbStack run
+    (overlap, filtering, fits, stacked profiles, covariances, stacked maps, plots, I/O).
+    Each stage records its wall and CPU times, the throughput in objects per second
+    per process, and the resident memory of the main process and of the worker processes.
+    The report is saved as JSON, and the stage profileStage can also be run
+    under cProfile, with the statistics dumped next to the report.
+    """
+
+    def __init__(self, pathOut, enabled=True, profileStage=None):
+        '''pathOut: directory for "profile.json" and the cProfile dump
+        enabled: if False, the stages are not timed, at no cost
+        profileStage: name of the stage to run under cProfile (eg 'filtering'), or None
+        '''
+        self.pathOut = pathOut
+        self.enabled = enabled
+        self.profileStage = profileStage
+        self.stages = []
+        # names of the stages being run, for nested stages
+        self.stack = []
+        self.tStart = time()
+
+    def rss(self):
+        '''Current resident memory of this process [bytes], or None if not available.
+        '''
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * resource.getpagesize()
+        except (IOError, OSError):
+            return None
+
+    def peakRss(self, who=resource.RUSAGE_SELF):
+        '''Peak resident memory so far [bytes], of this process (RUSAGE_SELF),
+        or of the largest terminated worker process (RUSAGE_CHILDREN).
+        '''
+        peak = resource.getrusage(who).ru_maxrss
+        # kB on linux, bytes on mac
+        if sys.platform != 'darwin':
+            peak *= 1024
+        return int(peak)
+
+    @contextmanager
+    def stage(self, name, nObj=None, nProc=1):
+        '''Time the code run within the with block, as the stage name.
+        nObj: number of objects processed in the stage, for the throughput
+        nProc: number of processes used in the stage
+        '''
+        if not self.enabled:
+            yield
+            return
+        self.stack.append(name)
+        fullName = "/".join(self.stack)
+        rssStart = self.rss()
+        peakStart = self.peakRss()
+        tStart = time()
+        cpuStart = os.times()
+        profiler = None
+        if name == self.profileStage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.pathOut+"/profile_"+name+".prof")
+            tStop = time()
+            cpuStop = os.times()
+            wall = tStop - tStart
+            peakStop = self.peakRss()
+            result = {
+                'stage': fullName,
+                'start': tStart - self.tStart,
+                'wall': wall,
+                # including the terminated worker processes
+                'cpu': (cpuStop[0] - cpuStart[0]) + (cpuStop[1] - cpuStart[1])
+                       + (cpuStop[2] - cpuStart[2]) + (cpuStop[3] - cpuStart[3]),
+                'nProc': int(nProc),
+                'rssStart': rssStart,
+                'rssStop': self.rss(),
+                'peakRss': peakStop,
+                'peakRssIncrease': peakStop - peakStart,
+                'peakRssWorkers': self.peakRss(resource.RUSAGE_CHILDREN),
+            }
+            if nObj is not None:
+                result['nObj'] = int(nObj)
+                result['objPerSecPerProc'] = nObj / max(wall, 1.e-9) / max(nProc, 1)
+            self.stages.append(result)
+            self.stack.pop()
+
+    ##################################################################################
+
+    def report(self):
+        '''Dictionary with all the stages, in the order they were run,
+        and the total wall time per stage name.
+        '''
+        totals = {}
+        for s in self.stages:
+            totals[s['stage']] = totals.get(s['stage'], 0.) + s['wall']
+        return {
+            'wall': time() - self.tStart,
+            'peakRss': self.peakRss(),
+            'peakRssWorkers': self.peakRss(resource.RUSAGE_CHILDREN),
+            'totals': totals,
+            'stages': self.stages,
+        }
+
+    def save(self, meta={}):
+        '''Save the report to "profile.json", with the additional entries in meta.
+        '''
+        if not self.enabled:
+            return
+        report = dict(meta)
+        report.update(self.report())
+        with open(self.pathOut+"/profile.json", 'w') as f:
+            json.dump(report, f, indent=1)
+        print("- profiling report saved to "+self.pathOut+"/profile.json")
@@ -22,12 +22,14 @@ from __future__ import print_function, division
 import numpy as np
 from astropy.io import fits
 from scipy import spatial
+from concurrent.futures import ThreadPoolExecutor
 from pixell import utils, enmap
 
 #### Map-space source simulation ###
 
 def sim_srcs(shape, wcs, srcs, beam, omap=None, dtype=None, nsigma=5, rmax=None, smul=1,
-		return_padded=False, pixwin=False, op=np.add, wrap="auto", verbose=False, cache=None):
+		return_padded=False, pixwin=False, op=np.add, wrap="auto", verbose=False, cache=None,
+		nthread=1, flat_rmax=1*utils.degree):
 	"""Simulate a point source map in the geometry given by shape, wcs
 	for the given srcs[nsrc,{dec,ra,T...}], using the beam[{r,val},npoint],
 	which must be equispaced. If omap is specified, the sources will be
@@ -35,7 +37,10 @@ def sim_srcs(shape, wcs, srcs, beam, omap=None, dtype=None, nsigma=5, rmax=None,
 	the point where it reaches exp(-0.5*nsigma**2) unless rmax is specified, in which
 	case this gives the maximum radius. smul gives a factor to multiply the resulting
 	source model by. This is mostly useful in conction with omap.
-	The source simulation is sped up by using a source lookup grid.
+	The sources are evaluated on the pixels within rmax of each of them,
+	in batches spread over nthread threads (see eval_srcs_pairs).
+	Sources with rmax < flat_rmax use flat-sky distances. Passing dtype=np.float32
+	(or a float32 omap) computes the profiles in single precision.
 	"""
 	if omap is None: omap = enmap.zeros(shape, wcs, dtype)
 	ishape = omap.shape
@@ -62,15 +67,14 @@ def sim_srcs(shape, wcs, srcs, beam, omap=None, dtype=None, nsigma=5, rmax=None,
 	wmap, wslice  = enmap.pad(omap, padding, return_slice=True)
 	# Overall we will have this many grid cells
 	cshape = wmap.shape[-2:]/cres
-	# Find out which sources matter for which cells
+	# Pixel coordinates of all the sources, in one call
 	srcpix = wmap.sky2pix(poss.T).T
-	pixbox= np.array([[0,0],wmap.shape[-2:]],int)
-	nhit, cell_srcs = build_src_cells(pixbox, srcpix, cres, wrap=wrap)
 	# Optionally cache the posmap
 	if cache is None or cache[0] is None: posmap = wmap.posmap()
 	else: posmap = cache[0]
 	if cache is not None: cache[0] = posmap
-	model = eval_srcs_loop(posmap, poss, amps, beam, cres, nhit, cell_srcs, dtype=wmap.dtype, op=op, verbose=verbose)
+	model = eval_srcs_pairs(posmap, poss, amps, beam, rmax, srcpix, wrap=wrap, dtype=wmap.dtype, op=op,
+		nthread=nthread, flat_rmax=flat_rmax, verbose=verbose)
 	del posmap
 	if pixwin: model = enmap.apply_window(model)
 	# Update our work map, through our view
@@ -109,6 +113,115 @@ def eval_srcs_loop(posmap, poss, amps, beam, cres, nhit, cell_srcs, dtype=np.flo
 			op(model[:,y1:y2,x1:x2], cmodel, model[:,y1:y2,x1:x2])
 	return model
 
+def eval_srcs_pairs(posmap, poss, amps, beam, rmax, srcpix, wrap=None, dtype=np.float64, op=np.add, nmaxpair=2**22,
+		nthread=1, flat_rmax=1*utils.degree, verbose=False):
+	"""Same as eval_srcs_loop, but vectorized over the (source, pixel) pairs
+	instead of looping over map cells in python. Each source is evaluated on
+	the box of pixels within rmax of its pixel, whose width in x follows the
+	local pixel shape, so empty regions of the map cost nothing. The sources are
+	sorted by box size and evaluated in batches of at most nmaxpair pairs,
+	spread over nthread threads (numpy releases the GIL). Their contributions are
+	accumulated with np.bincount (op=np.add) or op.at (eg np.maximum) on the flat pixel
+	indices hit by each batch, so that overlapping sources are handled correctly.
+	For CAR maps with rmax < flat_rmax, the squared distances are computed from the
+	pixel offsets, in the flat-sky approximation around the mean declination of each
+	pair, whose relative error is of order rmax**2, instead of the exact angular distance. With dtype=np.float32, the distances and beam
+	values are computed in single precision."""
+	ny, nx = posmap.shape[-2:]
+	ncomp  = amps.shape[-1]
+	model  = enmap.zeros(amps.shape[-1:]+posmap.shape[-2:], posmap.wcs, dtype)
+	flatmodel = model.reshape(ncomp,-1)
+	if len(poss) == 0: return model
+	if wrap is None: wrap = [0,0]
+	# The flat-sky kernel works in pixel offsets, for CAR maps, where the pixel
+	# declination only depends on the row, and the pixel sizes in dec and ra are constant
+	flat   = rmax < flat_rmax and posmap.wcs.wcs.ctype[0].endswith("CAR")
+	pixsize = np.abs(posmap.wcs.wcs.cdelt[::-1])*utils.degree
+	# Working precision. The posmap is not converted as a whole, which would copy it:
+	# only the positions gathered for each batch are
+	wtype  = np.float32 if np.dtype(dtype) == np.float32 else np.float64
+	poss   = np.asarray(poss, dtype=wtype)
+	beam   = np.asarray(beam, dtype=wtype)
+	rowdec = np.asarray(posmap[0,:,0], dtype=wtype)
+	# Local pixel shape [rad] at each source, from the neighboring pixel centers
+	jy = np.clip(utils.nint(srcpix[:,0]), 0, ny-2)
+	jx = np.clip(utils.nint(srcpix[:,1]), 0, nx-2)
+	dy = utils.angdist(posmap[::-1,jy,jx], posmap[::-1,jy+1,jx])
+	dx = utils.angdist(posmap[::-1,jy,jx], posmap[::-1,jy,jx+1])
+	# Half-widths of the boxes [pixels]
+	hy = np.minimum(np.ceil(rmax/np.maximum(dy,1e-12)).astype(int)+1, ny)
+	hx = np.minimum(np.ceil(rmax/np.maximum(dx,1e-12)).astype(int)+1, nx)
+	# Wrapping offsets [pixels], as in build_src_cells_helper
+	woffs = [[0] if w == 0 else [-w,0,w] for w in wrap]
+	# Batches of sources with similar box sizes
+	order   = np.lexsort((hy, hx))
+	batches = []
+	i = 0
+	while i < len(order):
+		npix = (2*hy[order[i]]+1)*(2*hx[order[i]]+1)
+		n    = max(1, nmaxpair//npix)
+		batches.append(order[i:i+n])
+		i   += n
+	def eval_batch(srcs):
+		# Returns the pixels hit by the batch, and either the summed contributions
+		# [ncomp,npix] (op=np.add) or the pixel of each pair and its values [ncomp,npair]
+		by, bx = np.max(hy[srcs]), np.max(hx[srcs])
+		oy, ox = np.meshgrid(np.arange(-by,by+1), np.arange(-bx,bx+1), indexing="ij")
+		pys, pxs, isrcs, dys, dxs = [], [], [], [], []
+		for woffy in woffs[0]:
+			for woffx in woffs[1]:
+				sy, sx = srcpix[srcs,0]+woffy, srcpix[srcs,1]+woffx
+				# Skip the offsets that do not hit the map at all
+				if np.min(sy)-by >= ny or np.max(sy)+by < 0 or np.min(sx)-bx >= nx or np.max(sx)+bx < 0: continue
+				# Pixel indices of all the pairs [nsrc,npix]
+				py = utils.nint(sy)[:,None] + oy.reshape(-1)[None,:]
+				px = utils.nint(sx)[:,None] + ox.reshape(-1)[None,:]
+				isrc, ipix = np.where((py >= 0) & (py < ny) & (px >= 0) & (px < nx))
+				py, px = py[isrc,ipix], px[isrc,ipix]
+				pys.append(py); pxs.append(px); isrcs.append(srcs[isrc])
+				# Offsets from the source [pixels]
+				dys.append(py-sy[isrc]); dxs.append(px-sx[isrc])
+		if len(pys) == 0: return np.zeros(0,int), np.zeros((ncomp,0),wtype)
+		py, px, isrc = np.concatenate(pys), np.concatenate(pxs), np.concatenate(isrcs)
+		if flat:
+			# Squared flat-sky distance, with the RA difference at the mean declination
+			ddec = np.concatenate(dys).astype(wtype)*pixsize[0]
+			dra  = np.concatenate(dxs).astype(wtype)*pixsize[1]
+			r2   = ddec**2 + (dra*np.cos(0.5*(rowdec[py]+poss[isrc,0])))**2
+			# Skip the pairs beyond the beam before the interpolation
+			keep = np.where(r2 <= beam[0,-1]**2)[0]
+			py, px, isrc = py[keep], px[keep], isrc[keep]
+			r    = np.sqrt(r2[keep])
+		else:
+			r    = utils.angdist(np.asarray(posmap[::-1,py,px], dtype=wtype), poss[isrc].T[::-1])
+		# Evaluate the beam at these locations, zero beyond its last point
+		bval = np.interp(r, beam[0], beam[1], right=0.).astype(wtype)
+		vals = amps[isrc].T.astype(wtype)*bval
+		# Pixels hit by this batch, and the pairs that fall in each of them
+		upix, inv = np.unique(py*nx + px, return_inverse=True)
+		if op is np.add:
+			return upix, np.array([np.bincount(inv, weights=v, minlength=len(upix)) for v in vals])
+		else:
+			return upix[inv], vals
+	def add_batch(result):
+		upix, vals = result
+		if op is np.add:
+			flatmodel[:,upix] += vals
+		else:
+			for c in range(ncomp): op.at(flatmodel[c], upix, vals[c])
+	if nthread <= 1:
+		for ib, srcs in enumerate(batches):
+			if verbose: print("batch %5d/%d with %7d sources" % (ib+1, len(batches), len(srcs)))
+			add_batch(eval_batch(srcs))
+	else:
+		# Accumulate in the main thread, a few batches per thread at a time to limit the memory
+		with ThreadPoolExecutor(max_workers=nthread) as pool:
+			for ib in range(0, len(batches), 2*nthread):
+				if verbose: print("batches %5d/%d" % (ib+1, len(batches)))
+				for result in pool.map(eval_batch, batches[ib:ib+2*nthread]):
+					add_batch(result)
+	return model
+
 def expand_beam(beam, nsigma=5, rmax=None, nper=400):
 	beam = np.asarray(beam)
 	if beam.ndim == 0:
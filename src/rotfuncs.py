@@ -84,3 +84,20 @@ def decenter(angs, center):
 	if len(center) == 4: ra0, dec0, ra1, dec1 = center
 	elif len(center) == 2: ra0, dec0, ra1, dec1 = center[0], center[1], 0, np.pi/2
 	return euler_rot([ra0,dec1-dec0,-ra1],  angs, kind="zyz")
+
+def recenter_multi(angs, centers):
+	"""Vectorized version of recenter, for many centers at once.
+	angs is [{ra,dec},...] and centers is [{from_ra,from_dec,to_ra,to_dec},ncenter]
+	or [{from_ra,from_dec},ncenter]. Returns [{ra,dec},ncenter,...], such that
+	recenter_multi(angs, centers)[:,i] == recenter(angs, centers[:,i])."""
+	centers = np.asarray(centers)
+	if len(centers) == 4: ra0, dec0, ra1, dec1 = centers
+	elif len(centers) == 2: ra0, dec0, ra1, dec1 = centers[0], centers[1], np.zeros_like(centers[0]), np.full_like(centers[1], np.pi/2)
+	# One rotation matrix per center: [ncenter,3,3]
+	M      = euler_mat([ra1,dec0-dec1,-ra0], kind="zyz")
+	angs   = np.asarray(angs)
+	co     = angs.reshape(2,-1)
+	rect   = ang2rect(co, False)
+	rect   = np.einsum("nij,jp->inp",M,rect)
+	co     = rect2ang(rect, False)
+	return co.reshape((2,len(M))+angs.shape[1:])
@@ -0,0 +1,247 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+class StackedMapSums(object):
+    """Running sums of the cutouts, accumulated during the filtering pass,
+    from which the stacked maps are obtained without extracting the cutouts again
+    (see ThumbStack.saveAllStackedMaps).
+
+    The estimator weights at the aperture iRAp0 are w = p v g, with:
+    p = m for ksz_massvarweight, 1 otherwise;
+    v = u - mean(u), with u = -v_r/c, for kSZ, v = 1 for tSZ;
+    g = 1, 1/s2Hit or 1/s2Full for the uniform, hit and var weightings.
+    mean(u) and the outlier rejection are only known after the filtering,
+    so the sums are kept as polynomials in u, for each weighting family.
+    The sums are exact for the weightings whose g is known during the filtering:
+    the uniform and hit weightings, and the var weightings without hit count map,
+    for which s2Full is the same for all the objects and cancels in the normalization.
+    With a hit count map, s2Full is a function of s2Hit fitted on all the filter outputs,
+    and 1/s2Full cannot be reweighted exactly from sums: the stacked maps of the var
+    weightings then take one more pass over the cutouts (see ThumbStack.stackCutouts).
+
+    The outliers are rejected after the filtering, from the spread of all the filter outputs.
+    The cutouts of the candidate outliers, with |filtMap| above nSigmaCandidate
+    times the robust spread of their chunk for any filter type or aperture,
+    are recorded during the filtering, so that the outliers can be subtracted afterwards.
+    """
+
+    # weighting families whose weights are known during the filtering
+    onlineFamilies = ['uniformweight', 'hitweight']
+
+    def __init__(self, ts, Est, iRAp0, nSigmaCandidate=4., nMinCandidate=20):
+        '''ts: ThumbStack object, providing the catalog, cuts and filter types
+        Est: list of estimators whose stacked maps are needed
+        iRAp0: index of the aperture used for the weights
+        nSigmaCandidate: threshold for the candidate outliers, in units of the spread of their chunk
+        nMinCandidate: all the objects of the chunks with fewer objects are recorded as candidates
+        '''
+        self.filterTypes = ts.filterTypes
+        self.iRAp0 = iRAp0
+        self.nSigmaCandidate = nSigmaCandidate
+        self.nMinCandidate = nMinCandidate
+        self.hasHit = ts.cmbHit is not None
+        # inputs of the filtering, to check that saved sums match them
+        self.catalogHash = ts.catalogHash()
+        self.mapChecksums = ts.mapChecksums()
+        self.Est = [est for est in Est if self.hasEstimator(est)]
+        self.families = sorted(set([est.split('_', 1)[1] for est in self.Est]))
+        # objects selected before the outlier rejection, as in computeStackedProfile
+        self.selection = (ts.Catalog.Mvir >= ts.mMin) * (ts.Catalog.Mvir <= ts.mMax) \
+            * (ts.Catalog.Z >= 0.) * (ts.Catalog.Z <= 100.)
+        # u = -v_r/c [dimless] and halo masses
+        self.u = -ts.Catalog.vR / 3.e5
+        self.m = ts.Catalog.Mvir
+        # sums for each key (iFilterType, family):
+        # [{p g T, p g u T}, ny, nx], [{p^2 g^2 T^2, p^2 g^2 u T^2, p^2 g^2 u^2 T^2}, ny, nx]
+        # and [{g, p^2 g, p^2 g u, p^2 g u^2, nObj}]
+        self.lin = {}
+        self.sq = {}
+        self.scal = {}
+        # candidate outliers: list of (indices, cutouts [nCandidate, ny, nx],
+        # filter outputs [4, nCandidate, nFilterTypes, nRAp]), one per chunk
+        self.candidates = []
+
+    def hasEstimator(self, est):
+        '''True if the stacked map of the estimator est can be obtained from the running sums.
+        '''
+        family = est.split('_', 1)[1]
+        return family in self.onlineFamilies or (not self.hasHit and family in ['varweight', 'massvarweight'])
+
+    def objectFactors(self, family, I, s2Hit):
+        '''Factors p and g of the weights, for the weighting family and the objects I.
+        '''
+        p = self.m[I] if family == 'massvarweight' else np.ones(len(I))
+        # without hit count map, 1/s2Full is the same for all the objects
+        g = 1. / s2Hit if family == 'hitweight' else np.ones(len(I))
+        return p, g
+
+    def add(self, I, stamps, result, sign=1., iFilterTypes=None):
+        '''Add the cutouts stamps [nChunk,{map,mask,hit},ny,nx] of the objects I,
+        with filter outputs result [4, nChunk, nFilterTypes, nRAp], as returned by FilterBank.apply.
+        Only the objects passing the mass, redshift and point source cuts are added,
+        and the candidate outliers among them are recorded.
+        sign=-1 subtracts them instead.
+        iFilterTypes: indices of the filter types to update (default: all)
+        '''
+        I = np.asarray(I)
+        # same point source cut for all filter types
+        K = np.where(self.selection[I] * (np.abs(result[1, :, 0, -1]) < 1.))[0]
+        if len(K) == 0:
+            return
+        if sign > 0.:
+            self.recordCandidates(I[K], stamps[K, 0], result[:, K])
+        self.addMaps(I[K], stamps[K, 0], result[:, K], sign=sign, iFilterTypes=iFilterTypes)
+
+    def addMaps(self, I, T, result, sign=1., iFilterTypes=None):
+        '''Add the cutouts T [nObj,ny,nx] of the map, for the selected objects I,
+        with filter outputs result [4, nObj, nFilterTypes, nRAp].
+        '''
+        if iFilterTypes is None:
+            iFilterTypes = range(len(self.filterTypes))
+        u = self.u[I]
+        for iFilterType in iFilterTypes:
+            s2Hit = result[2, :, iFilterType, self.iRAp0]**2
+            for family in self.families:
+                p, g = self.objectFactors(family, I, s2Hit)
+                key = (iFilterType, family)
+                if key not in self.lin:
+                    self.lin[key] = np.zeros((2,) + T.shape[1:])
+                    self.sq[key] = np.zeros((3,) + T.shape[1:])
+                    self.scal[key] = np.zeros(5)
+                pg = p * g
+                p2g2 = (p * g)**2
+                p2g = p**2 * g
+                self.lin[key] += sign * np.tensordot(np.array([pg, pg * u]), T, axes=1)
+                self.sq[key] += sign * np.tensordot(np.array([p2g2, p2g2 * u, p2g2 * u**2]), T**2, axes=1)
+                self.scal[key] += sign * np.array([np.sum(g), np.sum(p2g), np.sum(p2g * u), np.sum(p2g * u**2), len(I)])
+
+    def recordCandidates(self, I, T, result):
+        '''Record the cutouts T [nObj,ny,nx] and filter outputs of the candidate outliers
+        among the selected objects I of a chunk.
+        The outliers have |filtMap| above a threshold of at least 5 times
+        the spread of all the filter outputs (see ThumbStack.catalogMask).
+        '''
+        t = result[0]
+        if len(I) < self.nMinCandidate:
+            J = np.arange(len(I))
+        else:
+            # robust spread of the chunk, for each filter type and aperture
+            sigma = 1.4826 * np.median(np.abs(t - np.median(t, axis=0)), axis=0)
+            J = np.where(np.any(np.abs(t) > self.nSigmaCandidate * sigma, axis=(1, 2)))[0]
+        if len(J) > 0:
+            self.candidates.append((I[J], T[J].copy(), result[:, J].copy()))
+
+    def removeOutliers(self, iFilterType, I):
+        '''Subtract the outliers I of the filter type, rejected after the filtering,
+        using their recorded cutouts.
+        Returns the outliers that were not recorded as candidates.
+        '''
+        I = np.asarray(I)
+        if len(self.candidates) == 0:
+            return I
+        IC = np.concatenate([c[0] for c in self.candidates])
+        isRecorded = np.isin(I, IC)
+        if np.any(isRecorded):
+            order = np.argsort(IC)
+            J = order[np.searchsorted(IC[order], I[isRecorded])]
+            T = np.concatenate([c[1] for c in self.candidates])[J]
+            result = np.concatenate([c[2] for c in self.candidates], axis=1)[:, J]
+            self.addMaps(I[isRecorded], T, result, sign=-1., iFilterTypes=[iFilterType])
+        return I[~isRecorded]
+
+    def merge(self, other):
+        '''Add the sums of another StackedMapSums object, eg from another worker.
+        '''
+        for key in other.lin:
+            if key not in self.lin:
+                self.lin[key] = np.zeros_like(other.lin[key])
+                self.sq[key] = np.zeros_like(other.sq[key])
+                self.scal[key] = np.zeros_like(other.scal[key])
+            self.lin[key] += other.lin[key]
+            self.sq[key] += other.sq[key]
+            self.scal[key] += other.scal[key]
+        self.candidates += other.candidates
+
+    ##################################################################################
+
+    def save(self, path):
+        keys = sorted(self.lin.keys())
+        meta = {
+            'filterTypes': [str(f) for f in self.filterTypes],
+            'Est': self.Est,
+            'iRAp0': int(self.iRAp0),
+            'families': self.families,
+            'catalogHash': self.catalogHash,
+            'mapChecksums': self.mapChecksums,
+            'keys': [[int(k[0]), k[1]] for k in keys],
+            'nCandidate': int(np.sum([len(c[0]) for c in self.candidates])),
+        }
+        np.save(path+"_lin.npy", np.array([self.lin[k] for k in keys]))
+        np.save(path+"_sq.npy", np.array([self.sq[k] for k in keys]))
+        np.save(path+"_scal.npy", np.array([self.scal[k] for k in keys]))
+        if len(self.candidates) > 0:
+            np.save(path+"_candidate_indices.npy", np.concatenate([c[0] for c in self.candidates]))
+            np.save(path+"_candidate_maps.npy", np.concatenate([c[1] for c in self.candidates]))
+            np.save(path+"_candidate_results.npy", np.concatenate([c[2] for c in self.candidates], axis=1))
+        # the metadata last, so that an interrupted save is not used
+        with open(path+".json", 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def load(self, path):
+        '''Load the sums saved with save(path).
+        Returns False if they were saved for other filter types, estimators or aperture,
+        or for another catalog or other maps.
+        '''
+        if not os.path.exists(path+".json"):
+            return False
+        with open(path+".json") as f:
+            meta = json.load(f)
+        if meta['filterTypes'] != [str(f) for f in self.filterTypes] or not set(self.Est) <= set(meta['Est']) \
+                or meta['iRAp0'] != self.iRAp0 or meta.get('nCandidate') is None:
+            return False
+        if meta.get('catalogHash') != self.catalogHash or meta.get('mapChecksums') != self.mapChecksums:
+            print("- the stacked map sums in "+path+" were saved for another catalog or other maps")
+            return False
+        lin = np.load(path+"_lin.npy")
+        sq = np.load(path+"_sq.npy")
+        scal = np.load(path+"_scal.npy")
+        for iKey in range(len(meta['keys'])):
+            key = tuple(meta['keys'][iKey])
+            self.lin[key] = lin[iKey]
+            self.sq[key] = sq[iKey]
+            self.scal[key] = scal[iKey]
+        self.candidates = []
+        if meta['nCandidate'] > 0:
+            self.candidates.append((np.load(path+"_candidate_indices.npy"),
+                                    np.load(path+"_candidate_maps.npy"),
+                                    np.load(path+"_candidate_results.npy")))
+        return True
+
+    ##################################################################################
+
+    def stackedMap(self, filterType, est, mask, rV=1.):
+        '''Stacked map and its per-pixel uncertainty for the estimator est,
+        after the outliers have been subtracted.
+        mask: objects kept in the stack, as in computeStackedProfile
+        '''
+        key = (list(self.filterTypes).index(filterType), est.split('_', 1)[1])
+        lin = self.lin[key]
+        sq = self.sq[key]
+        scal = self.scal[key]
+        if est.startswith('tsz'):
+            # norm = 1 / sum(w)
+            stack = lin[0] / scal[0]
+            sStack = np.sqrt(np.maximum(sq[0], 0.)) / scal[0]
+        else:
+            # v = u - mean(u)
+            u = self.u[mask]
+            vBar = np.mean(u)
+            norm = np.std(u) / rV / (scal[3] - 2.*vBar*scal[2] + vBar**2*scal[1])
+            if est == 'ksz_massvarweight':
+                norm *= np.mean(self.m[mask])
+            stack = norm * (lin[1] - vBar * lin[0])
+            sStack = np.abs(norm) * np.sqrt(np.maximum(sq[2] - 2.*vBar*sq[1] + vBar**2*sq[0], 0.))
+        return stack, sStack
@@ -0,0 +1,109 @@
+from headers import *
+
+##################################################################################
+##################################################################################
+
+
+def mapChecksum(map, nChunk=2**22):
+    '''Checksum of an enmap, from its shape, its dtype, its wcs and all its pixels,
+    so that any change to the map changes the checksum.
+    The pixels are hashed in chunks of nChunk values, so that memory-mapped maps
+    are read in turn without being copied as a whole.
+    Returns None if map is None.
+    '''
+    if map is None:
+        return None
+    h = hashlib.sha1()
+    h.update(str(map.shape).encode())
+    h.update(str(map.dtype).encode())
+    h.update(map.wcs.to_header_string().encode())
+    x = np.asarray(map).reshape(-1)
+    for iStart in range(0, len(x), nChunk):
+        h.update(np.ascontiguousarray(x[iStart:iStart+nChunk]).tobytes())
+    return h.hexdigest()
+
+
+class StampCache(object):
+    """On-disk cache of the cutouts of all the objects, for the map, mask and hit count:
+    a memory-mapped float32 array "stamps.npy" with shape [nObj, {map,mask,hit}, ny, nx].
+    It is written during the first saveFiltering, then all the later cutout extractions
+    (other AP radii or filter types, stacked maps) are read from it instead of the big maps.
+    The cache is keyed by the catalog hash, the map, mask and hit checksums
+    and the cutout resolution and projection. A cache saved for a larger
+    rApMaxArcmin also serves smaller cutouts, cropped around the center.
+    """
+
+    def __init__(self, ts, pathCache):
+        '''ts: ThumbStack object, providing the catalog, the maps and the cutout geometry
+        pathCache: directory where the caches are saved
+        '''
+        key = hashlib.sha1()
+        checksums = ts.mapChecksums()
+        for x in [ts.catalogHash(), checksums['map'], checksums['mask'], checksums['hit'],
+                  str(ts.resCutoutArcmin), ts.projCutout]:
+            key.update(str(x).encode())
+        self.pathOut = pathCache + "/" + ts.Catalog.name + "_" + key.hexdigest()[:16]
+        if not os.path.exists(self.pathOut):
+            os.makedirs(self.pathOut)
+        self.nObj = ts.Catalog.nObj
+        self.cutoutMap = ts.cutoutGeometry()
+        # True while the cutouts are being saved
+        self.writing = False
+
+        # cutouts saved by a previous run
+        self.complete = False
+        if os.path.exists(self.pathOut + "/meta.json"):
+            with open(self.pathOut + "/meta.json") as f:
+                self.meta = json.load(f)
+            self.complete = self.meta['complete'] and self.covers(self.meta['cutoutShape'])
+
+    def covers(self, cutoutShape):
+        '''True if cutouts with shape cutoutShape contain the current cutouts.
+        The cutout geometries share the same pixel centers, so the smaller cutout
+        is the central part of the larger one.
+        '''
+        ny, nx = self.cutoutMap.shape
+        return cutoutShape[0] >= ny and cutoutShape[1] >= nx and (cutoutShape[0] - ny) % 2 == 0 and (cutoutShape[1] - nx) % 2 == 0
+
+    def create(self):
+        '''Preallocate the cache for the current cutout geometry, before the cutouts are written.
+        '''
+        print("- save the cutouts to the stamp cache "+self.pathOut)
+        store = np.lib.format.open_memmap(self.pathOut + "/stamps.npy", mode='w+',
+                                          dtype=np.float32, shape=(self.nObj, 3) + self.cutoutMap.shape)
+        del store
+        self.meta = {
+            'nObj': int(self.nObj),
+            'cutoutShape': [int(n) for n in self.cutoutMap.shape],
+            'complete': False,
+        }
+        with open(self.pathOut + "/meta.json", 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        self.writing = True
+
+    def finalize(self):
+        '''Flag the cache as complete, once all the cutouts are written.
+        '''
+        self.meta['complete'] = True
+        with open(self.pathOut + "/meta.json", 'w') as f:
+            json.dump(self.meta, f, indent=1)
+        self.writing = False
+        self.complete = True
+
+    def write(self, IObj, stamps):
+        '''Save the cutouts stamps [nChunk,{map,mask,hit},ny,nx] of the objects IObj.
+        '''
+        store = np.load(self.pathOut + "/stamps.npy", mmap_mode='r+')
+        store[np.asarray(IObj)] = stamps
+        store.flush()
+        del store
+
+    def read(self, IObj):
+        '''Cutouts of the objects IObj, as returned by ThumbStack.extractStamps.
+        '''
+        store = np.load(self.pathOut + "/stamps.npy", mmap_mode='r')
+        ny, nx = self.cutoutMap.shape
+        iy = (store.shape[-2] - ny) // 2
+        ix = (store.shape[-1] - nx) // 2
+        stamps = np.array(store[np.asarray(IObj), :, iy:iy+ny, ix:ix+nx], dtype=np.float64)
+        return self.cutoutMap.posmap(), stamps
@@ -1,5 +1,36 @@
 from headers import *
 
+import filter_bank
+reload(filter_bank)
+from filter_bank import *
+
+import ap_operator
+reload(ap_operator)
+from ap_operator import *
+
+import bootstrap
+reload(bootstrap)
+from bootstrap import *
+
+import harmonic_filter
+reload(harmonic_filter)
+from harmonic_filter import *
+
+import stamp_cache
+reload(stamp_cache)
+from stamp_cache import *
+
+import stacked_map
+reload(stacked_map)
+from stacked_map import *
+
+import pipeline_profiler
+reload(pipeline_profiler)
+from pipeline_profiler import *
+
+# only the map cache helpers: the class cmbMap would shadow the drivers' own
+from cmbMap import sharedMap
+
 ##################################################################################
 ##################################################################################
 
@@ -7,7 +38,7 @@ from headers import *
 class ThumbStack(object):
 
     #   def __init__(self, U, Catalog, pathMap="", pathMask="", pathHit="", name="test", nameLong=None, save=False, nProc=1):
-    def __init__(self, U, Catalog, cmbMap, cmbMask, cmbHit=None, name="test", nameLong=None, save=False, nProc=1, filterTypes='diskring', doStackedMap=False, doMBins=False, doVShuffle=False, doBootstrap=False, cmbNu=150.e9, cmbUnitLatex=r'$\mu$K', pathOut='/pscratch/sd/r/rhliu/projects/ThumbStack/', rApMinArcmin=2., rApMaxArcmin=6., rApInnerRad=1., nRAp = 9):
+    def __init__(self, U, Catalog, cmbMap, cmbMask, cmbHit=None, name="test", nameLong=None, save=False, nProc=1, filterTypes='diskring', doStackedMap=False, doMBins=False, doVShuffle=False, doBootstrap=False, cmbNu=150.e9, cmbUnitLatex=r'$\mu$K', pathOut='/pscratch/sd/r/rhliu/projects/ThumbStack/', rApMinArcmin=2., rApMaxArcmin=6., rApInnerRad=1., nRAp = 9, apOperator=None, pathMapCache=None, filterMode='stamp', doAnalysis=True, parent=None, pathStampCache=None, profile=False, profileStage=None):
 
         self.nProc = nProc
         self.U = U
@@ -25,6 +56,18 @@ class ThumbStack(object):
         self.doBootstrap = doBootstrap
         self.cmbNu = cmbNu
         self.cmbUnitLatex = cmbUnitLatex
+        # optional precomputed sparse operator map -> AP filters (see ApOperator),
+        # to filter a new map on the same pixelization without extracting cutouts
+        self.apOperator = apOperator
+        # 'stamp': apply the AP filters to the cutout pixels,
+        # 'annulus': sum the cutouts over thin annuli, saved to disk,
+        # then derive all the AP filters from these annulus sums,
+        # 'harmonic': convolve the whole map with each AP filter, then read it at the objects,
+        # 'native': apply the AP filters directly to the map pixels around each object
+        self.filterMode = filterMode
+        # optional ThumbStack object on the same map, whose catalog contains this catalog:
+        # the overlap flags and filter outputs are sliced from it instead of recomputed
+        self.parent = parent
 
         self.rApInnerRad = rApInnerRad
         self.rApMinArcmin = rApMinArcmin
@@ -70,6 +113,9 @@ class ThumbStack(object):
         self.resCutoutArcmin = 0.25   # [arcmin]
         # projection of the cutout maps
         self.projCutout = 'cea'
+        # max number of objects whose cutouts are extracted together,
+        # in a single vectorized call
+        self.nObjPerChunk = 500
 
         # number of samples for bootstraps, shuffles
         self.nSamples = 10000
@@ -98,29 +144,76 @@ class ThumbStack(object):
 
         print("- Thumbstack: "+str(self.name))
 
-        self.loadAPRadii()
-        self.loadMMaxBins()
-
-        if save:
-            self.saveOverlapFlag(nProc=self.nProc)
-        self.loadOverlapFlag()
+        # optional timing and memory report for each stage, saved to profile.json,
+        # with a cProfile dump for the stage profileStage (eg 'filtering')
+        self.profiler = PipelineProfiler(self.pathOut, enabled=profile, profileStage=profileStage)
 
-        if save:
-            self.saveFiltering(nProc=self.nProc)
-        self.loadFiltering()
+        # replace the maps by read-only memory maps of an uncompressed cache,
+        # so that all the worker processes share one physical copy
+        if pathMapCache is not None:
+            if not os.path.exists(pathMapCache):
+                os.makedirs(pathMapCache)
+            self.cmbMap = sharedMap(self.cmbMap, pathMapCache+"/"+self.name+"_map")
+            self.cmbMask = sharedMap(self.cmbMask, pathMapCache+"/"+self.name+"_mask")
+            self.cmbHit = sharedMap(self.cmbHit, pathMapCache+"/"+self.name+"_hit")
 
-        self.measureAllVarFromHitCount(plot=save)
+        self.loadAPRadii()
+        self.loadMMaxBins()
+        # AP filter weights, for all filter types and radii
+        self.filterBank = FilterBank(self)
+        if self.apOperator is not None:
+            self.apOperator.checkCompatible(self)
+        # optional on-disk cache of the cutouts, written by the first saveFiltering,
+        # so that other AP radii, filter types or stacked maps do not re-extract them
+        self.stampCache = None
+        if pathStampCache is not None:
+            self.stampCache = StampCache(self, pathStampCache)
+
+        with self.profiler.stage('overlap', nObj=self.Catalog.nObj):
+            if save:
+                if self.parent is not None:
+                    self.saveOverlapFlagFromParent()
+                else:
+                    self.saveOverlapFlag()
+            self.loadOverlapFlag()
+
+        # the filtering and the rest of the analysis can be deferred,
+        # eg to filter several maps in a single pass (see MultiMapThumbStack)
+        if doAnalysis:
+            self.analyze(save=save, doStackedMap=doStackedMap)
+
+    def analyze(self, save=False, doStackedMap=False, doFiltering=True):
+        '''Filtering, stacked profiles, covariances and plots.
+        doFiltering: if False, the filter outputs are assumed to be saved already,
+        and are only loaded.
+        '''
+        if save and doFiltering:
+            with self.profiler.stage('filtering', nObj=self.Catalog.nObj, nProc=self.nProc):
+                if self.parent is not None:
+                    self.saveFilteringFromParent()
+                else:
+                    # accumulate the stacked maps during the same pass
+                    self.saveFiltering(nProc=self.nProc, stackedMaps=doStackedMap)
+        with self.profiler.stage('io'):
+            self.loadFiltering()
+
+        with self.profiler.stage('varFromHit', nObj=self.Catalog.nObj):
+            self.measureAllVarFromHitCount(plot=save)
 
 #      self.measureAllMeanTZBins(plot=save, test=False)
 
         if save:
-            self.saveAllStackedProfiles()
-        self.loadAllStackedProfiles()
+            with self.profiler.stage('stackedProfiles', nObj=self.Catalog.nObj):
+                self.saveAllStackedProfiles()
+        with self.profiler.stage('io'):
+            self.loadAllStackedProfiles()
 
         if save:
-            self.plotAllStackedProfiles()
-            self.plotAllCov()
-            self.computeAllSnr()
+            with self.profiler.stage('plotting'):
+                self.plotAllStackedProfiles()
+                self.plotAllCov()
+            with self.profiler.stage('snr'):
+                self.computeAllSnr()
 
         # if save:
         if True:
@@ -131,7 +224,18 @@ class ThumbStack(object):
                 # the best tsz and ksz estimators,
                 # and for the diskring weighting
                 # self.saveAllStackedMaps(filterTypes=['diskring'], Est=['tsz_varweight', 'ksz_varweight'])
-                self.saveAllStackedMaps(filterTypes=None, Est=None)
+                with self.profiler.stage('stackedMaps', nObj=self.Catalog.nObj, nProc=self.nProc):
+                    self.saveAllStackedMaps(filterTypes=None, Est=None)
+
+        self.profiler.save(meta={
+            'name': self.name,
+            'nObj': int(self.Catalog.nObj),
+            'nProc': int(self.nProc),
+            'filterMode': self.filterMode,
+            'filterTypes': [str(f) for f in self.filterTypes],
+            'nRAp': int(self.nRAp),
+            'mapShape': [int(n) for n in self.cmbMap.shape[-2:]],
+        })
 
     ##################################################################################
     ##################################################################################
@@ -216,39 +320,177 @@ class ThumbStack(object):
         # use nearest neighbor interpolation
         return map.at(sourcecoord, prefilter=False, mask_nan=False, order=0)
 
-    # def saveOverlapFlag(self, thresh=1.e-5, nProc=1):
+    def sky2pixIndex(self, ra, dec, map):
+        '''Nearest pixel indices (iY, iX) on map for the coordinates (ra, dec),
+        for arrays of ra, dec in degrees, in a single sky2pix call.
+        Also returns a boolean array, False for the coordinates outside the map.
+        '''
+        pix = map.sky2pix(np.array([dec, ra]) * utils.degree)
+        # round to the nearest pixel, as in map.at(order=0)
+        iY = np.floor(pix[0] + 0.5).astype(int)
+        iX = np.floor(pix[1] + 0.5).astype(int)
+        inMap = (iY >= 0) & (iY < map.shape[-2]) & (iX >= 0) & (iX < map.shape[-1])
+        return np.where(inMap, iY, 0), np.where(inMap, iX, 0), inMap
+
+    def firstComponent(self, map):
+        '''First component [ny, nx] of a map, eg a mask read with a leading component axis.
+        '''
+        map = np.asarray(map)
+        return map.reshape((-1,) + map.shape[-2:])[0]
+
+    def loadMaskDistance(self, thresh=0.95):
+        '''Distance [rad] from each pixel to the nearest masked pixel
+        (mask <= thresh), computed once with a Euclidean distance transform.
+        The pixel width in ra is taken at the declination where it is smallest,
+        so the distance is never overestimated in CAR.
+        '''
+        if getattr(self, 'cmbMaskDist', None) is not None and self.cmbMaskDistThresh == thresh:
+            return
+        print("- compute the distance transform of the mask")
+        tStart = time()
+        dec, ra = self.cmbMask.pixshape()
+        dec = np.abs(dec)
+        # the box extends to the pixel edges
+        decMax = np.max(np.abs(self.cmbMask.box()[:, 0]))
+        ra = np.abs(ra) * np.cos(min(decMax, np.pi/2.))
+        unmasked = self.firstComponent(self.cmbMask) > thresh
+        # pixels beyond the map edges count as masked: pad with zeros before the transform.
+        # Full-sky maps are periodic in ra: wrap them instead, over the largest aperture
+        # (beyond which the distance is not used)
+        nY, nX = unmasked.shape
+        padY = 1
+        padX = 1
+        dRA = np.abs(self.cmbMask.wcs.wcs.cdelt[0])
+        if np.abs(nX * dRA - 360.) < 0.5 * dRA:
+            r1 = np.max(self.RApArcmin) / 60. * np.pi/180. * np.sqrt(2.)
+            padX = min(int(np.ceil(r1 / ra)) + 1, nX)
+            unmasked = np.pad(unmasked, ((0, 0), (padX, padX)), mode='wrap')
+        else:
+            unmasked = np.pad(unmasked, ((0, 0), (padX, padX)), mode='constant')
+        unmasked = np.pad(unmasked, ((padY, padY), (0, 0)), mode='constant')
+        self.cmbMaskDist = ndimage.distance_transform_edt(
+            unmasked, sampling=(dec, ra))[padY:padY+nY, padX:padX+nX]
+        self.cmbMaskDistThresh = thresh
+        tStop = time()
+        print("took", (tStop-tStart)/60., "min")
 
-    def saveOverlapFlag(self, thresh=0.95, nProc=1):
+    def overlapFraction(self, thresh=0.95):
+        '''Fraction of the largest AP filter (radius sqrt(2) * max(RApArcmin))
+        that is unmasked, for each object.
+        The masked region is approximated as a half-plane at the distance
+        of the nearest masked pixel, which removes a circular segment of the aperture.
+        0 for objects on masked pixels or outside the map.
+        '''
+        self.loadMaskDistance(thresh=thresh)
+        # radius of the largest aperture [rad]
+        r1 = np.max(self.RApArcmin) / 60. * np.pi/180. * np.sqrt(2.)
+        iY, iX, inMap = self.sky2pixIndex(self.Catalog.RA, self.Catalog.DEC, self.cmbMask)
+        d = np.clip(self.cmbMaskDist[iY, iX], 0., r1)
+        # area of the circular segment outside the distance d, in units of the aperture area
+        fSegment = (np.arccos(d/r1) - d/r1 * np.sqrt(1. - (d/r1)**2)) / np.pi
+        frac = 1. - fSegment
+        frac[d == 0.] = 0.
+        frac[~inMap] = 0.
+        return frac
+
+    def saveOverlapFlag(self, thresh=0.95, fracMin=None):
         '''1 for objects that overlap with the hit map,
         0 for objects that don't.
+        By default, an object overlaps if the mask at its nearest pixel is above thresh.
+        If fracMin is not None, an object overlaps if at least a fraction fracMin
+        of its largest AP filter is unmasked (see overlapFraction).
         '''
-        # print("Create overlap flag")
-        # find if a given object overlaps with the CMB hit map
-
-        def foverlap(iObj):
-            '''Returns 1. if the object overlaps with the hit map and 0. otherwise.
-            '''
-            # if iObj % 100000 == 0:
-                # print("-", iObj)
-            ra = self.Catalog.RA[iObj]
-            dec = self.Catalog.DEC[iObj]
-            # hit = self.sky2map(ra, dec, self.cmbHit)
-            hit = self.sky2map(ra, dec, self.cmbMask)
-            return np.float(hit > thresh)
-
-#      overlapFlag = np.array(map(foverlap, range(self.Catalog.nObj)))
         tStart = time()
-        with sharedmem.MapReduce(np=nProc) as pool:
-            overlapFlag = np.array(
-                pool.map(foverlap, list(range(self.Catalog.nObj))))
+        if fracMin is None:
+            # gather the mask values at all the object positions at once
+            iY, iX, inMap = self.sky2pixIndex(self.Catalog.RA, self.Catalog.DEC, self.cmbMask)
+            mask = self.firstComponent(self.cmbMask)[iY, iX] * inMap
+            overlapFlag = 1. * (mask > thresh)
+        else:
+            overlapFlag = 1. * (self.overlapFraction(thresh=thresh) >= fracMin)
         tStop = time()
         # print("took", (tStop-tStart)/60., "min")
         # print("Out of", self.Catalog.nObj, "objects,", np.sum(overlapFlag),
               # "overlap, ie a fraction", np.sum(overlapFlag)/self.Catalog.nObj)
-        np.savetxt(self.pathOut+"/overlap_flag.txt", overlapFlag)
+        np.save(self.pathOut+"/overlap_flag.npy", overlapFlag)
+
+    def parentIndices(self):
+        '''Indices of the objects of this catalog in the catalog of self.parent.
+        Uses Catalog.parentIndices if the catalog was extracted from the parent catalog,
+        otherwise matches the objects on their exact (RA, DEC, Z).
+        Raises an error if an object is not in the parent catalog.
+        '''
+        parentCatalog = self.parent.Catalog
+        if getattr(self.Catalog, 'parentName', None) == parentCatalog.name:
+            return self.Catalog.parentIndices
+
+        def keys(cat):
+            # one opaque key per object, from the bytes of (RA, DEC, Z)
+            x = np.ascontiguousarray(np.column_stack((cat.RA, cat.DEC, cat.Z)), dtype=np.float64)
+            return x.view(np.dtype((np.void, x.dtype.itemsize * 3))).ravel()
+        parentKeys = keys(parentCatalog)
+        childKeys = keys(self.Catalog)
+        iSort = np.argsort(parentKeys)
+        J = np.clip(np.searchsorted(parentKeys[iSort], childKeys), 0, len(iSort)-1)
+        I = iSort[J]
+        if not np.all(parentKeys[I] == childKeys):
+            raise ValueError("catalog "+self.Catalog.name+" is not a subset of the parent catalog "+parentCatalog.name)
+        return I
+
+    def checkParentMaps(self, keys=['map', 'mask', 'hit'], meta=None):
+        '''Raise an error if the parent ThumbStack was run on different maps (among keys),
+        or with a different map unit or frequency.
+        meta: metadata saved with the parent outputs (filtering.json), if any,
+        otherwise the maps of the parent object are used.
+        '''
+        if meta is not None and 'mapChecksums' in meta:
+            parentChecksums = meta['mapChecksums']
+            parentUnit = meta['cmbUnitLatex']
+            parentNu = meta['cmbNu']
+        else:
+            parentChecksums = self.parent.mapChecksums()
+            parentUnit = self.parent.cmbUnitLatex
+            parentNu = self.parent.cmbNu
+        for key in keys:
+            if parentChecksums[key] != self.mapChecksums()[key]:
+                raise ValueError("the parent ThumbStack "+self.parent.name+" was run on a different "+key)
+        if parentUnit != self.cmbUnitLatex or not np.isclose(parentNu, self.cmbNu):
+            raise ValueError("the parent ThumbStack "+self.parent.name+" uses a different map unit or frequency")
+
+    def saveOverlapFlagFromParent(self):
+        print("- slice the overlap flags from "+self.parent.name)
+        # the overlap flags only depend on the mask
+        self.checkParentMaps(keys=['mask'])
+        np.save(self.pathOut+"/overlap_flag.npy", np.asarray(self.parent.overlapFlag)[self.parentIndices()])
+
+    def saveFilteringFromParent(self):
+        '''Slice the filter outputs of the parent ThumbStack,
+        which must include the same AP radii and all the filter types of this one.
+        '''
+        print("- slice the filter outputs from "+self.parent.name)
+        with open(self.parent.pathOut+"/filtering.json") as f:
+            self.checkParentMaps(meta=json.load(f))
+        if self.parent.nRAp != self.nRAp or not np.allclose(self.parent.RApArcmin, self.RApArcmin):
+            raise ValueError("the parent ThumbStack "+self.parent.name+" uses different AP radii")
+        parentFilterTypes = list(self.parent.filterTypes)
+        for filterType in self.filterTypes:
+            if filterType not in parentFilterTypes:
+                raise ValueError("the parent ThumbStack "+self.parent.name+" does not have the filter type "+filterType)
+        I = self.parentIndices()
+        store = self.createFilteringStore()
+        for iFilterType in range(len(self.filterTypes)):
+            iParent = parentFilterTypes.index(self.filterTypes[iFilterType])
+            store[:, iFilterType] = self.parent.filtering[:, iParent][:, I]
+        store.flush()
+        del store
 
     def loadOverlapFlag(self):
-        self.overlapFlag = np.genfromtxt(self.pathOut+"/overlap_flag.txt")
+        path = self.pathOut+"/overlap_flag.npy"
+        if not os.path.exists(path) and os.path.exists(self.pathOut+"/overlap_flag.txt"):
+            # one-time conversion of the text output from older runs
+            print("- convert overlap_flag.txt to "+path)
+            np.save(path, np.genfromtxt(self.pathOut+"/overlap_flag.txt"))
+        self.overlapFlag = np.load(path, mmap_mode='r')
 
     ##################################################################################
 
@@ -360,47 +602,90 @@ class ThumbStack(object):
 
         return opos, stampMap, stampMask, stampHit
 
-    ##################################################################################
-
-    def aperturePhotometryFilter(self, opos, stampMap, stampMask, stampHit, r0, r1, filterType='diskring',  test=False):
-        """Apply an AP filter (disk minus ring) to a stamp map:
-        AP = int d^2theta * Filter * map.
-        Unit is [map unit * sr]
-        The filter function is dimensionless:
-        Filter = 1 in the disk, - (disk area)/(ring area) in the ring, 0 outside.
-        Hence:
-        int d^2theta * Filter = 0.
-        r0 and r1 are the radius of the disk and ring in radians.
-        stampMask should have values 0 and 1 only.
-        Output:
-        filtMap: [map unit * sr]
-        filtMask: [mask unit * sr]
-        filtHitNoiseStdDev: [1/sqrt(hit unit) * sr], ie [std dev * sr] if [hit map] = inverse var
-        diskArea: [sr]
+    def stampPositions(self, IObj):
+        """Sky coordinates of the cutout pixels, for the objects with indices IObj.
+        Returns:
+        opos: [{dec,ra},ny,nx] cutout positions, relative to the cutout center
+        ipos: [{dec,ra},nChunk,ny,nx] corresponding true coordinates on the big map
         """
-        # coordinates of the square map in radians
-        # zero is at the center of the map
+        IObj = np.asarray(IObj)
+        stampMap = self.cutoutGeometry()
+
+        # coordinates of the square map (between -1 and 1 deg)
         # output map position [{dec,ra},ny,nx]
-        dec = opos[0, :, :]
-        ra = opos[1, :, :]
-        radius = np.sqrt(ra**2 + dec**2)
-        # exact angular area of a pixel [sr] (same for all pixels in CEA, not CAR)
-        pixArea = ra.area() / len(ra.flatten())
+        opos = stampMap.posmap()
 
-        # detect point sources within the filter:
-        # gives 0 in the absence of point sources/edges; gives >=1 in the presence of point sources/edges
-        filtMask = np.sum((radius <= r1) * (1-stampMask))   # [dimensionless]
+        # coordinates of the centers of the square maps we want to extract
+        # [{from_ra,from_dec,to_ra,to_dec},nChunk]
+        # convert from degrees to radians
+        zeros = np.zeros(len(IObj))
+        sourcecoord = np.array([zeros, zeros, self.Catalog.RA[IObj],
+                               self.Catalog.DEC[IObj]]) * utils.degree
+
+        # corresponding true coordinates on the big map [{dec,ra},nChunk,ny,nx]
+        ipos = rotfuncs.recenter_multi(opos[::-1], sourcecoord)[::-1]
+        return opos, ipos
+
+    def extractStamps(self, IObj):
+        """Batched version of extractStamp, for the objects with indices IObj.
+        All the cutout positions are obtained from a single vectorized recentering,
+        and each map (map, mask, hit count) is interpolated in a single call.
+        Returns:
+        opos: [{dec,ra},ny,nx] cutout positions, as in extractStamp
+        stamps: [nChunk,{map,mask,hit},ny,nx] contiguous cube of cutouts
+        """
+        IObj = np.asarray(IObj)
+        if self.stampCache is not None and self.stampCache.complete:
+            return self.stampCache.read(IObj)
+        opos, ipos = self.stampPositions(IObj)
+
+        # extract the small square maps by bilinear interpolation of the big maps
+        stamps = np.zeros((len(IObj), 3) + opos.shape[1:])
+        stamps[:, 0] = self.cmbMap.at(
+            ipos, prefilter=True, mask_nan=False, order=1)
+        stamps[:, 1] = self.cmbMask.at(
+            ipos, prefilter=True, mask_nan=False, order=1)
+        if self.cmbHit is not None:
+            stamps[:, 2] = self.cmbHit.at(
+                ipos, prefilter=True, mask_nan=False, order=1)
 
+        # re-threshold the mask map, to keep 0 and 1 only
+        stamps[:, 1] = 1.*(stamps[:, 1] > 0.5)
+
+        if self.stampCache is not None and self.stampCache.writing:
+            self.stampCache.write(IObj, stamps)
+        return opos, stamps
+
+    def objectChunks(self, IObj=None):
+        '''Split the object indices IObj (default: whole catalog)
+        into contiguous chunks, with at most nObjPerChunk objects each,
+        and at least one chunk per process.
+        '''
+        if IObj is None:
+            IObj = np.arange(self.Catalog.nObj)
+        nChunk = max(self.nProc, int(np.ceil(len(IObj) / self.nObjPerChunk)))
+        nChunk = max(1, min(nChunk, len(IObj)))
+        return np.array_split(IObj, nChunk)
+
+    ##################################################################################
+
+    def apertureFilterWeight(self, radius, pixArea, r0, r1, filterType='diskring'):
+        """AP filter weights [dimensionless], for pixels at the given radius [rad]
+        from the center of the cutout. pixArea is the pixel area [sr].
+        r0 and r1 are the radius of the disk and ring in radians.
+        pixArea can also be an array of pixel areas, with the shape of radius,
+        for pixels of unequal areas (eg CAR).
+        The normalizations of the rings are computed from the pixel areas,
+        so that eg the disk-ring filter integrates exactly to zero on the pixel grid.
+        """
         # disk filter [dimensionless]
         inDisk = 1.*(radius <= r0)
-        # exact angular area of disk [sr]
-        diskArea = np.sum(inDisk) * pixArea
         # ring filter [dimensionless]
         inRing = 1.*(radius > r0)*(radius <= r1)
 
         if filterType == 'diskring':
             # normalize the ring so that the disk-ring filter integrates exactly to zero
-            inRing *= np.sum(inDisk) / np.sum(inRing)
+            inRing *= np.sum(pixArea * inDisk) / np.sum(pixArea * inRing)
             # disk minus ring filter [dimensionless]
             filterW = inDisk - inRing
             if np.isnan(np.sum(filterW)):
@@ -414,8 +699,8 @@ class ThumbStack(object):
             # rings are re-scaled to the same area as the disk.
             rr = self.rApInnerRad / 60. * np.pi/180.
             innerRing = 1.*(radius > rr)*(radius <= r0)
-            innerRing *= np.sum(inDisk)/np.sum(innerRing)
-            inRing *= np.sum(inDisk) / np.sum(inRing)
+            innerRing *= np.sum(pixArea * inDisk) / np.sum(pixArea * innerRing)
+            inRing *= np.sum(pixArea * inDisk) / np.sum(pixArea * inRing)
             filterW = innerRing - inRing
         elif filterType == 'ringring2':
             # A ringring filter is a diskring filter that also masks out the central pixels (within radius rr). This is done
@@ -432,7 +717,7 @@ class ThumbStack(object):
             
             r1 = np.sqrt(2*r0**2 - rr**2)
             inRing = 1.*(radius > r0)*(radius <= r1)
-            inRing *= np.sum(innerRing) / np.sum(inRing)
+            inRing *= np.sum(pixArea * innerRing) / np.sum(pixArea * inRing)
             
             filterW = innerRing - inRing
         elif filterType =='ringring3':
@@ -443,7 +728,7 @@ class ThumbStack(object):
             
             r1 = np.sqrt(2*r0**2 - rr**2)
             inRing = 1.*(radius > r0)*(radius <= r1)
-            inRing *= np.sum(innerRing) / np.sum(inRing)
+            inRing *= np.sum(pixArea * innerRing) / np.sum(pixArea * inRing)
             
             filterW = innerRing - inRing            
         elif filterType == 'disk':
@@ -455,6 +740,45 @@ class ThumbStack(object):
         elif filterType == 'meanring':
             filterW = inRing / np.sum(pixArea * inRing)
 
+        return filterW
+
+    def aperturePhotometryFilter(self, opos, stampMap, stampMask, stampHit, r0, r1, filterType='diskring',  test=False):
+        """Apply an AP filter (disk minus ring) to a stamp map:
+        AP = int d^2theta * Filter * map.
+        Unit is [map unit * sr]
+        The filter function is dimensionless:
+        Filter = 1 in the disk, - (disk area)/(ring area) in the ring, 0 outside.
+        Hence:
+        int d^2theta * Filter = 0.
+        r0 and r1 are the radius of the disk and ring in radians.
+        stampMask should have values 0 and 1 only.
+        Output:
+        filtMap: [map unit * sr]
+        filtMask: [mask unit * sr]
+        filtHitNoiseStdDev: [1/sqrt(hit unit) * sr], ie [std dev * sr] if [hit map] = inverse var
+        diskArea: [sr]
+        """
+        # coordinates of the square map in radians
+        # zero is at the center of the map
+        # output map position [{dec,ra},ny,nx]
+        dec = opos[0, :, :]
+        ra = opos[1, :, :]
+        radius = np.sqrt(ra**2 + dec**2)
+        # exact angular area of a pixel [sr] (same for all pixels in CEA, not CAR)
+        pixArea = ra.area() / len(ra.flatten())
+
+        # detect point sources within the filter:
+        # gives 0 in the absence of point sources/edges; gives >=1 in the presence of point sources/edges
+        filtMask = np.sum((radius <= r1) * (1-stampMask))   # [dimensionless]
+
+        # disk filter [dimensionless]
+        inDisk = 1.*(radius <= r0)
+        # exact angular area of disk [sr]
+        diskArea = np.sum(inDisk) * pixArea
+        # filter weight in each pixel [dimensionless]
+        filterW = self.apertureFilterWeight(
+            radius, pixArea, r0, r1, filterType=filterType)
+
         # apply the filter: int_disk d^2theta map -  disk_area / ring_area * int_ring d^2theta map
         filtMap = np.sum(pixArea * filterW * stampMap)   # [map unit * sr]
         # quantify noise std dev in the filter
@@ -579,38 +903,350 @@ class ThumbStack(object):
 
         return filtMap, filtMask, filtHitNoiseStdDev, filtArea
 
-    def saveFiltering(self, nProc=1):
+    def analyzeChunk(self, IObj, stackedMapSums=None):
+        '''Same as analyzeObject, for a chunk of objects with indices IObj:
+        the cutouts of all the overlapping objects in the chunk are extracted at once.
+        Returns an array with shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nChunk, nFilterTypes, nRAp]
+        stackedMapSums: optional StackedMapSums object, to which the cutouts are added
+        '''
+        IObj = np.asarray(IObj)
+        result = np.zeros((4, len(IObj), len(self.filterTypes), self.nRAp))
+
+        # only do the analysis for the objects that overlap with the CMB map
+        J = np.where(self.overlapFlag[IObj] > 0.)[0]
+        if len(J) == 0:
+            return result
+        # extract postage stamps around all of them
+        opos, stamps = self.extractStamps(IObj[J])
+        # apply all the filter types and radii at once
+        result[:, J] = self.filterBank.apply(stamps)
+        if stackedMapSums is not None:
+            stackedMapSums.add(IObj[J], stamps, result[:, J])
+        return result
+
+    def loadNativeGeometry(self):
+        '''Exact area [sr] of the map pixels in each row, for the native-pixel filters.
+        The AP filters in a CAR map are computed on the pixels within r1 of each object,
+        so they only need the rows within nativeWindowY of the object row.
+        '''
+        self.nativePixArea = np.asarray(enmap.pixsizemap(self.cmbMap.shape[-2:], self.cmbMap.wcs, broadcastable=True))[:, 0]
+        # largest outer ring radius of all the AP filters [rad]
+        self.nativeR1 = np.sqrt(2.) * np.max(self.RApArcmin) / 60. * np.pi/180.
+        self.nativeDY = np.abs(self.cmbMap.wcs.wcs.cdelt[1]) * utils.degree
+        self.nativeDX = np.abs(self.cmbMap.wcs.wcs.cdelt[0]) * utils.degree
+        self.nativeWindowY = int(np.ceil(self.nativeR1 / self.nativeDY)) + 1
+        # full-sky maps are periodic in RA
+        self.nativeFullRA = np.abs(self.cmbMap.shape[-1] * self.nativeDX - 2.*np.pi) < 0.5 * self.nativeDX
+
+    def analyzeChunkNative(self, IObj):
+        '''Same as analyzeChunk, but the AP filters are applied directly
+        to the original CAR pixels around each object, without reprojecting
+        the map onto a CEA cutout: the pixel radii are the exact angular distances
+        to the object, and the filters are weighted by the exact pixel areas.
+        filtHitNoiseStdDev assumes independent noise in each map pixel,
+        so it is larger than with the cutouts, whose interpolated pixels are correlated.
+        Pixels outside the map count as masked.
+        '''
+        IObj = np.asarray(IObj)
+        result = np.zeros((4, len(IObj), len(self.filterTypes), self.nRAp))
+        J = np.where(self.overlapFlag[IObj] > 0.)[0]
+        if len(J) == 0:
+            return result
+        nY, nX = self.cmbMap.shape[-2:]
+        ra = self.Catalog.RA[IObj[J]] * utils.degree
+        dec = self.Catalog.DEC[IObj[J]] * utils.degree
+        iY, iX, inMap = self.sky2pixIndex(self.Catalog.RA[IObj[J]], self.Catalog.DEC[IObj[J]], self.cmbMap)
+
+        for j in range(len(J)):
+            # window of pixels containing the disk of radius r1
+            nWX = min(int(np.ceil(self.nativeR1 / (self.nativeDX * max(np.cos(dec[j]), 1.e-3)))) + 1, nX // 2)
+            rows = iY[j] + np.arange(-self.nativeWindowY, self.nativeWindowY + 1)
+            cols = iX[j] + np.arange(-nWX, nWX + 1)
+            if self.nativeFullRA:
+                cols = np.mod(cols, nX)
+            inRows = (rows >= 0) & (rows < nY)
+            inCols = (cols >= 0) & (cols < nX)
+            valid = inRows[:, np.newaxis] & inCols[np.newaxis, :]
+            I = np.ix_(np.clip(rows, 0, nY-1), np.clip(cols, 0, nX-1))
+
+            # exact angular distance of each pixel center to the object [rad]
+            decRows = enmap.pix2sky(self.cmbMap.shape[-2:], self.cmbMap.wcs, np.array([rows, np.full(len(rows), iX[j])]))[0]
+            raCols = enmap.pix2sky(self.cmbMap.shape[-2:], self.cmbMap.wcs, np.array([np.full(len(cols), iY[j]), cols]))[1]
+            pos = np.array(np.broadcast_arrays(raCols[np.newaxis, :], decRows[:, np.newaxis]))
+            radius = utils.angdist(pos, np.array([ra[j], dec[j]])[:, np.newaxis, np.newaxis])
+
+            # only keep the pixels within the largest filter
+            K = np.where(radius <= self.nativeR1)
+            radius = radius[K]
+            pixArea = self.nativePixArea[np.clip(rows, 0, nY-1)][K[0]] * valid[K]
+            stampMap = np.where(valid, self.firstComponent(self.cmbMap)[I], 0.)[K]
+            stampMask = np.where(valid, 1.*(self.firstComponent(self.cmbMask)[I] > 0.5), 0.)[K]
+
+            # filter weights, including the exact pixel areas [sr]
+            # shape [nFilterTypes, nRAp, nPix]
+            filterW = np.zeros((len(self.filterTypes), self.nRAp, len(radius)))
+            for iRAp in range(self.nRAp):
+                r0 = self.RApArcmin[iRAp] / 60. * np.pi/180.
+                r1 = r0 * np.sqrt(2.)
+                for iFilterType in range(len(self.filterTypes)):
+                    filterW[iFilterType, iRAp] = pixArea * self.apertureFilterWeight(radius, pixArea, r0, r1, filterType=self.filterTypes[iFilterType])
+                # [dimensionless]
+                result[1, J[j], :, iRAp] = np.sum((radius <= r1) * (1. - stampMask))
+                # [sr]
+                result[3, J[j], :, iRAp] = np.sum((radius <= r0) * pixArea)
+            # [map unit * sr]
+            result[0, J[j]] = np.dot(filterW, stampMap)
+            # [sr / sqrt(hit unit)]
+            if self.cmbHit is not None:
+                stampHit = np.where(valid, self.firstComponent(self.cmbHit)[I], 0.)[K]
+                result[2, J[j]] = np.sqrt(np.dot(filterW**2, 1. / (1.e-16 + stampHit)))
+        return result
+
+    def annulusChunk(self, IObj, stackedMapSums=None):
+        '''Annulus sums of the map, 1-mask and 1/hit for a chunk of objects with indices IObj,
+        with shape [nChunk, {map, 1-mask, 1/hit}, nAnnulus] (see FilterBank.annulusSums).
+        Zero for the objects that do not overlap with the CMB map.
+        '''
+        IObj = np.asarray(IObj)
+        sums = np.zeros((len(IObj), 3, self.filterBank.nAnnulus))
+        J = np.where(self.overlapFlag[IObj] > 0.)[0]
+        if len(J) == 0:
+            return sums
+        opos, stamps = self.extractStamps(IObj[J])
+        sums[J] = self.filterBank.annulusSums(stamps)
+        if stackedMapSums is not None:
+            stackedMapSums.add(IObj[J], stamps, self.filterBank.applyAnnulusSums(sums[J]))
+        return sums
+
+    def saveFiltering(self, nProc=1, stackedMaps=False):
+        '''stackedMaps: if True, also accumulate the cutouts for the stacked maps of the estimators
+        (see StackedMapSums), when the cutouts are extracted
+        '''
 
         print("Evaluate all filters on all objects")
-        # loop over all objects in catalog
-#      result = np.array(map(self.analyzeObject, range(self.Catalog.nObj)))
         tStart = time()
-        with sharedmem.MapReduce(np=nProc) as pool:
-            def f(iObj): return self.analyzeObject(iObj, test=False)
-            result = np.array(pool.map(f, list(range(self.Catalog.nObj))))
+        if self.apOperator is not None:
+            # the AP filters are linear in the map:
+            # apply the precomputed sparse operator
+            # shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nObj, nFilterTypes, nRAp]
+            self.writeFilteringStore(self.apOperator.apply(self.cmbMap))
+        elif self.filterMode == 'harmonic':
+            # cost independent of the number of objects
+            self.writeFilteringStore(HarmonicFilter(self).apply(nProc=nProc))
+        else:
+            # preallocate the output file, then each process
+            # writes the results for its chunks of objects directly into it
+            self.createFilteringStore()
+            if self.filterMode == 'annulus':
+                self.createAnnulusStore()
+            elif self.filterMode == 'native':
+                self.loadNativeGeometry()
+            # save the cutouts while they are extracted
+            newStampCache = self.stampCache is not None and not self.stampCache.complete and self.filterMode in ['stamp', 'annulus']
+            if newStampCache:
+                self.stampCache.create()
+            if stackedMaps and self.filterMode in ['stamp', 'annulus'] and len(StackedMapSums(self, self.Est, int(self.nRAp / 4)).Est) > 0:
+                # each process keeps running sums of its cutouts,
+                # over an interleaved share of the chunks
+                chunks = self.objectChunks()
+                with sharedmem.MapReduce(np=nProc) as pool:
+                    sums = pool.map(self.filterChunks, [chunks[i::nProc] for i in range(min(nProc, len(chunks)))])
+                for s in sums[1:]:
+                    sums[0].merge(s)
+                sums[0].save(self.pathOut+"/stackedmap_sums")
+            else:
+                with sharedmem.MapReduce(np=nProc) as pool:
+                    pool.map(self.filterChunk, self.objectChunks())
+            if newStampCache:
+                self.stampCache.finalize()
         tStop = time()
         print("took", (tStop-tStart)/60., "min")
 
-        # unpack and save to file
+    def filterChunks(self, chunks):
+        '''Run filterChunk on a list of chunks, and return the running sums
+        of the cutouts for the stacked maps (StackedMapSums).
+        '''
+        stackedMapSums = StackedMapSums(self, self.Est, int(self.nRAp / 4))
+        for IObj in chunks:
+            self.filterChunk(IObj, stackedMapSums=stackedMapSums)
+        return stackedMapSums
+
+    def filterChunk(self, IObj, stackedMapSums=None):
+        '''Evaluate all the filters on the contiguous chunk of objects IObj,
+        and write the results into the filtering store.
+        '''
+        store = np.load(self.pathOut+"/filtering.npy", mmap_mode='r+')
+        if self.filterMode == 'annulus':
+            # keep the annulus sums, to derive other AP filters later
+            sums = self.annulusChunk(IObj, stackedMapSums=stackedMapSums)
+            annulusStore = np.load(self.pathOut+"/annulus_sums.npy", mmap_mode='r+')
+            annulusStore[IObj[0]:IObj[-1]+1] = sums
+            annulusStore.flush()
+            del annulusStore
+            result = self.filterBank.applyAnnulusSums(sums)
+            # objects that do not overlap keep zero outputs
+            result *= (self.overlapFlag[IObj] > 0.)[np.newaxis, :, np.newaxis, np.newaxis]
+        elif self.filterMode == 'native':
+            result = self.analyzeChunkNative(IObj)
+        else:
+            result = self.analyzeChunk(IObj, stackedMapSums=stackedMapSums)
+        store[:, :, IObj[0]:IObj[-1]+1, :] = np.swapaxes(result, 1, 2)
+        store.flush()
+        del store
+
+    def validateHarmonicFiltering(self, nTest=1000, seed=0):
+        '''Compare the harmonic-space filters (HarmonicFilter) to the cutout-based ones,
+        on nTest random objects overlapping with the map.
+        Prints and returns the residuals, for each filter type and radius:
+        rms(harmonic - cutout) / rms(cutout) for filtMap,
+        median |harmonic / cutout - 1| for filtHitNoiseStdDev,
+        and the fraction of objects whose point source mask differs.
+        '''
+        print("- validate the harmonic-space AP filters against the cutouts")
+        IObj = np.where(self.overlapFlag[:] > 0.)[0]
+        if len(IObj) > nTest:
+            IObj = np.sort(np.random.default_rng(seed).choice(IObj, size=nTest, replace=False))
+        stamp = np.concatenate([self.analyzeChunk(I) for I in self.objectChunks(IObj)], axis=1)
+        harmonic = HarmonicFilter(self).apply(IObj=IObj, nProc=self.nProc)
+
+        resMap = np.sqrt(np.mean((harmonic[0] - stamp[0])**2, axis=0) / np.mean(stamp[0]**2, axis=0))
+        resNoise = np.zeros_like(resMap)
+        if self.cmbHit is not None:
+            resNoise = np.median(np.abs(harmonic[2] / stamp[2] - 1.), axis=0)
+        # objects kept by the point source mask (see catalogMask)
+        resMask = np.mean((np.abs(harmonic[1, :, 0, -1]) < 1.) != (np.abs(stamp[1, :, 0, -1]) < 1.))
+
         for iFilterType in range(len(self.filterTypes)):
-            filterType = self.filterTypes[iFilterType]
+            print("  "+self.filterTypes[iFilterType]+": filtMap residual", np.round(resMap[iFilterType], 4))
+            print("  "+self.filterTypes[iFilterType]+": filtHitNoiseStdDev residual", np.round(resNoise[iFilterType], 4))
+        print("  fraction of objects with a different point source mask", resMask)
+        return resMap, resNoise, resMask
+
+    def createAnnulusStore(self):
+        '''Create the binary file "annulus_sums.npy" for the annulus sums,
+        with shape [nObj, {map, 1-mask, 1/hit}, nAnnulus],
+        and save the annulus radii [rad] to "annulus_radius.npy".
+        '''
+        store = np.lib.format.open_memmap(self.pathOut+"/annulus_sums.npy", mode='w+',
+                                          dtype=np.float64, shape=(self.Catalog.nObj, 3, self.filterBank.nAnnulus))
+        np.save(self.pathOut+"/annulus_radius.npy", self.filterBank.annulusRadius)
+        return store
+
+    def saveFilteringFromAnnulusSums(self):
+        '''Evaluate the current AP filter types and radii on the saved annulus sums,
+        without extracting the cutouts again.
+        The cutout geometry, hence rApMaxArcmin, must be the same as when the sums were saved.
+        '''
+        print("- derive the AP filters from the saved annulus sums")
+        annulusRadius = np.load(self.pathOut+"/annulus_radius.npy")
+        if len(annulusRadius) != self.filterBank.nAnnulus or not np.allclose(annulusRadius, self.filterBank.annulusRadius):
+            raise ValueError("the saved annulus sums were computed for a different cutout geometry")
+        sums = np.load(self.pathOut+"/annulus_sums.npy", mmap_mode='r')
+        store = self.createFilteringStore()
+        for IObj in self.objectChunks():
+            result = self.filterBank.applyAnnulusSums(sums[IObj[0]:IObj[-1]+1])
+            result *= (self.overlapFlag[IObj] > 0.)[np.newaxis, :, np.newaxis, np.newaxis]
+            store[:, :, IObj[0]:IObj[-1]+1, :] = np.swapaxes(result, 1, 2)
+        store.flush()
+        del store
+
+    ##################################################################################
 
-            filtMap = np.array([result[iObj, 0][filterType][:]
-                               for iObj in range(self.Catalog.nObj)])
-            filtMask = np.array([result[iObj, 1][filterType][:]
-                                for iObj in range(self.Catalog.nObj)])
-            filtHitNoiseStdDev = np.array(
-                [result[iObj, 2][filterType][:] for iObj in range(self.Catalog.nObj)])
-            filtArea = np.array([result[iObj, 3][filterType][:]
-                                for iObj in range(self.Catalog.nObj)])
-
-            np.savetxt(self.pathOut+"/"+filterType+"_filtmap.txt", filtMap)
-            np.savetxt(self.pathOut+"/"+filterType+"_filtmask.txt", filtMask)
-            np.savetxt(self.pathOut+"/"+filterType +
-                       "_filtnoisestddev.txt", filtHitNoiseStdDev)
-            np.savetxt(self.pathOut+"/"+filterType+"_filtarea.txt", filtArea)
+    def catalogHash(self):
+        '''Hash of the catalog positions and redshifts,
+        to check that saved outputs match the catalog.
+        '''
+        h = hashlib.sha1()
+        for x in [self.Catalog.RA, self.Catalog.DEC, self.Catalog.Z]:
+            h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def mapChecksums(self):
+        '''Checksums of the map, mask and hit count (see stamp_cache.mapChecksum),
+        computed once, to check that saved outputs match the maps.
+        '''
+        if getattr(self, 'mapChecksumsCache', None) is None:
+            self.mapChecksumsCache = {
+                'map': mapChecksum(self.cmbMap),
+                'mask': mapChecksum(self.cmbMask),
+                'hit': mapChecksum(self.cmbHit),
+            }
+        return self.mapChecksumsCache
+
+    def filteringMeta(self):
+        '''Metadata header of the filter outputs.
+        '''
+        return {
+            'name': self.name,
+            'cmbNu': float(self.cmbNu),
+            'cmbUnitLatex': self.cmbUnitLatex,
+            'nObj': int(self.Catalog.nObj),
+            'catalogName': self.Catalog.name,
+            'catalogHash': self.catalogHash(),
+            'mapChecksums': self.mapChecksums(),
+            'filterTypes': [str(f) for f in self.filterTypes],
+            'RApArcmin': [float(r) for r in self.RApArcmin],
+            'quantities': ['filtMap', 'filtMask', 'filtHitNoiseStdDev', 'filtArea'],
+        }
+
+    def createFilteringStore(self):
+        '''Create the binary file "filtering.npy" for the filter outputs,
+        with shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nFilterTypes, nObj, nRAp],
+        and save the metadata to "filtering.json".
+        The running sums for the stacked maps of a previous filtering, if any, are removed.
+        Returns the store, memory-mapped for writing.
+        '''
+        if os.path.exists(self.pathOut+"/stackedmap_sums.json"):
+            os.remove(self.pathOut+"/stackedmap_sums.json")
+        store = np.lib.format.open_memmap(self.pathOut+"/filtering.npy", mode='w+',
+                                          dtype=np.float64, shape=(4, len(self.filterTypes), self.Catalog.nObj, self.nRAp))
+        with open(self.pathOut+"/filtering.json", 'w') as f:
+            json.dump(self.filteringMeta(), f, indent=1)
+        return store
+
+    def writeFilteringStore(self, result):
+        '''Save the filter outputs to the binary store.
+        result: array with shape [4, nObj, nFilterTypes, nRAp], as returned by analyzeChunk.
+        '''
+        store = self.createFilteringStore()
+        store[:] = np.swapaxes(result, 1, 2)
+        store.flush()
+        del store
+
+    def convertFilteringTxt(self):
+        '''One-time conversion of the text outputs of older runs
+        (four files per filter type) to the binary store.
+        '''
+        print("- convert the text filter outputs to "+self.pathOut+"/filtering.npy")
+        result = np.zeros((4, self.Catalog.nObj, len(self.filterTypes), self.nRAp))
+        for iFilterType in range(len(self.filterTypes)):
+            filterType = self.filterTypes[iFilterType]
+            result[0, :, iFilterType, :] = np.genfromtxt(self.pathOut+"/"+filterType+"_filtmap.txt")
+            result[1, :, iFilterType, :] = np.genfromtxt(self.pathOut+"/"+filterType+"_filtmask.txt")
+            result[2, :, iFilterType, :] = np.genfromtxt(self.pathOut+"/"+filterType+"_filtnoisestddev.txt")
+            result[3, :, iFilterType, :] = np.genfromtxt(self.pathOut+"/"+filterType+"_filtarea.txt")
+        self.writeFilteringStore(result)
 
     def loadFiltering(self):
+        path = self.pathOut+"/filtering.npy"
+        if not os.path.exists(path):
+            self.convertFilteringTxt()
+
+        # check that the store matches the catalog and the AP filters
+        with open(self.pathOut+"/filtering.json") as f:
+            meta = json.load(f)
+        if meta['nObj'] != self.Catalog.nObj or meta['catalogHash'] != self.catalogHash():
+            raise ValueError("filter outputs in "+path+" do not match the catalog "+self.Catalog.name)
+        if meta['filterTypes'] != [str(f) for f in self.filterTypes] or len(meta['RApArcmin']) != self.nRAp or not np.allclose(meta['RApArcmin'], self.RApArcmin):
+            if self.filterMode == 'annulus' and os.path.exists(self.pathOut+"/annulus_sums.npy"):
+                # new filter types or radii: derive them from the annulus sums
+                self.saveFilteringFromAnnulusSums()
+            else:
+                raise ValueError("filter outputs in "+path+" do not match the AP filters")
+
+        # memory-mapped, read-only
+        # shape [{filtMap, filtMask, filtHitNoiseStdDev, filtArea}, nFilterTypes, nObj, nRAp]
+        self.filtering = np.load(path, mmap_mode='r')
         self.filtMap = {}
         self.filtMask = {}
         self.filtHitNoiseStdDev = {}
@@ -618,14 +1254,10 @@ class ThumbStack(object):
 
         for iFilterType in range(len(self.filterTypes)):
             filterType = self.filterTypes[iFilterType]
-            self.filtMap[filterType] = np.genfromtxt(
-                self.pathOut+"/"+filterType+"_filtmap.txt")
-            self.filtMask[filterType] = np.genfromtxt(
-                self.pathOut+"/"+filterType+"_filtmask.txt")
-            self.filtHitNoiseStdDev[filterType] = np.genfromtxt(
-                self.pathOut+"/"+filterType+"_filtnoisestddev.txt")
-            self.filtArea[filterType] = np.genfromtxt(
-                self.pathOut+"/"+filterType+"_filtarea.txt")
+            self.filtMap[filterType] = self.filtering[0, iFilterType]
+            self.filtMask[filterType] = self.filtering[1, iFilterType]
+            self.filtHitNoiseStdDev[filterType] = self.filtering[2, iFilterType]
+            self.filtArea[filterType] = self.filtering[3, iFilterType]
 
     ##################################################################################
 
@@ -890,31 +1522,16 @@ class ThumbStack(object):
 
     ##################################################################################
 
-    def computeStackedProfile(self, filterType, est, iBootstrap=None, iVShuffle=None, tTh='', stackedMap=False, mVir=None, z=[0., 100.], ts=None, mask=None):
-        """Returns the estimated profile and its uncertainty for each aperture.
-        est: string to select the estimator
-        iBootstrap: index for bootstrap resampling
-        iVShuffle: index for shuffling velocities
+    def stackedProfileInputs(self, filterType, mask, tTh='', ts=None):
+        """Per-object inputs of the stacked profile estimators,
+        for the objects selected by mask:
+        temperatures t [map unit * sr], velocities v = -v_r/c [dimless],
+        hit count and full filter variances s2Hit, s2Full, and halo masses m.
         tTh: to replace measured temperatures by a theory expectation
         ts: option to specify another thumbstack object
         """
-
-        # tStart = time()
-
-        # print(("- Compute stacked profile: "+filterType+", "+est+", "+tTh))
-
-        # compute stacked profile from another thumbstack object
         if ts is None:
             ts = self
-        if mVir is None:
-            mVir = [ts.mMin, ts.mMax]
-
-        # select objects that overlap, and reject point sources
-        if mask is None:
-            mask = ts.catalogMask(overlap=True, psMask=True,
-                                  filterType=filterType, mVir=mVir, z=z)
-
-#      tMean = ts.meanT[filterType].copy()
 
         # temperatures [muK * sr]
         if tTh == '':
@@ -980,36 +1597,13 @@ class ThumbStack(object):
         # halo masses
         m = ts.Catalog.Mvir[mask]
 
-        if iBootstrap is not None:
-            # make sure each resample is independent,
-            # and make the resampling reproducible
-            np.random.seed(iBootstrap)
-            # list of overlapping objects
-            nObj = np.sum(mask)
-            # print "sample "iBootstrap, ";", nObj, "objects overlap with", ts.name
-            I = np.arange(nObj)
-            # choose with replacement from this list
-            J = np.random.choice(I, size=nObj, replace=True)
-            #
-            t = t[J, :]
-            # tMean = tMean[J,:]
-            v = v[J]
-            s2Hit = s2Hit[J, :]
-            s2Full = s2Full[J, :]
-            m = m[J]
-
-        if iVShuffle is not None:
-            # make sure each shuffling is independent,
-            # and make the shuffling reproducible
-            np.random.seed(iVShuffle)
-            # list of overlapping objects
-            nObj = np.sum(mask)
-            I = np.arange(nObj)
-            # shuffle the velocities
-            J = np.random.permutation(I)
-            #
-            v = v[J]
+        return t, v, s2Hit, s2Full, m
 
+    def estimatorWeights(self, est, v, s2Hit, s2Full, m, rV=1.):
+        '''Weights [nObj, nRAp] of the objects in the stacked profile of the estimator est,
+        and the normalization [nRAp] of the weighted sum.
+        Same inputs as returned by stackedProfileInputs.
+        '''
         # tSZ: uniform weighting
         if est == 'tsz_uniformweight':
             weights = np.ones_like(s2Hit)
@@ -1030,7 +1624,7 @@ class ThumbStack(object):
             #         t -= tMean
             weights = v[:, np.newaxis] * np.ones_like(s2Hit)
             # norm = sVTrue / np.sum(v[:,np.newaxis]*weights, axis=0)
-            norm = np.std(v) / ts.Catalog.rV / \
+            norm = np.std(v) / rV / \
                 np.sum(v[:, np.newaxis]*weights, axis=0)
         # kSZ: detector-noise weighted (hit count)
         elif est == 'ksz_hitweight':
@@ -1039,7 +1633,7 @@ class ThumbStack(object):
             #         t -= tMean
             weights = v[:, np.newaxis] / s2Hit
             # norm = sVTrue / np.sum(v[:,np.newaxis]*weights, axis=0)
-            norm = np.std(v) / ts.Catalog.rV / \
+            norm = np.std(v) / rV / \
                 np.sum(v[:, np.newaxis]*weights, axis=0)
         # kSZ: full noise weighted (detector noise + CMB)
         elif est == 'ksz_varweight':
@@ -1048,7 +1642,7 @@ class ThumbStack(object):
             #         t -= tMean
             weights = v[:, np.newaxis] / s2Full
             # norm = sVTrue / np.sum(v[:,np.newaxis]*weights, axis=0)
-            norm = np.std(v) / ts.Catalog.rV / \
+            norm = np.std(v) / rV / \
                 np.sum(v[:, np.newaxis]*weights, axis=0)
         # kSZ: full noise weighted (detector noise + CMB)
         elif est == 'ksz_massvarweight':
@@ -1057,10 +1651,71 @@ class ThumbStack(object):
             #         t -= tMean
             weights = m[:, np.newaxis] * v[:, np.newaxis] / s2Full
             # norm = np.mean(m) * sVTrue / np.sum(m[:,np.newaxis]**2 * v[:,np.newaxis]**2 / s2Full, axis=0)
-            norm = np.mean(m) * np.std(v) / ts.Catalog.rV / \
+            norm = np.mean(m) * np.std(v) / rV / \
                 np.sum(m[:, np.newaxis]**2 *
                        v[:, np.newaxis]**2 / s2Full, axis=0)
 
+        return weights, norm
+
+    def computeStackedProfile(self, filterType, est, iBootstrap=None, iVShuffle=None, tTh='', stackedMap=False, mVir=None, z=[0., 100.], ts=None, mask=None):
+        """Returns the estimated profile and its uncertainty for each aperture.
+        est: string to select the estimator
+        iBootstrap: index for bootstrap resampling
+        iVShuffle: index for shuffling velocities
+        tTh: to replace measured temperatures by a theory expectation
+        ts: option to specify another thumbstack object
+        """
+
+        # tStart = time()
+
+        # print(("- Compute stacked profile: "+filterType+", "+est+", "+tTh))
+
+        # compute stacked profile from another thumbstack object
+        if ts is None:
+            ts = self
+        if mVir is None:
+            mVir = [ts.mMin, ts.mMax]
+
+        # select objects that overlap, and reject point sources
+        if mask is None:
+            mask = ts.catalogMask(overlap=True, psMask=True,
+                                  filterType=filterType, mVir=mVir, z=z)
+
+        t, v, s2Hit, s2Full, m = self.stackedProfileInputs(
+            filterType, mask, tTh=tTh, ts=ts)
+
+        if iBootstrap is not None:
+            # make sure each resample is independent,
+            # and make the resampling reproducible
+            np.random.seed(iBootstrap)
+            # list of overlapping objects
+            nObj = np.sum(mask)
+            # print "sample "iBootstrap, ";", nObj, "objects overlap with", ts.name
+            I = np.arange(nObj)
+            # choose with replacement from this list
+            J = np.random.choice(I, size=nObj, replace=True)
+            #
+            t = t[J, :]
+            # tMean = tMean[J,:]
+            v = v[J]
+            s2Hit = s2Hit[J, :]
+            s2Full = s2Full[J, :]
+            m = m[J]
+
+        if iVShuffle is not None:
+            # make sure each shuffling is independent,
+            # and make the shuffling reproducible
+            np.random.seed(iVShuffle)
+            # list of overlapping objects
+            nObj = np.sum(mask)
+            I = np.arange(nObj)
+            # shuffle the velocities
+            J = np.random.permutation(I)
+            #
+            v = v[J]
+
+        weights, norm = self.estimatorWeights(est, v, s2Hit, s2Full, m, rV=ts.Catalog.rV)
+
         # tStop = time()
         # print "stacked profile took", tStop-tStart, "sec"
 
@@ -1072,17 +1727,6 @@ class ThumbStack(object):
 
         # or, if requested, compute and return the stacked cutout map
         else:
-            # define chunks
-            nChunk = ts.nProc
-            chunkSize = int(ts.Catalog.nObj / nChunk)
-            # list of indices for each of the nChunk chunks
-            chunkIndices = [
-                list(range(iChunk*chunkSize, (iChunk+1)*chunkSize)) for iChunk in range(nChunk)]
-            # make sure not to miss the last few objects:
-            # add them to the last chunk
-            chunkIndices[-1] = list(range((nChunk-1) *
-                                    chunkSize, ts.Catalog.nObj))
-
             # select weights for a typical aperture size (not the smallest, not the largest)
             # iRAp0 = ts.nRAp / 2
             iRAp0 = int(ts.nRAp / 4)
@@ -1090,39 +1734,51 @@ class ThumbStack(object):
             # need to link object number with weight,
             # despite the mask
             weightsLong = np.zeros(ts.Catalog.nObj)
-            weightsLong[mask] = weights[:, iRAp0]
-
-            def stackChunk(iChunk):
-                # object indices to be processed
-                chunk = chunkIndices[iChunk]
-
-                # start with a null map for stacking
-                resMap = ts.cutoutGeometry()
-                for iObj in chunk:
-                    # if iObj % 100000 == 0:
-                    #     print("- analyze object", iObj)
-                    if ts.overlapFlag[iObj]:
-                        # Object coordinates
-                        ra = ts.Catalog.RA[iObj]   # in deg
-                        dec = ts.Catalog.DEC[iObj]  # in deg
-                        z = ts.Catalog.Z[iObj]
-                        # extract postage stamp around it
-                        opos, stampMap, stampMask, stampHit = ts.extractStamp(
-                            ra, dec, test=False)
-                        resMap += stampMap * weightsLong[iObj]
-                return resMap
-
-            # dispatch each chunk of objects to a different processor
-            with sharedmem.MapReduce(np=ts.nProc) as pool:
-                resMap = np.array(pool.map(stackChunk, list(range(nChunk))))
-
-            # sum all the chunks
-            resMap = np.sum(resMap, axis=0)
-            # normalize by the proper sum of weights
-            resMap *= norm
+            weightsLong[mask] = norm * weights[:, iRAp0]
+            resMap, sResMap = ts.stackCutouts(weightsLong[np.newaxis, :])
+            return resMap[0]
 
+    def stackedMapWeights(self, filterType, est):
+        '''Weights [nObj] of all the objects in the stacked map of the estimator est,
+        including the normalization, as in computeStackedProfile (zero outside the stack).
+        '''
+        mask = self.catalogMask(overlap=True, psMask=True, filterType=filterType)
+        t, v, s2Hit, s2Full, m = self.stackedProfileInputs(filterType, mask)
+        weights, norm = self.estimatorWeights(est, v, s2Hit, s2Full, m, rV=self.Catalog.rV)
+        iRAp0 = int(self.nRAp / 4)
+        weightsLong = np.zeros(self.Catalog.nObj)
+        weightsLong[mask] = norm[iRAp0] * weights[:, iRAp0]
+        return weightsLong
+
+    def stackCutouts(self, W):
+        '''Stacked cutouts for several sets of object weights W [nMap, nObj],
+        in a single pass over the objects with a non-zero weight in any set.
+        Returns the stacked maps sum_i W_i T_i and their per-pixel uncertainties
+        sqrt(sum_i W_i^2 T_i^2), with shape [nMap, ny, nx].
+        '''
+        W = np.atleast_2d(W)
+        # only the objects in the stacks, in chunks of at most nObjPerChunk objects,
+        # interleaved between the processes to balance the load
+        chunks = [IObj for IObj in self.objectChunks(np.where(np.any(W != 0., axis=0))[0]) if len(IObj) > 0]
+
+        def stackChunks(iProc):
+            # start with null maps for stacking
+            resMap = np.zeros((2, len(W)) + self.cutoutGeometry().shape)
+            for IObj in chunks[iProc::self.nProc]:
+                # extract the postage stamps in batches
+                # (read from the stamp cache if available)
+                opos, stamps = self.extractStamps(IObj)
+                resMap[0] += np.tensordot(W[:, IObj], stamps[:, 0], axes=1)
+                resMap[1] += np.tensordot(W[:, IObj]**2, stamps[:, 0]**2, axes=1)
             return resMap
 
+        # dispatch the chunks of objects to the processors
+        with sharedmem.MapReduce(np=self.nProc) as pool:
+            resMap = np.array(pool.map(stackChunks, list(range(max(1, min(self.nProc, len(chunks)))))))
+        # sum all the chunks
+        resMap = np.sum(resMap, axis=0)
+        return resMap[0], np.sqrt(resMap[1])
+
 
 #   def computeStackedProfile(self, filterType, est, iBootstrap=None, iVShuffle=None, tTh=None, stackedMap=False, mVir=None, z=[0., 100.]):
 #      """Returns the estimated profile and its uncertainty for each aperture.
@@ -1344,30 +2000,148 @@ class ThumbStack(object):
 
     ##################################################################################
 
-    def SaveCovBootstrapStackedProfile(self, filterType, est, mVir=None, z=[0., 100.], nSamples=100, nProc=1):
-        """Estimate covariance matrix for the stacked profile from bootstrap resampling
+    def nestedEstimatorTerms(self, est, t, v, s2Hit, s2Full, m):
+        """Per-object terms of the estimator est, with shape [nObj, nTerms, nRAp],
+        such that the stacked profile and its error on any subsample
+        only depend on the sums of these terms over the subsample.
+        For kSZ, the mean velocity vBar of the subsample is removed
+        by expanding the weights w = p (v - vBar) u in powers of vBar.
+        Same inputs as returned by stackedProfileInputs.
+        """
+        ones = np.ones_like(s2Hit)
+        if est in ['tsz_uniformweight', 'ksz_uniformweight']:
+            u = ones
+        elif est in ['tsz_hitweight', 'ksz_hitweight']:
+            u = 1. / s2Hit
+        elif est in ['tsz_varweight', 'ksz_varweight', 'ksz_massvarweight']:
+            u = 1. / s2Full
+
+        if est.startswith('tsz'):
+            # sum(w t), sum(w), sum(s2 w^2)
+            terms = [u * t, u, s2Full * u**2]
+        else:
+            v = v[:, np.newaxis] * ones
+            if est == 'ksz_massvarweight':
+                p = m[:, np.newaxis] * ones
+            else:
+                p = ones
+            terms = [
+                # sum(w t) = a1 - vBar a2
+                p * u * t * v, p * u * t,
+                # sum(p (v - vBar) w) = b1 - 2 vBar b2 + vBar^2 b3
+                p**2 * u * v**2, p**2 * u * v, p**2 * u,
+                # sum(s2 w^2) = c1 - 2 vBar c2 + vBar^2 c3
+                s2Full * (p * u * v)**2, s2Full * (p * u)**2 * v, s2Full * (p * u)**2,
+                # number of objects, sum(v), sum(v^2), sum(m)
+                ones, v, v**2, m[:, np.newaxis] * ones]
+        return np.stack(terms, axis=1)
+
+    def nestedEstimatorStack(self, est, sums):
+        """Stacked profiles and errors [..., nRAp] from the sums [..., nTerms, nRAp]
+        of the terms returned by nestedEstimatorTerms.
+        """
+        sums = np.moveaxis(sums, -2, 0)
+        if est.startswith('tsz'):
+            return sums[0] / sums[1], np.sqrt(sums[2]) / sums[1]
+        n = sums[8]
+        vBar = sums[9] / n
+        sV = np.sqrt(np.maximum(sums[10] / n - vBar**2, 0.))
+        sumWT = sums[0] - vBar * sums[1]
+        sumPVW = sums[2] - 2. * vBar * sums[3] + vBar**2 * sums[4]
+        sumS2W2 = sums[5] - 2. * vBar * sums[6] + vBar**2 * sums[7]
+        norm = sV / self.Catalog.rV / sumPVW
+        if est == 'ksz_massvarweight':
+            norm *= sums[11] / n
+        return norm * sumWT, norm * np.sqrt(np.maximum(sumS2W2, 0.))
+
+    def computeNestedStackedProfiles(self, filterType, est, x, xMax, baseMask, tThs=['']):
+        """Stacked profiles and errors for the nested subsamples
+        baseMask * (x <= xMax[k]), for all the thresholds xMax at once,
+        with the same outlier rejection as catalogMask on each subsample.
+        The objects are sorted in x once, and the estimator terms are summed
+        cumulatively. The outliers depend on the subsample
+        (through its size and filter std dev): their terms are subtracted exactly.
+        x: quantity to threshold [nObj], eg Catalog.Mvir or Catalog.Z
+        xMax: thresholds [nX]
+        baseMask: all the other cuts, without outlier rejection [nObj]
+        tThs: list of tTh values, as in computeStackedProfile
+        Returns stack, sStack with shape [len(tThs), nX, nRAp]
+        """
+        xMax = np.asarray(xMax)
+        nX = len(xMax)
+        baseMask = np.asarray(baseMask).astype(bool)
+        # sort the objects of the base sample in x
+        I = np.where(baseMask)[0]
+        iSort = np.argsort(x[I], kind='stable')
+        # number of objects in each subsample (before outlier rejection):
+        # the first nK[k] objects in sorted order
+        nK = np.searchsorted(x[I][iSort], xMax, side='right')
+
+        # outlier rejection, as in catalogMask
+        t0Sorted = np.asarray(self.filtMap[filterType])[I][iSort]
+        zero = np.zeros((1, self.nRAp))
+        sumT = np.concatenate((zero, np.cumsum(t0Sorted, axis=0)))[nK]
+        sumT2 = np.concatenate((zero, np.cumsum(t0Sorted**2, axis=0)))[nK]
+        # thresholds on |t| for each subsample [nX, nRAp]
+        thresh = np.zeros((nX, self.nRAp))
+        for k in range(nX):
+            if nK[k] == 0:
+                thresh[k] = np.nan
+                continue
+
+            def f(nSigmas): return nK[k] * special.erfc(nSigmas / np.sqrt(2.)) - special.erfc(5. / np.sqrt(2.))
+            nSigmasCut = optimize.brentq(f, 0., 1.e2)
+            sigmas = np.sqrt(np.maximum(sumT2[k] / nK[k] - (sumT[k] / nK[k])**2, 0.))
+            thresh[k] = nSigmasCut * sigmas
+        empty = np.any(np.isnan(thresh), axis=1)
+        # candidate outliers: above the lowest threshold
+        threshMin = np.min(thresh[~empty], axis=0) if np.any(~empty) else np.zeros(self.nRAp)
+        iCand = np.where(np.any(np.abs(t0Sorted) > threshMin[np.newaxis, :], axis=1))[0]
+        # isOutlier[i, k]: candidate i is in subsample k and rejected there
+        isOutlier = np.any(np.abs(t0Sorted[iCand])[:, np.newaxis, :] > thresh[np.newaxis, :, :], axis=2)
+        isOutlier *= iCand[:, np.newaxis] < nK[np.newaxis, :]
+
+        stack = np.zeros((len(tThs), nX, self.nRAp))
+        sStack = np.zeros((len(tThs), nX, self.nRAp))
+        for iTh in range(len(tThs)):
+            # stackedProfileInputs keeps the catalog order: sort the terms in x
+            terms = self.nestedEstimatorTerms(est, *self.stackedProfileInputs(filterType, baseMask, tTh=tThs[iTh]))[iSort]
+            # sums over the first nK[k] objects
+            sums = np.concatenate((np.zeros((1,) + terms.shape[1:]), np.cumsum(terms, axis=0)))[nK]
+            # remove the outliers of each subsample
+            sums -= np.einsum('ik,itr->ktr', 1. * isOutlier, terms[iCand])
+            stack[iTh], sStack[iTh] = self.nestedEstimatorStack(est, sums)
+        # subsamples without any object
+        stack[:, empty] = np.nan
+        sStack[:, empty] = np.nan
+        return stack, sStack
+
+    ##################################################################################
+
+    def SaveCovBootstrapStackedProfile(self, filterType, est, mVir=None, z=[0., 100.], nSamples=100, seed=0):
+        """Estimate covariance matrix for the stacked profile from bootstrap resampling.
+        All the resamples are evaluated at once with BootstrapStack.
         """
         # print("Performing", nSamples, "bootstrap resamples")
         if mVir is None:
             mVir = [self.mMin, self.mMax]
         tStart = time()
-        with sharedmem.MapReduce(np=nProc) as pool:
-            def f(iSample): return self.computeStackedProfile(
-                filterType, est, iBootstrap=iSample, mVir=mVir, z=z)
-            result = np.array(pool.map(f, list(range(nSamples))))
-            # result = np.array(map(f, range(nSamples)))
+        mask = self.catalogMask(overlap=True, psMask=True,
+                                filterType=filterType, mVir=mVir, z=z)
+        t, v, s2Hit, s2Full, m = self.stackedProfileInputs(filterType, mask)
+        resampler = BootstrapStack(np.sum(mask), nSamples=nSamples, seed=seed)
+        # shape (nSamples, nRAp)
+        stackSamples = resampler.stackSamples(
+            est, t, v, s2Hit, s2Full, m, rV=self.Catalog.rV)
         tStop = time()
         # print("took", (tStop-tStart)/60., "min")
-        # unpack results
-        stackSamples = result[:, 0, :]  # shape (nSamples, nRAp)
-        # sStackSamples = result[:,1,:]
         # estimate cov
         covStack = np.cov(stackSamples, rowvar=False)
         # save it to file
         np.savetxt(self.pathOut+"/cov_"+filterType +
                    "_"+est+"_bootstrap.txt", covStack)
 
-    def SaveCovBootstrapTwoStackedProfiles(self, ts2, filterType, est, mVir=None, z=[0., 100.], nSamples=100, nProc=1):
+    def SaveCovBootstrapTwoStackedProfiles(self, ts2, filterType, est, mVir=None, z=[0., 100.], nSamples=100, seed=0):
         """Estimate the full covariance for two stacked profiles.
         These need to use the same galaxy catalog. The temperature maps can be different.
         Resamples only the objects in common, then rescales the cov assuming
@@ -1399,19 +2173,15 @@ class ThumbStack(object):
         f22 = 1. * n12 / n2 * block
         rescaleMat = np.block([[f11, f12], [f12, f22]])
 
-        def f(iSample):
-            # print "Joint Bootstrap", iSample
-            prof1 = self.computeStackedProfile(
-                filterType, est, iBootstrap=iSample, mVir=mVir, z=z, mask=mask12)
-            prof2 = self.computeStackedProfile(
-                filterType, est, iBootstrap=iSample, mVir=mVir, z=z, ts=ts2, mask=mask12)
-            # concatenate the 2 profiles
-            jointProf = np.concatenate((prof1[0], prof2[0]))
-            return jointProf
-
-        with sharedmem.MapReduce(np=nProc) as pool:
-            stackSamples = np.array(pool.map(f, list(range(nSamples))))
-            # result = np.array(map(f, range(nSamples)))
+        # the same resamples are used for both profiles:
+        # concatenate the estimator terms of the 2 profiles along the aperture axis
+        resampler = BootstrapStack(n12, nSamples=nSamples, seed=seed)
+        terms = np.concatenate([
+            resampler.estimatorTerms(est, *self.stackedProfileInputs(filterType, mask12)),
+            resampler.estimatorTerms(est, *self.stackedProfileInputs(filterType, mask12, ts=ts2))], axis=-1)
+        # shape (nSamples, 2*nRAp)
+        stackSamples = resampler.estimatorStack(
+            est, resampler.resampledSums(terms), rV=self.Catalog.rV)
         tStop = time()
         # print("took", (tStop-tStart)/60., "min")
         # estimate cov
@@ -1438,23 +2208,24 @@ class ThumbStack(object):
             for iEst in range(len(self.EstBootstrap)):
                 est = self.EstBootstrap[iEst]
                 self.SaveCovBootstrapTwoStackedProfiles(
-                    ts2, filterType, est, nSamples=self.nSamples, nProc=min(8, self.nProc))
+                    ts2, filterType, est, nSamples=self.nSamples)
 
-    def SaveCovVShuffleStackedProfile(self, filterType, est, mVir=None, z=[0., 100.], nSamples=100, nProc=1):
-        """Estimate covariance matrix for the stacked profile from shuffling velocities
+    def SaveCovVShuffleStackedProfile(self, filterType, est, mVir=None, z=[0., 100.], nSamples=100, seed=0):
+        """Estimate covariance matrix for the stacked profile from shuffling velocities.
+        All the shuffles are evaluated at once with VShuffleStack.
         """
         if mVir is None:
             mVir = [self.mMin, self.mMax]
         tStart = time()
-        with sharedmem.MapReduce(np=nProc) as pool:
-            def f(iSample): return self.computeStackedProfile(
-                filterType, est, iVShuffle=iSample, mVir=mVir, z=z)
-            result = np.array(pool.map(f, list(range(nSamples))))
+        mask = self.catalogMask(overlap=True, psMask=True,
+                                filterType=filterType, mVir=mVir, z=z)
+        t, v, s2Hit, s2Full, m = self.stackedProfileInputs(filterType, mask)
+        shuffler = VShuffleStack(np.sum(mask), nSamples=nSamples, seed=seed)
+        # shape (nSamples, nRAp)
+        stackSamples = shuffler.stackSamples(
+            est, t, v, s2Hit, s2Full, m, rV=self.Catalog.rV)
         tStop = time()
         # print("took", (tStop-tStart)/60., "min")
-        # unpack results
-        stackSamples = result[:, 0, :]  # shape (nSamples, nRAp)
-        # sStackSamples = result[:,1,:]
         # estimate cov
         covStack = np.cov(stackSamples, rowvar=False)
         # save it to file
@@ -1487,6 +2258,31 @@ class ThumbStack(object):
         baseMap = FlatMap(
             nX=cutoutMap.shape[0], nY=cutoutMap.shape[1], sizeX=size, sizeY=size)
 
+        # running sums of the cutouts, if accumulated during the filtering
+        iRAp0 = int(self.nRAp / 4)
+        sums = StackedMapSums(self, Est, iRAp0)
+        if len(sums.Est) == 0 or not sums.load(self.pathOut+"/stackedmap_sums"):
+            sums = None
+        else:
+            # remove the outliers, rejected after the filtering,
+            # from the cutouts recorded during the filtering
+            for iFilterType in range(len(self.filterTypes)):
+                filterType = self.filterTypes[iFilterType]
+                I = np.where(self.catalogMask(filterType=filterType, outlierReject=False) * ~self.catalogMask(filterType=filterType))[0]
+                I = sums.removeOutliers(iFilterType, I)
+                if len(I) > 0:
+                    print("- extract the cutouts of "+str(len(I))+" outliers not recorded during the filtering")
+                    opos, stamps = self.extractStamps(I)
+                    result = np.swapaxes(np.asarray(self.filtering[:, :, I, :]), 1, 2)
+                    sums.add(I, stamps, result, sign=-1., iFilterTypes=[iFilterType])
+
+        # the other stacked maps (eg var weightings with a hit count map)
+        # are all computed in a single pass over the cutouts
+        exact = [(filterType, est) for filterType in filterTypes for est in Est if sums is None or not sums.hasEstimator(est)]
+        if len(exact) > 0:
+            W = np.array([self.stackedMapWeights(filterType, est) for filterType, est in exact])
+            exactMaps, sExactMaps = self.stackCutouts(W)
+
         # loop over filter types: only matter
         # because they determine the weights in the stacked map
         for iFilterType in range(len(filterTypes)):
@@ -1495,8 +2291,14 @@ class ThumbStack(object):
             for iEst in range(len(Est)):
                 est = Est[iEst]
                 # print("compute stacked map:", filterType, est)
-                stackedMap = self.computeStackedProfile(
-                    filterType, est, iBootstrap=None, iVShuffle=None, tTh='', stackedMap=True)
+                if (filterType, est) in exact:
+                    stackedMap = exactMaps[exact.index((filterType, est))]
+                    sStackedMap = sExactMaps[exact.index((filterType, est))]
+                else:
+                    mask = self.catalogMask(filterType=filterType)
+                    stackedMap, sStackedMap = sums.stackedMap(filterType, est, mask, rV=self.Catalog.rV)
+                # per-pixel uncertainty of the stacked cutout
+                np.savetxt(self.pathOut + "/stackedmaperr_"+filterType+"_"+est+".txt", sStackedMap)
 
                 # save the stacked cutout
                 path = self.pathOut + "/stackedmap_"+filterType+"_"+est+".txt"
@@ -1550,49 +2352,52 @@ class ThumbStack(object):
             # covariance matrices from bootstrap,
             # only for a few select estimators
             if self.doBootstrap:
-                for iEst in range(len(self.EstBootstrap)):
-                    est = self.EstBootstrap[iEst]
-                    self.SaveCovBootstrapStackedProfile(
-                        filterType, est, nSamples=self.nSamples, nProc=self.nProc)
+                with self.profiler.stage('bootstrap', nObj=self.Catalog.nObj):
+                    for iEst in range(len(self.EstBootstrap)):
+                        est = self.EstBootstrap[iEst]
+                        self.SaveCovBootstrapStackedProfile(
+                            filterType, est, nSamples=self.nSamples)
 
             # covariance matrices from shuffling velocities,
             # for ksz only
             if self.doVShuffle:
-                for iEst in range(len(self.EstVShuffle)):
-                    est = self.EstVShuffle[iEst]
-                    self.SaveCovVShuffleStackedProfile(
-                        filterType, est, nSamples=self.nSamples, nProc=self.nProc)
+                with self.profiler.stage('vshuffle', nObj=self.Catalog.nObj):
+                    for iEst in range(len(self.EstVShuffle)):
+                        est = self.EstVShuffle[iEst]
+                        self.SaveCovVShuffleStackedProfile(
+                            filterType, est, nSamples=self.nSamples)
 
         # Stacked profiles in mass bins, to check for contamination
         if self.doMBins:
-            for iFilterType in range(len(self.filterTypes)):
-                filterType = self.filterTypes[iFilterType]
-                for iEst in range(len(self.EstMBins)):
-                    est = self.EstMBins[iEst]
-                    data = np.zeros((self.nRAp, 2*self.nMMax+1))
-                    data[:, 0] = self.RApArcmin  # [arcmin]
-                    dataTsz = data.copy()
-                    dataKsz = data.copy()
-                    for iMMax in range(self.nMMax):
-                        mMax = self.MMax[iMMax]
-
-                        # measured stacked profile
-                        data[:, 1+2*iMMax], data[:, 1+2*iMMax+1] = self.computeStackedProfile(
-                            filterType, est, mVir=[1.e6, mMax])  # [map unit * sr]
-                        # expcted from tSZ
-                        dataTsz[:, 1+2*iMMax], dataTsz[:, 1+2*iMMax+1] = self.computeStackedProfile(
-                            filterType, est, mVir=[1.e6, mMax], tTh='tsz')  # [map unit * sr]
-                        # expected from kSZ
-                        dataKsz[:, 1+2*iMMax], dataKsz[:, 1+2*iMMax+1] = self.computeStackedProfile(
-                            filterType, est, mVir=[1.e6, mMax], tTh='ksz')  # [map unit * sr]
-
-                    # Save all stacked profiles
-                    np.savetxt(self.pathOut+"/"+filterType+"_" +
-                               est+"_mmax_measured.txt", data)
-                    np.savetxt(self.pathOut+"/"+filterType+"_" +
-                               est+"_mmax_theory_tsz.txt", dataTsz)
-                    np.savetxt(self.pathOut+"/"+filterType+"_" +
-                               est+"_mmax_theory_ksz.txt", dataKsz)
+            with self.profiler.stage('mBins', nObj=self.Catalog.nObj):
+                for iFilterType in range(len(self.filterTypes)):
+                    filterType = self.filterTypes[iFilterType]
+                    for iEst in range(len(self.EstMBins)):
+                        est = self.EstMBins[iEst]
+                        data = np.zeros((self.nRAp, 2*self.nMMax+1))
+                        data[:, 0] = self.RApArcmin  # [arcmin]
+                        dataTsz = data.copy()
+                        dataKsz = data.copy()
+                        # all the nested mass thresholds at once, for measured, tSZ and kSZ
+                        baseMask = self.catalogMask(overlap=True, psMask=True, filterType=filterType,
+                                                    mVir=[1.e6, np.inf], outlierReject=False)
+                        stack, sStack = self.computeNestedStackedProfiles(
+                            filterType, est, self.Catalog.Mvir, self.MMax, baseMask, tThs=['', 'tsz', 'ksz'])  # [map unit * sr]
+                        for iMMax in range(self.nMMax):
+                            # measured stacked profile
+                            data[:, 1+2*iMMax], data[:, 1+2*iMMax+1] = stack[0, iMMax], sStack[0, iMMax]
+                            # expcted from tSZ
+                            dataTsz[:, 1+2*iMMax], dataTsz[:, 1+2*iMMax+1] = stack[1, iMMax], sStack[1, iMMax]
+                            # expected from kSZ
+                            dataKsz[:, 1+2*iMMax], dataKsz[:, 1+2*iMMax+1] = stack[2, iMMax], sStack[2, iMMax]
+
+                        # Save all stacked profiles
+                        np.savetxt(self.pathOut+"/"+filterType+"_" +
+                                   est+"_mmax_measured.txt", data)
+                        np.savetxt(self.pathOut+"/"+filterType+"_" +
+                                   est+"_mmax_theory_tsz.txt", dataTsz)
+                        np.savetxt(self.pathOut+"/"+filterType+"_" +
+                                   est+"_mmax_theory_ksz.txt", dataKsz)
 
         tStop = time()
         print("Computing all stacked profiles (and cov) took",
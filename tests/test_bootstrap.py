@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from bootstrap import BootstrapStack, VShuffleStack
+
+
+def test_bootstrap_counts_are_pinned_to_the_seed():
+    resampler = BootstrapStack(6, nSamples=4, seed=1)
+    C = np.concatenate(list(resampler.countBlocks()))
+    assert C.tolist() == [[1, 3, 0, 2, 0, 0],
+                          [0, 1, 2, 1, 1, 1],
+                          [0, 2, 1, 1, 2, 0],
+                          [0, 1, 0, 1, 1, 3]]
+
+
+def test_bootstrap_counts_do_not_depend_on_the_block_size():
+    C = np.concatenate(list(BootstrapStack(50, nSamples=7, seed=3).countBlocks()))
+    resampler = BootstrapStack(50, nSamples=7, seed=3, maxBlockEntries=100)
+    assert resampler.nBlock == 2
+    assert np.array_equal(np.concatenate(list(resampler.countBlocks())), C)
+    assert np.all(C.sum(axis=1) == 50)
+
+
+def test_bootstrap_tsz_stack_matches_the_resampled_weighted_means():
+    rng = np.random.default_rng(0)
+    nObj, nRAp = 40, 3
+    t = rng.normal(size=(nObj, nRAp))
+    s2Hit = rng.uniform(1., 2., size=(nObj, nRAp))
+    resampler = BootstrapStack(nObj, nSamples=5, seed=2)
+    samples = resampler.stackSamples('tsz_hitweight', t, None, s2Hit, None, None)
+    C = np.concatenate(list(resampler.countBlocks()))
+    expected = np.array([np.sum(c[:, None] * t / s2Hit, axis=0) / np.sum(c[:, None] / s2Hit, axis=0) for c in C])
+    assert np.allclose(samples, expected)
+
+
+def test_vshuffle_velocities_are_pinned_to_the_seed():
+    shuffler = VShuffleStack(5, nSamples=3, seed=2)
+    V = np.concatenate(list(shuffler.velocityBlocks(np.arange(5.))))
+    assert V.tolist() == [[2., 4., 3., 0., 1.],
+                          [2., 0., 4., 3., 1.],
+                          [4., 3., 2., 1., 0.]]
+
+
+def test_vshuffle_velocities_do_not_depend_on_the_block_size():
+    v = np.random.default_rng(0).normal(size=30)
+    V = np.concatenate(list(VShuffleStack(30, nSamples=5, seed=4).velocityBlocks(v)))
+    shuffler = VShuffleStack(30, nSamples=5, seed=4, maxBlockEntries=60)
+    assert shuffler.nBlock == 2
+    assert np.array_equal(np.concatenate(list(shuffler.velocityBlocks(v))), V)
+    assert np.allclose(np.sort(V, axis=1), np.sort(v)[np.newaxis, :])
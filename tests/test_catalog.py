@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from catalog import Catalog, catalogColumns, saveCatalogColumns
+
+
+def loadedCatalog(path, nObj):
+    # a Catalog reading its columns from the columnar store, as after loadCatalog
+    cat = Catalog.__new__(Catalog)
+    cat.name = "test"
+    cat.nObj = nObj
+    cat.pathOutColumns = path + "/columns"
+    cat.lazyColumns = True
+    return cat
+
+
+def test_loaded_columns_can_be_modified_in_place(tmp_path):
+    data = np.arange(10. * len(catalogColumns)).reshape((10, len(catalogColumns)))
+    saveCatalogColumns(str(tmp_path) + "/columns", data)
+    cat = loadedCatalog(str(tmp_path), len(data))
+    iMvir = catalogColumns.index('Mvir')
+    cat.Mvir[2:4] = -1.
+    assert np.all(cat.Mvir[2:4] == -1.)
+    # the columnar store is unchanged
+    assert np.array_equal(np.load(str(tmp_path) + "/columns/Mvir.npy"), data[:, iMvir])
+    assert np.array_equal(loadedCatalog(str(tmp_path), len(data)).Mvir, data[:, iMvir])
+
+
+def positionCatalog(RA, DEC, Z):
+    # a Catalog with the given positions and redshifts, and vR = index
+    cat = Catalog.__new__(Catalog)
+    cat.name = "test"
+    cat.nObj = len(RA)
+    for column in catalogColumns:
+        setattr(cat, column, np.zeros(cat.nObj))
+    cat.RA = np.array(RA, dtype=float)
+    cat.DEC = np.array(DEC, dtype=float)
+    cat.Z = np.array(Z, dtype=float)
+    cat.vR = np.arange(cat.nObj, dtype=float)
+    return cat
+
+
+def test_intersection_matches_on_the_sphere():
+    # across RA=0/360, at high DEC, too far on the sky, too far in redshift
+    cat = positionCatalog([359.9999, 10., 50., 100.], [0., 80., 0., 0.], [0.5, 0.5, 0.5, 0.5])
+    newCat = positionCatalog([0.0004, 10.004, 50.01, 100.], [0., 80., 0., 0.], [0.5, 0.5, 0.5, 0.6])
+    cat.intersectCatalog(newCat, vDiff=True)
+    assert cat.nObj == 2
+    assert np.array_equal(cat.RA, [359.9999, 10.])
+    assert np.all(cat.vR == 0.)